@@ -0,0 +1,88 @@
+"""Measures trigger throughput with many concurrent writers on one service.
+
+Compares the server-side trigger script with the WATCH/MULTI transaction
+that it replaced. Runs against the test redis instance, which is flushed.
+
+    $ redis-server test/redis-test.conf
+    $ python bench/contention.py --writers 1,4,16,64
+"""
+import json
+import optparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import lovebeat
+
+SID = 'bench.hot'
+
+
+def watch_multi_trigger(db, sid, now, stats):
+    """ The trigger as it was implemented before the script existed.
+    """
+    def trans(pipe):
+        stats['attempts'] += 1
+        conf_present, conf = lovebeat.load_service_config(pipe, sid)
+        state = lovebeat.load_service_state(pipe, sid)
+        if state.get('maint', {}).get('type') == 'soft':
+            del state['maint']
+        pipe.multi()
+        pipe.zadd("lb:services:all", 0, sid)
+        state['last']['ts'] = now
+        state['last']['val'] = 1
+        pipe.hset("lb:s:%s" % sid, "state", json.dumps(state))
+        pipe.lpush("lb:s:%s:h" % sid, '%d:1' % now)
+        pipe.ltrim("lb:s:%s:h" % sid, 0, lovebeat.MAX_SAVED - 1)
+        if not conf_present:
+            pipe.hset("lb:s:%s" % sid, "conf", json.dumps(conf))
+    db.transaction(trans, "lb:s:%s" % sid)
+
+
+def script_trigger(db, sid, now, stats):
+    stats['attempts'] += 1
+    lovebeat.trigger_script(db, sid, now, set(), None, None)
+
+
+def run(trigger, writers, count):
+    lovebeat.conn().flushdb()
+    stats = [{'attempts': 0} for _ in range(writers)]
+
+    def writer(n):
+        db = lovebeat.conn()
+        for i in xrange(count):
+            trigger(db, SID, int(time.time()), stats[n])
+
+    threads = [threading.Thread(target=writer, args=(n,))
+               for n in range(writers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    attempts = sum(s['attempts'] for s in stats)
+    return writers * count / elapsed, attempts - writers * count
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=16379)
+    parser.add_option('--writers', default='1,4,16,64')
+    parser.add_option('--count', type='int', default=500,
+                      help='triggers per writer')
+    opts, args = parser.parse_args()
+
+    lovebeat.use_test_db(opts.port)
+    print '%8s %16s %10s %16s' % ('writers', 'watch/multi', 'retries',
+                                  'script')
+    for writers in [int(w) for w in opts.writers.split(',')]:
+        tx_rate, retries = run(watch_multi_trigger, writers, opts.count)
+        script_rate, _ = run(script_trigger, writers, opts.count)
+        print '%8d %14.0f/s %10d %14.0f/s' % (writers, tx_rate, retries,
+                                              script_rate)
+
+
+if __name__ == '__main__':
+    main()
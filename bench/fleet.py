@@ -0,0 +1,220 @@
+"""Measures lovebeat on synthetic fleets of services.
+
+Creates fleets of services with a varied number of labels and heartbeat
+intervals, of which some have stopped reporting, and drives storms of
+heartbeats, dashboard polls and agent alert polls against each of them. For
+every fleet and workload it reports the throughput, the median and 99th
+percentile latency and the redis commands per request, and the memory used
+by redis and by lovebeat. Runs against the test redis instance, which is
+flushed.
+
+The fleets and the requests are generated from a seed, so runs are
+comparable. Results are written as JSON, and can be compared with an
+earlier run, e.g. of another commit:
+
+    $ redis-server test/redis-test.conf
+    $ python bench/fleet.py --fleets 1000,10000,100000 --output base.json
+    $ git checkout my-branch
+    $ python bench/fleet.py --fleets 1000,10000,100000 --compare base.json
+"""
+import json
+import optparse
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from werkzeug.datastructures import MultiDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import lovebeat
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+INTERVALS = (30, 60, 300, 3600)
+NOW = 1400000000
+
+
+def make_fleet(rng, services, labels, fanout):
+    """ Return (sid, labels, warning, error) of every service. A service
+        has up to `fanout` labels, picked so that a few labels are much more
+        common than the rest.
+    """
+    names = ['label%d' % i for i in xrange(labels)]
+    fleet = []
+    for i in xrange(services):
+        lbls = set(names[min(int(rng.expovariate(4.0 / labels)), labels - 1)]
+                   for n in xrange(rng.randint(0, fanout)))
+        interval = rng.choice(INTERVALS)
+        fleet.append(('bench.%d' % i, sorted(lbls), interval, interval * 2))
+    return names, fleet
+
+
+def populate(client, rng, names, fleet, failing):
+    """ Report every service once, after which `failing` of them stop
+        reporting and the rest report again, much later.
+    """
+    for lbl in names[:len(names) / 2]:
+        client.post('/l/%s' % lbl, data={'alert': 'error:email:%s@x' % lbl})
+    stopped = set(rng.sample(xrange(len(fleet)), int(len(fleet) * failing)))
+    for ts, items in ((NOW - 2 * max(INTERVALS), fleet),
+                      (NOW, [s for i, s in enumerate(fleet)
+                             if i not in stopped])):
+        lovebeat.app.config['TESTING_TS'] = ts
+        with lovebeat.app.test_request_context():
+            lovebeat.app.preprocess_request()
+            lovebeat.do_trigger_many([(sid, lbls, whb, ehb, None, None)
+                                      for sid, lbls, whb, ehb in items])
+    with lovebeat.app.test_request_context():
+        lovebeat.app.preprocess_request()
+        lovebeat.evaluate(NOW)
+
+
+def trigger_storm(rng, names, fleet, requests):
+    for i in xrange(requests):
+        sid, lbls, whb, ehb = rng.choice(fleet)
+        yield 'POST', '/s/%s' % sid, MultiDict([
+            ('labels', ','.join(lbls)),
+            ('heartbeat', 'warning:%d' % whb),
+            ('heartbeat', 'error:%d' % ehb)])
+
+
+def dashboard_polls(rng, names, fleet, requests):
+    for i in xrange(requests):
+        lbl = rng.choice(names + ['all'])
+        yield 'GET', '/dashboard/%s/json' % lbl, None
+
+
+def alert_polls(rng, names, fleet, requests):
+    for i in xrange(requests):
+        yield 'GET', '/agent/bench%d/alerts.txt' % (i % 4), None
+
+
+WORKLOADS = (('triggers', trigger_storm, 'triggers'),
+             ('dashboards', dashboard_polls, 'polls'),
+             ('alerts', alert_polls, 'polls'))
+
+
+def commands(db):
+    # the INFO itself is counted as well
+    return db.info()['total_commands_processed'] + 1
+
+
+def percentile(latencies, p):
+    return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+
+def run(client, db, requests):
+    latencies = []
+    before = commands(db)
+    started = time.time()
+    for method, path, data in requests:
+        start = time.time()
+        rv = client.open(path, method=method, data=data)
+        rv.data
+        if rv.status_code != 200:
+            raise SystemExit("%s %s: %s" % (method, path, rv.status))
+        latencies.append(time.time() - start)
+    elapsed = time.time() - started
+    ops = db.info()['total_commands_processed'] - before
+    latencies.sort()
+    return {'requests': len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'redis_ops': float(ops) / len(latencies)}
+
+
+def bench_fleet(size, opts):
+    rng = random.Random('%s:%d' % (opts.seed, size))
+    lovebeat.use_test_db(opts.port)
+    db = lovebeat.conn()
+    client = lovebeat.app.test_client()
+    names, fleet = make_fleet(rng, size, opts.labels, opts.fanout)
+    populate(client, rng, names, fleet, opts.failing)
+    lovebeat.app.config['TESTING_TS'] = NOW
+    memory = {'redis_memory': db.info()['used_memory'],
+              'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    results = []
+    for name, workload, count in WORKLOADS:
+        reqs = workload(rng, names, fleet, getattr(opts, count))
+        result = run(client, db, reqs)
+        result.update(memory, fleet=size, workload=name)
+        results.append(result)
+    return results
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+                                        'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path) as f:
+        old = json.load(f)
+    base = dict(((r['fleet'], r['workload']), r) for r in old['results'])
+    print
+    print 'compared with %s (%s):' % (path, old.get('revision'))
+    print '%-8s %-12s %12s %10s %10s %10s' % ('fleet', 'workload',
+                                              'throughput', 'p50', 'p99',
+                                              'ops/req')
+    for r in results:
+        b = base.get((r['fleet'], r['workload']))
+        if b is None:
+            continue
+        print '%-8d %-12s %+11.1f%% %+9.1f%% %+9.1f%% %+10.1f' % (
+            r['fleet'], r['workload'],
+            (r['throughput'] / b['throughput'] - 1) * 100,
+            (r['p50_ms'] / b['p50_ms'] - 1) * 100,
+            (r['p99_ms'] / b['p99_ms'] - 1) * 100,
+            r['redis_ops'] - b['redis_ops'])
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=16379)
+    parser.add_option('--fleets', default='1000,10000',
+                      help='comma separated numbers of services')
+    parser.add_option('--labels', type='int', default=50)
+    parser.add_option('--fanout', type='int', default=4,
+                      help='most labels of a service')
+    parser.add_option('--failing', type='float', default=0.02,
+                      help='share of services that stop reporting')
+    parser.add_option('--triggers', type='int', default=2000)
+    parser.add_option('--polls', type='int', default=20,
+                      help='dashboard and alert requests')
+    parser.add_option('--seed', default='lovebeat')
+    parser.add_option('--output', help='write the results as JSON')
+    parser.add_option('--compare', help='JSON results of an earlier run')
+    opts, args = parser.parse_args()
+
+    lovebeat.app.config['TESTING'] = True
+    results = []
+    print '%-8s %-12s %12s %10s %10s %8s %10s %10s' % (
+        'fleet', 'workload', 'throughput', 'p50', 'p99', 'ops/req',
+        'redis', 'rss')
+    for size in [int(n) for n in opts.fleets.split(',')]:
+        for r in bench_fleet(size, opts):
+            print '%-8d %-12s %10.0f/s %8.2fms %8.2fms %8.1f %8.1fMB ' \
+                  '%8.1fMB' % (r['fleet'], r['workload'], r['throughput'],
+                               r['p50_ms'], r['p99_ms'], r['redis_ops'],
+                               r['redis_memory'] / 1048576.0,
+                               r['rss'] / 1024.0)
+            results.append(r)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({'revision': revision(), 'time': int(time.time()),
+                       'python': platform.python_version(),
+                       'options': vars(opts), 'results': results},
+                      f, indent=2, sort_keys=True)
+    if opts.compare:
+        compare(results, opts.compare)
+
+
+if __name__ == '__main__':
+    main()
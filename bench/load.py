@@ -0,0 +1,101 @@
+"""Compares heartbeat ingestion between the threaded and the gevent server.
+
+Starts each server against the test redis instance (which is flushed) and
+posts heartbeats for many services from many concurrent clients. Requires
+gevent, which is also used for the clients.
+
+    $ redis-server test/redis-test.conf
+    $ python bench/load.py --clients 200 --requests 10000
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import httplib
+import optparse
+import os
+import subprocess
+import sys
+import time
+import urllib
+
+from gevent.pool import Pool
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SERVERS = {
+    'threaded': "import lovebeat; lovebeat.use_test_db(%(redis)d); "
+                "lovebeat.app.run(port=%(port)d, threaded=True)",
+    'gevent': "import lovebeat_gevent, lovebeat; "
+              "lovebeat.use_test_db(%(redis)d); "
+              "lovebeat_gevent.serve('127.0.0.1', %(port)d, 10000)",
+}
+
+
+def start(mode, port, redis_port):
+    code = SERVERS[mode] % {'port': port, 'redis': redis_port}
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT,
+                            stdout=devnull, stderr=devnull)
+    for i in range(100):
+        try:
+            httplib.HTTPConnection('127.0.0.1', port).request('GET', '/s/up')
+            return proc
+        except IOError:
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit("%s server didn't start" % mode)
+
+
+def post(port, sid, latencies, errors):
+    body = urllib.urlencode({'heartbeat': 'error:60', 'labels': 'bench'})
+    start = time.time()
+    try:
+        c = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        c.request('POST', '/s/%s' % sid, body,
+                  {'Content-Type': 'application/x-www-form-urlencoded'})
+        if c.getresponse().status != 200:
+            errors.append(sid)
+        c.close()
+    except IOError:
+        errors.append(sid)
+    latencies.append(time.time() - start)
+
+
+def run(mode, opts):
+    proc = start(mode, opts.port, opts.redis_port)
+    try:
+        latencies, errors = [], []
+        pool = Pool(opts.clients)
+        started = time.time()
+        for i in xrange(opts.requests):
+            pool.spawn(post, opts.port, 'bench.%d' % (i % opts.services),
+                       latencies, errors)
+        pool.join()
+        elapsed = time.time() - started
+    finally:
+        proc.kill()
+        proc.wait()
+    latencies.sort()
+    p50 = latencies[len(latencies) / 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print '%-10s %10.0f/s %8.1fms %8.1fms %8d' % (
+        mode, opts.requests / elapsed, p50 * 1000, p99 * 1000, len(errors))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=18001)
+    parser.add_option('--redis-port', type='int', default=16379)
+    parser.add_option('--clients', type='int', default=200)
+    parser.add_option('--requests', type='int', default=10000)
+    parser.add_option('--services', type='int', default=2000)
+    parser.add_option('--modes', default='threaded,gevent')
+    opts, args = parser.parse_args()
+
+    print '%-10s %12s %10s %10s %8s' % ('server', 'throughput', 'p50',
+                                        'p99', 'errors')
+    for mode in opts.modes.split(','):
+        run(mode, opts)
+
+
+if __name__ == '__main__':
+    main()
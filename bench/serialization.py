@@ -0,0 +1,69 @@
+"""Compares the cost of storing service records as JSON and as msgpack.
+
+Measures encoding and decoding time of a typical config and state, and the
+redis memory used per service after triggering many of them. Runs against
+the test redis instance, which is flushed.
+
+    $ redis-server test/redis-test.conf
+    $ python bench/serialization.py --services 10000
+"""
+import optparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import lovebeat
+
+CONF = {'heartbeat': {'warning': 60, 'error': 300},
+        'labels': ['prod', 'eu', 'db']}
+STATE = {'last': {'ts': 1364774400, 'val': 1}, 'status': 'ok',
+         'alert': {'status': 'error', 'id': 17, 'state': 'confirmed',
+                   'ts': 1364770000, 'confirmed': {'agent': 'bond'}}}
+
+
+def codec_cost(fmt, n):
+    lovebeat.app.config['SERIALIZER'] = fmt
+    conf = lovebeat.pack(CONF)
+    state = lovebeat.pack(STATE)
+    encode = timeit.timeit(lambda: (lovebeat.pack(CONF),
+                                    lovebeat.pack(STATE)), number=n)
+    decode = timeit.timeit(lambda: (lovebeat.unpack_config(conf),
+                                    lovebeat.unpack(state)), number=n)
+    return len(conf) + len(state), encode / n * 1e6, decode / n * 1e6
+
+
+def memory_per_service(fmt, services):
+    lovebeat.app.config['SERIALIZER'] = fmt
+    r = lovebeat.conn()
+    r.flushdb()
+    with lovebeat.app.test_request_context():
+        lovebeat.app.preprocess_request()
+        lovebeat.do_trigger_many([('bench.%d' % i, CONF['labels'], 60, 300,
+                                   None, None)
+                                  for i in xrange(services)])
+    sample = min(services, 1000)
+    total = sum(r.execute_command('MEMORY', 'USAGE', 'lb:s:bench.%d' % i)
+                for i in xrange(sample))
+    return float(total) / sample
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=16379)
+    parser.add_option('--services', type='int', default=10000)
+    parser.add_option('--iterations', type='int', default=100000)
+    opts, args = parser.parse_args()
+
+    lovebeat.use_test_db(opts.port)
+    print '%-8s %8s %12s %12s %16s' % ('format', 'bytes', 'encode', 'decode',
+                                       'redis/service')
+    for fmt in ('json', 'msgpack'):
+        size, encode, decode = codec_cost(fmt, opts.iterations)
+        memory = memory_per_service(fmt, opts.services)
+        print '%-8s %8d %10.2fus %10.2fus %14.0f B' % (fmt, size, encode,
+                                                       decode, memory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Compares the redis and the memory storage engines.
+
+Times single and batched triggers, and reading the dashboards of a fleet of
+services, with each engine. The memory engine is measured with and without
+writing its log. Runs against the test redis instance, which is flushed.
+
+    $ redis-server test/redis-test.conf
+    $ python bench/storage.py --services 10000
+"""
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import lovebeat
+
+LABELS = ['prod', 'eu', 'db', 'web']
+
+
+def timed(func, *args):
+    started = time.time()
+    func(*args)
+    return time.time() - started
+
+
+def triggers(services):
+    for i in xrange(services):
+        lovebeat.do_trigger('bench.%d' % i, [LABELS[i % len(LABELS)]])
+
+
+def batch(services):
+    lovebeat.do_trigger_many([('bench.%d' % i, [LABELS[i % len(LABELS)]],
+                               None, None, None, None)
+                              for i in xrange(services)])
+
+
+def dashboards(client, reads):
+    for i in xrange(reads):
+        client.get('/dashboard/all/json')
+        client.get('/dashboard/%s/list?limit=1000' % LABELS[i % len(LABELS)])
+
+
+def run(storage, log, opts):
+    lovebeat.app.config['STORAGE'] = storage
+    lovebeat.app.config['MEMORY_LOG'] = log
+    lovebeat.memory_store = None
+    lovebeat.use_test_db(opts.port)
+    client = lovebeat.app.test_client()
+    with lovebeat.app.test_request_context():
+        lovebeat.app.preprocess_request()
+        single = timed(triggers, opts.services)
+        batched = timed(batch, opts.services)
+    read = timed(dashboards, client, opts.reads)
+    return (opts.services / single, opts.services / batched,
+            read / opts.reads / 2 * 1000)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=16379)
+    parser.add_option('--services', type='int', default=10000)
+    parser.add_option('--reads', type='int', default=20,
+                      help='dashboard requests of each kind')
+    opts, args = parser.parse_args()
+
+    lovebeat.app.config['TESTING'] = True
+    lovebeat.app.config['TESTING_TS'] = int(time.time())
+    tmp = tempfile.mkdtemp()
+    try:
+        print '%-12s %14s %14s %14s' % ('engine', 'triggers/s', 'batched/s',
+                                        'dashboard')
+        for name, storage, log in (
+                ('redis', 'redis', None),
+                ('memory', 'memory', None),
+                ('memory+log', 'memory', os.path.join(tmp, 'lovebeat.log'))):
+            single, batched, read = run(storage, log, opts)
+            print '%-12s %14.0f %14.0f %11.1f ms' % (name, single, batched,
+                                                     read)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Measures how long it takes to evaluate windowed value thresholds.
+
+Creates services that report a value every 10 seconds with thresholds on
+the average or the 95th percentile of the last five minutes, of which one in
+a hundred are failing, and times evaluating all of them. Runs against the
+test redis instance, which is flushed.
+
+    $ redis-server test/redis-test.conf
+    $ python bench/thresholds.py --services 50000
+"""
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import lovebeat
+
+AGGREGATES = ('avg', 'p95')
+
+
+def populate(services, samples, now):
+    with lovebeat.app.test_request_context():
+        lovebeat.app.preprocess_request()
+        for i in xrange(samples):
+            ts = now - (samples - i) * 10
+            lovebeat.app.config['TESTING_TS'] = ts
+            items = []
+            for n in xrange(services):
+                mean = 90 if n % 100 == 0 else 40
+                threshold = None
+                if i == 0:
+                    threshold = {'warning': 80, 'error': 95, 'window': 300,
+                                 'aggregate': AGGREGATES[n % len(AGGREGATES)]}
+                items.append(('bench.%d' % n, [], None, 3600,
+                              random.gauss(mean, 10), threshold))
+            lovebeat.do_trigger_many(items)
+
+
+def tick(now):
+    lovebeat.app.config['TESTING_TS'] = now
+    started = time.time()
+    lovebeat.evaluator_tick(
+        lambda now: lovebeat.evaluate_thresholds(lovebeat.conn(), now))
+    return time.time() - started
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=16379)
+    parser.add_option('--services', type='int', default=50000)
+    parser.add_option('--samples', type='int', default=30,
+                      help='values reported per service')
+    parser.add_option('--fallback', action='store_true',
+                      help="don't use numpy")
+    opts, args = parser.parse_args()
+
+    if opts.fallback:
+        lovebeat.numpy = None
+    lovebeat.use_test_db(opts.port)
+    lovebeat.app.config['TESTING'] = True
+    now = int(time.time())
+    populate(opts.services, opts.samples, now)
+    # the first tick sets the status of most services
+    print 'first tick: %6.3f s' % tick(now)
+    # an evaluator's next tick
+    interval = lovebeat.app.config['EVAL_INTERVAL']
+    print 'next tick:  %6.3f s' % tick(now + interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,148 @@
+import atexit
+import base64
+import bisect
+import contextlib
 import copy
+import functools
+import hashlib
+import itertools
 import json
 import logging
+import math
+import operator
+import os
+import Queue
+import random
+import signal
+import socket
+import struct
 import sys
+import threading
 import time
+import urlparse
+from thread import get_ident
 
 from flask import Flask, g, render_template, request, make_response, jsonify
-from flask import redirect, url_for, Response, stream_with_context
+from flask import redirect, url_for, Response, stream_with_context, abort
+from flask import has_request_context
 import redis
+import lovebeat_memory
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 sys.stdout = sys.stderr
 MAX_SAVED = 100
+BATCH_SIZE = 500
+THRESHOLD_BATCH_SIZE = 2000
+PAGE_SIZE = 100
+# seconds between keepalives of event streams, and the number of events that
+# may be waiting to be sent before a (slow) stream is ended.
+EVENTS_KEEPALIVE = 15
+MAX_QUEUED_EVENTS = 10000
+# the number of alerts kept in the feed of the agents, and the longest time
+# to wait for one, in seconds.
+MAX_QUEUED_ALERTS = 10000
+MAX_FEED_WAIT = 300
+# the number of label sets whose alert recipients are remembered
+MAX_ROUTES = 10000
+# the number of rendered dashboards that are kept, see RESPONSE_CACHE
+MAX_CACHED_RESPONSES = 1000
+# points per shard on the hash ring, see Ring, and the longest time to wait
+# for another shard when moving a service to it, in milliseconds.
+RING_REPLICAS = 100
+MIGRATE_TIMEOUT = 5000
+MAX_PAGE_SIZE = 1000
+# upper bounds of the buckets of the request latency histograms, in ms
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                   10000)
+STATUSES = ('ok', 'warning', 'error', 'maint')
+# (resolution, bucket span, retention) of the stored values, in seconds. A
+# resolution of 0 means that the raw samples are kept.
+SERIES_TIERS = ((0, 3600, 6 * 3600),
+                (60, 86400, 7 * 86400),
+                (3600, 30 * 86400, 180 * 86400))
+# aggregates of the values reported within a window that thresholds can be
+# set on. 'pNN' is the NNth percentile.
+AGGREGATES = ('last', 'avg', 'min', 'max', 'p50', 'p90', 'p95', 'p99')
+DEFAULT_THRESHOLD = {'warning': None, 'error': None, 'aggregate': 'last',
+                     'window': 300}
 DEFAULT_CONF = {'heartbeat': {'warning': 10, 'error': 20}, 'labels': []}
 app = Flask(__name__)
-pool = redis.ConnectionPool(host='localhost', port=6379, db=0)
+app.config.update(
+    # evaluate status and alerts when serving dashboards and alerts, as
+    # opposed to having a separate evaluator process doing it.
+    INLINE_EVAL=True,
+    EVAL_INTERVAL=1,
+    # write repeated triggers of a service at most once per this many
+    # seconds. Disabled when 0.
+    COALESCE_WINDOW=0,
+    # how service configs and states are stored; 'json' or 'msgpack'.
+    # Records in either format can be read regardless of this setting.
+    SERIALIZER='json',
+    # seconds after which an alert that has been claimed or read from the
+    # feed, but not confirmed, is handed to another agent.
+    CLAIM_TIMEOUT=300,
+    # redis URLs of the instances storing the services, which are spread
+    # over them by their ids. When empty, they are stored with the labels.
+    SHARDS=[],
+    # the SHARDS before some were added or removed, until all services
+    # have been moved to their new shards. See rebalance.
+    PREVIOUS_SHARDS=[],
+    # where to store everything; 'redis', or 'memory' to keep it in this
+    # process, see lovebeat_memory. Writes to the memory store are logged to
+    # MEMORY_LOG, if set, and read back when starting.
+    STORAGE='redis',
+    MEMORY_LOG=None,
+    # seconds that the output of /metrics is reused for. Disabled when 0.
+    METRICS_CACHE=0,
+    # time one in this many requests for /stats. Disabled when 0.
+    STATS_SAMPLE=10,
+    # seconds that the rendered dashboards of a label are reused for while
+    # the label doesn't change, see cached. Disabled when 0.
+    RESPONSE_CACHE=0,
+    # the redis server; redis://[:password@]host[:port][/db], or
+    # unix://[:password@]/path/to/socket[?db=db]. The same settings are used
+    # for the SHARDS and the REDIS_REPLICAS.
+    REDIS_URL='redis://localhost:6379/0',
+    # the most connections to each server per process, or None for no
+    # limit. When they are all in use, a request fails, or waits up to
+    # REDIS_POOL_TIMEOUT seconds for one with REDIS_POOL_BLOCK.
+    REDIS_MAX_CONNECTIONS=None,
+    REDIS_POOL_BLOCK=False,
+    REDIS_POOL_TIMEOUT=20,
+    # seconds to wait for connecting to a server, and for its replies, or
+    # None to wait forever. Event streams and waiting for the alert feed
+    # have no reply timeout.
+    REDIS_CONNECT_TIMEOUT=None,
+    REDIS_SOCKET_TIMEOUT=None,
+    # redis URLs of replicas of REDIS_URL that the dashboards and labels are
+    # read from. Not used with SHARDS.
+    REDIS_REPLICAS=[],
+)
+app.config.from_envvar('LOVEBEAT_SETTINGS', silent=True)
+pool = None
+replica_pools = {}
+untimed_conns = {}
+scripts = {}
+coalescer = None
+thresholds = {}
+# when the thresholds on windows were last evaluated, per server
+thresholds_evaluated = {}
+routing = None
+rings = {}
+shard_conns = {}
+memory_store = None
+# (time, output) of the last /metrics, see METRICS_CACHE
+metrics_cache = None
+metrics_lock = threading.Lock()
+# (view, label) -> (version, expiry, data, headers), see RESPONSE_CACHE
+response_cache = {}
 
 
 def get_ts():
@@ -21,33 +151,395 @@ def get_ts():
     return int(time.time())
 
 
-def rvtrans(db, func, *watches, **kwargs):
-    shard_hint = kwargs.pop('shard_hint', None)
-    rv = None
-    with g.db.pipeline(True, shard_hint) as pipe:
+class Instruments(object):
+    """ Counters and timings of the requests served by this process, see
+        /stats. The counters are spread over a fixed number of slots, picked
+        by thread, so that threads seldom wait for each other's locks, and
+        summed when they are read.
+    """
+    # a prime, as the ids of threads and greenlets are aligned addresses
+    SLOTS = 31
+
+    def __init__(self):
+        self.local = threading.local()
+        self.requests = itertools.count(1)
+        self.slots = [(threading.Lock(), {}) for i in xrange(self.SLOTS)]
+
+    def add(self, key, n=1):
+        lock, counters = self.slots[get_ident() % self.SLOTS]
+        with lock:
+            counters[key] = counters.get(key, 0) + n
+
+    def round_trip(self):
+        self.local.round_trips = getattr(self.local, 'round_trips', 0) + 1
+
+    def sampled(self):
+        return getattr(self.local, 'started', None) is not None
+
+    def start_request(self):
+        self.local.round_trips = 0
+        self.local.started = None
+        rate = app.config['STATS_SAMPLE']
+        # counted across threads, as greenlets only serve a single request
+        if rate and next(self.requests) % rate == 0:
+            self.local.started = time.time()
+
+    def end_request(self, route):
+        self.add(('requests', route))
+        self.add(('round_trips', route), self.local.round_trips)
+        if self.sampled():
+            ms = (time.time() - self.local.started) * 1000
+            self.local.started = None
+            bucket = bisect.bisect_left(LATENCY_BUCKETS, ms)
+            self.add(('latency', route, bucket))
+            self.add(('latency_ms', route), ms)
+
+    def read(self):
+        """ Return the sums of the counters of all threads. """
+        total = {}
+        for lock, counters in self.slots:
+            with lock:
+                for key, value in counters.items():
+                    total[key] = total.get(key, 0) + value
+        return total
+
+
+instruments = Instruments()
+
+
+@contextlib.contextmanager
+def timing(name):
+    """ Add the time spent within the block to the timer `name` in /stats,
+        if the request is sampled.
+    """
+    if not instruments.sampled():
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        instruments.add(('calls', name))
+        instruments.add(('time_ms', name), (time.time() - started) * 1000)
+
+
+def timed(name):
+    """ Decorate a function to time it, see timing. """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timing(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def transaction(db, func, *watches):
+    """ Like db.transaction, but counts the retries in /stats. """
+    with db.pipeline(True) as pipe:
         while 1:
             try:
-                if watches:
-                    pipe.watch(*watches)
-                rv = func(pipe)
-                pipe.execute()
-                return rv
+                pipe.watch(*watches)
+                func(pipe)
+                return pipe.execute()
             except redis.WatchError:
-                continue
+                instruments.add(('retries', 'transaction'))
+
+
+def load_script(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'lua', name)
+    with open(path) as f:
+        return f.read()
+
+
+def script(name):
+    """ Return the server-side script `name`, registering it on first use.
+    """
+    if name not in scripts:
+        scripts[name] = conn().register_script(load_script(name))
+    return scripts[name]
+
+
+def run_script(name, client, keys, args):
+    """ Run the server-side script `name` using `client`, which may be a
+        pipeline or a shard that the script hasn't been loaded on.
+    """
+    s = script(name)
+    try:
+        return s(keys=keys, args=args, client=client)
+    except redis.ResponseError as e:
+        # not raised as a NoScriptError when using hiredis
+        if not str(e).startswith('NOSCRIPT'):
+            raise
+        client.script_load(s.script)
+        return s(keys=keys, args=args, client=client)
+
+
+class Connection(redis.Connection):
+    """ A connection with a timeout for connecting of its own, which
+        counts its round trips, see Instruments.
+    """
+    def __init__(self, connect_timeout=None, **kwargs):
+        self.connect_timeout = connect_timeout
+        super(Connection, self).__init__(**kwargs)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port),
+                                        self.connect_timeout)
+        sock.settimeout(self.socket_timeout)
+        return sock
+
+    def send_packed_command(self, command):
+        instruments.round_trip()
+        super(Connection, self).send_packed_command(command)
+
+
+class UnixConnection(redis.UnixDomainSocketConnection):
+    def send_packed_command(self, command):
+        instruments.round_trip()
+        super(UnixConnection, self).send_packed_command(command)
+
+
+class BlockingConnectionPool(redis.ConnectionPool):
+    """ A pool that waits up to `timeout` seconds for a connection when
+        max_connections are in use, instead of failing right away.
+    """
+    def __init__(self, connection_class=Connection, max_connections=None,
+                 timeout=20, **connection_kwargs):
+        self.timeout = timeout
+        self.released = threading.Condition()
+        super(BlockingConnectionPool, self).__init__(
+            connection_class, max_connections, **connection_kwargs)
+
+    def _checkpid(self):
+        # the pool is reset after forking
+        timeout = self.timeout
+        super(BlockingConnectionPool, self)._checkpid()
+        self.timeout = timeout
+
+    def get_connection(self, command_name, *keys, **options):
+        deadline = time.time() + self.timeout
+        with self.released:
+            self._checkpid()
+            while not self._available_connections and \
+                    self._created_connections >= self.max_connections:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise redis.ConnectionError("No connection available")
+                self.released.wait(remaining)
+            return super(BlockingConnectionPool, self).get_connection(
+                command_name, *keys, **options)
+
+    def release(self, connection):
+        with self.released:
+            super(BlockingConnectionPool, self).release(connection)
+            self.released.notify()
+
+
+def make_pool(url, **overrides):
+    """ Return a connection pool for the redis server at `url` using the
+        REDIS_* settings, see REDIS_URL.
+    """
+    parts = urlparse.urlparse(url)
+    query = urlparse.parse_qs(parts.query)
+    kwargs = {'password': parts.password,
+              'socket_timeout': app.config['REDIS_SOCKET_TIMEOUT']}
+    if parts.scheme == 'unix':
+        kwargs.update(connection_class=UnixConnection,
+                      path=parts.path, db=int(query.get('db', ['0'])[0]))
+    else:
+        kwargs.update(connection_class=Connection,
+                      host=parts.hostname or 'localhost',
+                      port=parts.port or 6379,
+                      db=int(parts.path.strip('/') or 0),
+                      connect_timeout=app.config['REDIS_CONNECT_TIMEOUT'])
+    kwargs['max_connections'] = app.config['REDIS_MAX_CONNECTIONS']
+    kwargs.update(overrides)
+    if app.config['REDIS_POOL_BLOCK']:
+        return BlockingConnectionPool(
+            timeout=app.config['REDIS_POOL_TIMEOUT'], **kwargs)
+    return redis.ConnectionPool(**kwargs)
 
 
 def use_test_db(port):
-    global pool
-    pool = redis.ConnectionPool(host='localhost', port=port, db=0)
+    global pool, routing
+    pool = make_pool('redis://localhost:%d/0' % port)
+    # the memory store is flushed below
+    thresholds.clear()
+    thresholds_evaluated.clear()
+    routing = None
     r = conn()
     r.flushdb()
 
 
 def conn():
+    global memory_store
+    if app.config['STORAGE'] == 'memory':
+        if memory_store is None:
+            memory_store = lovebeat_memory.MemoryStore(
+                app.config['MEMORY_LOG'])
+            # logs written by previous versions
+            upgrade_label_index(memory_store)
+        return memory_store
+    global pool
+    if pool is None:
+        pool = make_pool(app.config['REDIS_URL'])
     r = redis.StrictRedis(connection_pool=pool)
     return r
 
 
+def read_conn():
+    """ Return a connection for reads that may lag slightly behind the
+        writes, to one of the REDIS_REPLICAS if there are any.
+    """
+    urls = app.config['REDIS_REPLICAS']
+    if not urls or app.config['STORAGE'] == 'memory':
+        return conn()
+    # a request reads from a single replica, so that its reads are
+    # consistent with each other; see label_version
+    url = getattr(g, 'replica', None) if has_request_context() else None
+    if url not in urls:
+        url = random.choice(urls)
+        if has_request_context():
+            g.replica = url
+    if url not in replica_pools:
+        replica_pools[url] = make_pool(url)
+    return redis.StrictRedis(connection_pool=replica_pools[url])
+
+
+def untimed(db):
+    """ Return a client like `db` without REDIS_SOCKET_TIMEOUT, for
+        subscribing and blocking reads.
+    """
+    kwargs = getattr(db.connection_pool, 'connection_kwargs', {})
+    if kwargs.get('socket_timeout') is None:
+        return db
+    # they have a pool of their own, as they hold on to their connections
+    key = id(db.connection_pool)
+    if key not in untimed_conns:
+        untimed_conns[key] = redis.StrictRedis(
+            connection_pool=redis.ConnectionPool(
+                db.connection_pool.connection_class,
+                **dict(kwargs, socket_timeout=None)))
+    return untimed_conns[key]
+
+
+class Ring(object):
+    """ Maps service ids to shards by consistent hashing, so that adding or
+        removing a shard only moves the services to or from that shard.
+        Shards must be reached over TCP, as services are moved between them
+        by MIGRATE.
+    """
+    def __init__(self, urls):
+        for url in urls:
+            if urlparse.urlparse(url).scheme == 'unix':
+                raise ValueError("shards can't use unix sockets: %s" % url)
+        points = sorted((ring_hash("%s#%d" % (url, i)), url)
+                        for url in urls for i in xrange(RING_REPLICAS))
+        self.hashes = [h for h, url in points]
+        self.urls = [url for h, url in points]
+
+    def owner(self, sid):
+        i = bisect.bisect(self.hashes, ring_hash(sid))
+        return self.urls[i % len(self.urls)]
+
+
+def ring_hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+
+def get_ring(urls):
+    urls = tuple(urls)
+    if urls not in rings:
+        rings[urls] = Ring(urls)
+    return rings[urls]
+
+
+def shard_conn(url):
+    if url not in shard_conns:
+        shard_conns[url] = redis.StrictRedis(connection_pool=make_pool(url))
+    return shard_conns[url]
+
+
+def all_shards():
+    """ Return connections to all redis instances that may store services,
+        including those that services are being moved from.
+    """
+    urls = app.config['SHARDS']
+    if not urls:
+        return [conn()]
+    urls = urls + [url for url in app.config['PREVIOUS_SHARDS']
+                   if url not in urls]
+    return [shard_conn(url) for url in urls]
+
+
+def read_shards():
+    """ Like all_shards, but for reads that may lag slightly behind the
+        writes, see read_conn.
+    """
+    if not app.config['SHARDS']:
+        return [read_conn()]
+    return all_shards()
+
+
+def shard(sid):
+    """ Return a connection to the redis instance storing a service. While
+        rebalancing, the service is moved there first if it hasn't been.
+    """
+    urls = app.config['SHARDS']
+    if not urls:
+        return conn()
+    url = get_ring(urls).owner(sid)
+    if app.config['PREVIOUS_SHARDS']:
+        old = get_ring(app.config['PREVIOUS_SHARDS']).owner(sid)
+        if old != url:
+            move_service(sid, shard_conn(old), shard_conn(url), get_ts())
+    return shard_conn(url)
+
+
+def group_by_shard(items, key=lambda sid: sid):
+    """ Group items by the shard storing the service `key(item)`, keeping
+        their order. Returns (connection, items) pairs.
+    """
+    dbs = {}
+    groups = {}
+    for item in items:
+        sid = key(item)
+        if sid not in dbs:
+            dbs[sid] = shard(sid)
+        db = dbs[sid]
+        groups.setdefault(id(db.connection_pool), (db, []))[1].append(item)
+    return groups.values()
+
+
+def fan_out(func, args):
+    """ Return [func(arg) for arg in args], calling func in a thread per
+        arg if there are several, such as one per shard.
+    """
+    if len(args) == 1:
+        return [func(args[0])]
+    results = [None] * len(args)
+    errors = []
+
+    def run(i, arg):
+        try:
+            results[i] = func(arg)
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=run, args=(i, arg))
+               for i, arg in enumerate(args)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
 def chunks(l, n):
     """ Yield successive n-sized chunks from l.
     """
@@ -57,39 +549,186 @@ def chunks(l, n):
 
 @app.before_request
 def before_request():
+    instruments.start_request()
     g.db = conn()
 
 
-def load_service_config(pipe, sid):
-    conf = pipe.hget("lb:s:%s" % sid, "conf")
+@app.teardown_request
+def teardown_request(exc):
+    # when streaming, after the last chunk has been sent
+    rule = request.url_rule.rule if request.url_rule else None
+    instruments.end_request('%s %s' % (request.method, rule))
+
+
+def pack(obj):
+    """ Encode a service config or state using the configured SERIALIZER.
+    """
+    if app.config['SERIALIZER'] == 'msgpack':
+        return msgpack.packb(obj, use_bin_type=False)
+    return json.dumps(obj)
+
+
+def unpack(data):
+    """ Decode a service config or state stored in any of the formats.
+    """
+    if data[:1] == '{':
+        return json.loads(data)
+    return msgpack.unpackb(data, raw=False)
+
+
+def unpack_config(data):
+    conf = unpack(data)
+    # msgpack can't store null values in maps
+    conf['heartbeat'].setdefault('warning', None)
+    conf['heartbeat'].setdefault('error', None)
+    conf.setdefault('labels', [])
+    if 'threshold' in conf:
+        conf['threshold'].setdefault('warning', None)
+        conf['threshold'].setdefault('error', None)
+    return conf
+
+
+def decode_config(conf):
     if not conf:
         return False, copy.deepcopy(DEFAULT_CONF)
-    return True, json.loads(conf)
+    return True, unpack_config(conf)
 
 
-def load_service_state(pipe, sid):
-    state = pipe.hget("lb:s:%s" % sid, "state")
+def decode_state(state):
     if not state:
         alert = {'status': 'ok', 'id': 0, 'state': 'confirmed'}
         return {'last': {}, 'status': 'ok', 'alert': alert}
-    return json.loads(state)
+    return unpack(state)
 
 
-def update_labels(pipe, sid, old_lbls, new_lbls):
-    pipe.sadd("lb:services:all", sid)
-    # only modify labels if we are setting new ones. They shall be
-    # persistent otherwise.
-    if len(new_lbls) == 0:
-        return
-    for lbl in new_lbls - old_lbls:
-        pipe.sadd("lb:services:%s" % lbl, sid)
-        pipe.sadd("lb:labels", lbl)
-    for lbl in old_lbls - new_lbls:
-        pipe.srem("lb:services:%s" % lbl, sid)
+def expand_labels(lbls):
+    """ Return the labels and all their ancestors. Labels are hierarchical:
+        a service labelled "prod/eu/db" is also in "prod/eu" and "prod", and
+        is indexed in all of them, so that a parent label shows its whole
+        subtree without taking the union of its children.
+    """
+    expanded = set()
+    for lbl in lbls:
+        parts = lbl.split('/')
+        for i in range(1, len(parts) + 1):
+            expanded.add('/'.join(parts[:i]))
+    return expanded
+
+
+def normalize_label(lbl):
+    return '/'.join(part for part in lbl.lower().split('/') if part)
+
+
+def label_arg(lbl):
+    """ Return a label named in a URL, normalized like the labels of
+        triggers. Empty parts, as in "prod//db", are rejected.
+    """
+    parts = lbl.lower().strip('/').split('/')
+    if not all(parts):
+        abort(400)
+    return '/'.join(parts)
+
+
+def service_labels(conf):
+    lbls = expand_labels(conf.get('labels', []))
+    lbls.add('all')
+    return lbls
+
+
+def index_status(pipe, sid, lbls, status):
+    """ Move the service to the `status` set of each label, or remove it
+        from all of them if `status` is None.
+    """
+    for lbl in lbls:
+        for s in STATUSES:
+            if s == status:
+                pipe.zadd("lb:status:%s:%s" % (lbl, s), 0, sid)
+            else:
+                pipe.zrem("lb:status:%s:%s" % (lbl, s), sid)
+
+
+def publish(pipe, sid, lbls, event):
+    """ Send an event about a service to the dashboards of its labels that
+        are open. See Events.
+    """
+    event = json.dumps(dict(event, id=sid))
+    for lbl in lbls:
+        pipe.publish("lb:events:%s" % lbl, event)
 
 
-@app.route("/l/<lbl>", methods = ["POST"])
+def bump_versions(pipe, lbls):
+    """ Note that services in the labels have changed, see label_version.
+        This must be written along with or after the changes.
+    """
+    for lbl in lbls:
+        pipe.hincrby("lb:versions", lbl, 1)
+
+
+def label_version(lbl):
+    """ Return a number that grows whenever a service in the label is
+        triggered, changes status, alert or maintenance, or is deleted. It
+        is read before the services, so that they are at least as new.
+    """
+    def read(db):
+        return int(db.hget("lb:versions", lbl) or 0)
+    return sum(fan_out(read, read_shards()))
+
+
+def state_event(state):
+    return {'status': state['status'], 'last': state['last'].get('ts')}
+
+
+def queue_alert(pipe, sid, alert):
+    """ Add a new alert to the feed of the agents, see alert_feed.
+    """
+    pipe.execute_command("XADD", "lb:alerts", "MAXLEN", "~", MAX_QUEUED_ALERTS,
+                         "*", "service", sid, "id", alert['id'],
+                         "status", alert['status'])
+
+
+def label_summaries(lbls, dbs):
+    """ Return the number of services in each label, per status, as a list
+        of dicts. They are the sizes of the status indexes, so no service
+        is read.
+    """
+    def count(db):
+        with db.pipeline(False) as pipe:
+            for lbl in lbls:
+                for s in STATUSES:
+                    pipe.zcard("lb:status:%s:%s" % (lbl, s))
+            return pipe.execute()
+    counts = map(sum, zip(*fan_out(count, dbs)))
+    return [dict(zip(STATUSES, counts[i:i + len(STATUSES)]))
+            for i in range(0, len(counts), len(STATUSES))]
+
+
+def label_summary(lbl):
+    """ Return the number of services in the label, per status.
+    """
+    return label_summaries([lbl], all_shards())[0]
+
+
+def worst_status(summary):
+    """ Return the worst status of the services of a label summary, or
+        None if it has none.
+    """
+    for s in ('error', 'warning', 'maint', 'ok'):
+        if summary[s]:
+            return s
+    return None
+
+
+def load_service_config(pipe, sid):
+    return decode_config(pipe.hget("lb:s:%s" % sid, "conf"))
+
+
+def load_service_state(pipe, sid):
+    return decode_state(pipe.hget("lb:s:%s" % sid, "state"))
+
+
+@app.route("/l/<path:lbl>", methods = ["POST"])
 def update_label(lbl):
+    lbl = label_arg(lbl)
     alert_warning = set()
     alert_error = set()
     if request.form:
@@ -103,33 +742,49 @@ def update_label(lbl):
 
     with g.db.pipeline() as pipe:
         pipe.multi()
-        pipe.sadd('lb:labels', lbl)
+        pipe.zadd('lb:labels', 0, lbl)
         config = {'alerts': {'error': list(alert_error),
                              'warning': list(alert_warning)}}
         pipe.hset('lb:l:%s' % lbl, 'config', json.dumps(config))
+        pipe.hincrby('lb:l:%s' % lbl, 'version', 1)
+        # see load_routing
+        pipe.incr('lb:labels:version')
         pipe.execute()
     return "ok"
 
 
-@app.route("/l/<lbl>", methods = ["GET"])
+@app.route("/l/<path:lbl>", methods = ["GET"])
 def get_label(lbl):
-    config = g.db.hget('lb:l:%s' % lbl, 'config')
+    lbl = label_arg(lbl)
+    config, version = read_conn().hmget('lb:l:%s' % lbl, 'config', 'version')
+    etag = version or '0'
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
     if not config:
-        return jsonify()
-    return jsonify(**json.loads(config))
+        resp = jsonify()
+    else:
+        resp = jsonify(**json.loads(config))
+    return set_etag(resp, etag)
 
 
 @app.route("/s/<sid>/unmaint", methods = ["GET", "POST"])
 def unmaint(sid):
+    now = get_ts()
+
     def trans(pipe):
+        conf_present, conf = load_service_config(pipe, sid)
         state = load_service_state(pipe, sid)
         if 'maint' in state:
             del state['maint']
         # don't calculate 'status' here, let that be done in 'eval'
         pipe.multi()
-        pipe.hset("lb:s:%s" % sid, "state", json.dumps(state))
+        pipe.hset("lb:s:%s" % sid, "state", pack(state))
+        # services that have never been triggered aren't evaluated
+        if conf_present:
+            schedule(pipe, sid, now)
+        bump_versions(pipe, service_labels(conf))
 
-    g.db.transaction(trans, 'lb:s:%s' % sid)
+    transaction(shard(sid), trans, 'lb:s:%s' % sid)
     if request.json:
         return jsonify()
     return "ok\n"
@@ -142,51 +797,275 @@ def maint(sid):
     expiry = 10 * 60
 
     def trans(pipe):
+        conf_present, conf = load_service_config(pipe, sid)
         state = load_service_state(pipe, sid)
+        old_status = state['status']
         state['maint'] = {'type': type, 'expiry': now + expiry}
         state['status'] = 'maint'
         pipe.multi()
-        pipe.hset("lb:s:%s" % sid, "state", json.dumps(state))
+        pipe.hset("lb:s:%s" % sid, "state", pack(state))
+        # services that have never been triggered aren't evaluated
+        if conf_present:
+            schedule(pipe, sid, next_deadline(conf, state, now))
+        if conf_present and old_status != 'maint':
+            index_status(pipe, sid, service_labels(conf), 'maint')
+            publish(pipe, sid, service_labels(conf), state_event(state))
+        bump_versions(pipe, service_labels(conf))
 
     if request.json:
         type = request.json.get('type', type)
-        expiry = int(request.json.get('expiry'), expiry)
-        g.db.transaction(trans, 'lb:s:%s' % sid)
+        expiry = int(request.json.get('expiry', expiry))
+        transaction(shard(sid), trans, 'lb:s:%s' % sid)
         return jsonify()
     elif request.form:
         type = request.form.get('type', type)
         expiry = int(request.form.get('expiry', expiry))
-    g.db.transaction(trans, 'lb:s:%s' % sid)
+    transaction(shard(sid), trans, 'lb:s:%s' % sid)
     return "ok\n"
 
 
 @app.route("/s/<sid>/delete", methods = ["POST"])
 def delete(sid):
+    now = get_ts()
+
     def trans(pipe):
         conf_present, conf = load_service_config(pipe, sid)
-        lbls = set(conf.get('labels', []))
-        lbls.add('all')
         pipe.multi()
-        for lbl in lbls:
-            pipe.srem("lb:services:%s" % lbl, sid)
-        pipe.delete("lb:s:%s" % sid)
-        pipe.delete("lb:s:%s:h" % sid)
+        unindex_service(pipe, sid, conf)
+        publish(pipe, sid, service_labels(conf), {'deleted': True})
+        bump_versions(pipe, service_labels(conf))
+        pipe.delete(*service_keys(sid, now))
 
-    g.db.transaction(trans, 'lb:s:%s' % sid)
+    transaction(shard(sid), trans, 'lb:s:%s' % sid)
 
     if request.json:
         return jsonify()
     return "ok\n"
 
 
+def service_keys(sid, now):
+    """ Return the keys storing a service, some of which may not exist.
+    """
+    keys = ["lb:s:%s" % sid, "lb:s:%s:h" % sid]
+    for tier in SERIES_TIERS:
+        for bucket in series_buckets(tier, now - tier[2], now):
+            keys.append(series_key(sid, tier[0], bucket))
+    return keys
+
+
+def threshold_entry(threshold):
+    """ Return a threshold on a window as stored in lb:thresholds, see
+        load_thresholds and trigger.lua.
+    """
+    levels = ['' if level is None else repr(level)
+              for level in (threshold['warning'], threshold['error'])]
+    return '/'.join([threshold['aggregate'], str(threshold['window'])] +
+                    levels)
+
+
+def index_labels(pipe, sid, lbls):
+    """ Add a service to the member indexes of its labels, see
+        service_labels.
+    """
+    for lbl in lbls:
+        pipe.zadd("lb:services:%s" % lbl, 0, sid)
+        if lbl != 'all':
+            pipe.zadd("lb:labels", 0, lbl)
+
+
+def index_service(pipe, sid, conf, state, now):
+    """ Add a service to the indexes of its shard: its labels, status,
+        deadline and thresholds. See move_service.
+    """
+    lbls = service_labels(conf)
+    index_labels(pipe, sid, lbls)
+    index_status(pipe, sid, lbls, state['status'])
+    if 'ts' in state['last']:
+        pipe.hset("lb:last", sid, state['last']['ts'])
+    schedule(pipe, sid, next_deadline(conf, state, now))
+    threshold = conf.get('threshold', DEFAULT_THRESHOLD)
+    if threshold['aggregate'] != 'last':
+        pipe.hset("lb:thresholds", sid, threshold_entry(threshold))
+        if state.get('value_status', 'ok') != 'ok':
+            pipe.hset("lb:value_status", sid, state['value_status'])
+        pipe.incr("lb:thresholds:version")
+
+
+def unindex_service(pipe, sid, conf):
+    """ Remove a service from the indexes of its shard.
+    """
+    lbls = service_labels(conf)
+    for lbl in lbls:
+        pipe.zrem("lb:services:%s" % lbl, sid)
+    index_status(pipe, sid, lbls, None)
+    pipe.hdel("lb:last", sid)
+    pipe.zrem("lb:deadlines", sid)
+    pipe.hdel("lb:alerts:entries", sid)
+    if conf.get('threshold', DEFAULT_THRESHOLD)['aggregate'] != 'last':
+        pipe.hdel("lb:thresholds", sid)
+        pipe.hdel("lb:value_status", sid)
+        pipe.incr("lb:thresholds:version")
+
+
+def move_service(sid, src, dst, now):
+    """ Move a service from the shard `src` to `dst`, unless it has been
+        moved already. Its keys are moved atomically by MIGRATE, so any
+        other request sees them on either of the shards, and its indexes
+        are moved after that.
+    """
+    conf = src.hget("lb:s:%s" % sid, "conf")
+    if conf is None:
+        return
+    target = dst.connection_pool.connection_kwargs
+    args = [target['host'], target['port'], "", target['db'], MIGRATE_TIMEOUT]
+    keys = ["KEYS"] + service_keys(sid, now)
+    try:
+        reply = src.execute_command("MIGRATE", *(args + keys))
+    except redis.ResponseError as e:
+        if "BUSYKEY" not in str(e):
+            raise
+        # left on `dst` by a move that failed halfway. The service is used
+        # on `dst` only once it has been moved, so while it is still on
+        # `src` the copy there is the authoritative one
+        reply = src.execute_command("MIGRATE", *(args + ["REPLACE"] + keys))
+    if reply == 'NOKEY':
+        # moved by someone else
+        return
+    with src.pipeline(False) as pipe:
+        unindex_service(pipe, sid, unpack_config(conf))
+        pipe.execute()
+
+    def trans(pipe):
+        conf, state = pipe.hmget("lb:s:%s" % sid, "conf", "state")
+        pipe.multi()
+        if state:
+            index_service(pipe, sid, unpack_config(conf), unpack(state), now)
+    transaction(dst, trans, "lb:s:%s" % sid)
+
+
+def rebalance(now):
+    """ Move the services that are stored on another shard than they
+        should be since SHARDS changed. Web servers running with the same
+        PREVIOUS_SHARDS move the services as they are used, so this can
+        run while serving. Remove PREVIOUS_SHARDS once it has finished.
+    """
+    ring = get_ring(app.config['SHARDS'])
+    moved = 0
+    for url in app.config['PREVIOUS_SHARDS']:
+        src = shard_conn(url)
+        for sid in src.zrange("lb:services:all", 0, -1):
+            owner = ring.owner(sid)
+            if owner != url:
+                move_service(sid, src, shard_conn(owner), now)
+                moved += 1
+    logging.info("moved %d services", moved)
+
+
+def series_key(sid, resolution, bucket):
+    return "lb:s:%s:ts:%d:%d" % (sid, resolution, bucket)
+
+
+def series_buckets(tier, start, end):
+    span = tier[1]
+    return range(start // span, end // span + 1)
+
+
+def read_series(sid, tier, start, end):
+    """ Return the samples of a time series tier between `start` and `end`.
+
+        Raw samples are stored as packed (ts, value) records and returned as
+        [ts, value] pairs. Rollups are stored as packed (ts, count, sum, min,
+        max) records, one per `resolution` seconds, and returned as-is.
+    """
+    with shard(sid).pipeline(False) as pipe:
+        for bucket in series_buckets(tier, start, end):
+            pipe.get(series_key(sid, tier[0], bucket))
+        data = ''.join(d for d in pipe.execute() if d)
+    fmt, size = ('Id', 12) if tier[0] == 0 else ('IIddd', 32)
+    fields = struct.unpack('<' + fmt * (len(data) // size), data)
+    n = len(fmt)
+    return [list(fields[i:i + n]) for i in xrange(0, len(fields), n)
+            if start <= fields[i] <= end]
+
+
+def downsample(samples, resolution):
+    """ Merge raw samples or rollups into rollups of `resolution` seconds.
+    """
+    rollups = []
+    for sample in samples:
+        if len(sample) == 2:
+            ts, v = sample
+            sample = [ts, 1, v, v, v]
+        ts, count, total, lo, hi = sample
+        slot = ts - ts % resolution
+        if rollups and rollups[-1][0] == slot:
+            r = rollups[-1]
+            r[1] += count
+            r[2] += total
+            r[3] = min(r[3], lo)
+            r[4] = max(r[4], hi)
+        else:
+            rollups.append([slot, count, total, lo, hi])
+    return rollups
+
+
+@app.route("/s/<sid>/series", methods = ["GET"])
+def get_series(sid):
+    """ The values reported for a service between 'from' and 'to' (default:
+        the last hour). With 'res' 0, the raw samples are returned as
+        [ts, value]. Otherwise, they are rolled up per 'res' seconds and
+        returned as [ts, count, mean, min, max]. The default resolution is
+        the finest one that is kept for the whole period.
+    """
+    now = get_ts()
+    try:
+        start = int(request.args.get('from', now - 3600))
+        end = int(request.args.get('to', now))
+        res = request.args.get('res')
+        res = None if res is None else int(res)
+    except ValueError:
+        abort(400)
+    if res is None:
+        res = ([t[0] for t in SERIES_TIERS if now - t[2] <= start] +
+               [SERIES_TIERS[-1][0]])[0]
+    # Use the coarsest stored tier that can be rolled up into `res`,
+    # preferring those that cover the whole period.
+    tiers = [t for t in SERIES_TIERS
+             if t[0] == res or (t[0] and res and res % t[0] == 0) or
+             (t[0] == 0 and res > 0)]
+    if res < 0 or not tiers:
+        abort(400)
+    covering = [t for t in tiers if now - t[2] <= start]
+    tier = covering[-1] if covering else tiers[-1]
+    start = max(start, now - tier[2])
+    end = min(end, now)
+
+    samples = read_series(sid, tier, start, end)
+    if res != tier[0]:
+        samples = downsample(samples, res)
+    if res:
+        samples = [[ts, count, total / count, lo, hi]
+                   for ts, count, total, lo, hi in samples]
+    return jsonify(resolution=res, points=samples)
+
+
 @app.route("/s/<sid>", methods = ["GET", "POST"])
 @app.route("/s/<sid>/trigger", methods = ["GET", "POST"])
 def trigger(sid):
+    try:
+        val = parse_value(request.values.get('value'))
+    except ValueError:
+        abort(400)
     if request.json:
         whb = request.json.get('heartbeat', {}).get('warning')
         ehb = request.json.get('heartbeat', {}).get('error')
+        try:
+            val = parse_value(request.json.get('value', val))
+            threshold = parse_threshold(request.json.get('threshold'))
+        except (ValueError, TypeError, AttributeError):
+            abort(400)
         do_trigger(sid, request.json.get('labels', []),
-                   whb, ehb)
+                   whb, ehb, val, threshold)
         return jsonify()
     elif request.form:
         lbls = set([])
@@ -194,6 +1073,7 @@ def trigger(sid):
             lbls = [l.strip() for l in request.form['labels'].split(',')]
             lbls = set([l for l in lbls if l])
         ehb = whb = None
+        threshold = None
         for key, value in request.form.items(multi=True):
             if key == 'heartbeat':
                 if ':' in value:
@@ -204,41 +1084,414 @@ def trigger(sid):
                     ehb = int(value)
                 elif type == 'warning':
                     whb = int(value)
-        do_trigger(sid, lbls, whb, ehb)
+            elif key == 'threshold':
+                threshold = threshold or {}
+                if ':' in value:
+                    type, value = value.split(":", 1)
+                    if type not in ('warning', 'error'):
+                        abort(400)
+                    threshold[type] = value
+                elif value != 'off':
+                    threshold['error'] = value
+        if threshold is not None:
+            for key in ('aggregate', 'window'):
+                if key in request.form:
+                    threshold[key] = request.form[key]
+        try:
+            threshold = parse_threshold(threshold)
+        except ValueError:
+            abort(400)
+        do_trigger(sid, lbls, whb, ehb, val, threshold)
         return "ok\n"
-    do_trigger(sid, [], None, None)
+    do_trigger(sid, [], None, None, val)
     return "ok\n"
 
 
-def do_trigger(sid, new_lbls = None, whb = None, ehb = None):
-    now = get_ts()
-    new_lbls = set([l.lower() for l in new_lbls])
+def parse_value(value):
+    """ Parse the optional value of a heartbeat.
+    """
+    if value is None:
+        return None
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError("value must be finite")
+    return value
+
+
+def parse_threshold(threshold):
+    """ Parse the value thresholds of a service, given as a dict like
+        DEFAULT_THRESHOLD. Thresholds without a warning or error level are
+        removed. Returns None if the thresholds are to be left as they are.
+    """
+    if threshold is None:
+        return None
+    rv = {'warning': parse_value(threshold.get('warning')),
+          'error': parse_value(threshold.get('error')),
+          'aggregate': threshold.get('aggregate',
+                                     DEFAULT_THRESHOLD['aggregate']),
+          'window': int(threshold.get('window',
+                                      DEFAULT_THRESHOLD['window']))}
+    if rv['aggregate'] not in AGGREGATES:
+        raise ValueError("unknown aggregate")
+    # windows are aggregated from the raw samples or the minute rollups
+    if not 0 < rv['window'] <= SERIES_TIERS[0][2]:
+        raise ValueError("window out of range")
+    if rv['warning'] is not None and rv['error'] is not None and \
+            rv['warning'] > rv['error']:
+        rv['warning'] = None
+    return rv
+
+
+def parse_trigger(new_lbls, whb, ehb):
+    new_lbls = set([normalize_label(l) for l in (new_lbls or [])])
+    new_lbls.discard('')
     if whb is not None and ehb is not None and whb > ehb:
         whb = None
+    return new_lbls, whb, ehb
+
+
+def trigger_script(pipe, sid, now, new_lbls, whb, ehb, value=None,
+                   threshold=None):
+    run_script('trigger.lua', pipe,
+               keys=["lb:s:%s" % sid, "lb:s:%s:h" % sid],
+               args=[sid, now, MAX_SAVED,
+                     json.dumps(sorted(new_lbls)),
+                     '' if whb is None else whb,
+                     '' if ehb is None else ehb,
+                     json.dumps(DEFAULT_CONF),
+                     app.config['SERIALIZER'],
+                     '' if value is None else repr(value),
+                     json.dumps(SERIES_TIERS),
+                     '' if threshold is None else json.dumps(threshold)])
+
+
+def do_trigger(sid, new_lbls = None, whb = None, ehb = None, value = None,
+               threshold = None):
+    now = get_ts()
+    new_lbls, whb, ehb = parse_trigger(new_lbls, whb, ehb)
+    # values are never coalesced, as that would lose samples
+    if coalescer and value is None and threshold is None and \
+            not coalescer.add(sid, now, new_lbls, whb, ehb):
+        return
+    trigger_script(shard(sid), sid, now, new_lbls, whb, ehb, value, threshold)
+
+
+def do_trigger_many(items):
+    """ Trigger many services using a few pipelined round trips.
+
+        `items` is a list of (sid, labels, whb, ehb, value, threshold)
+        tuples. A sid may occur several times; the triggers are then applied
+        in order. The shards are written to in parallel.
+    """
+    now = get_ts()
+
+    def write(group):
+        db, shard_items = group
+        for chunk in chunks(shard_items, BATCH_SIZE):
+            with db.pipeline(False) as pipe:
+                for sid, new_lbls, whb, ehb, value, threshold in chunk:
+                    new_lbls, whb, ehb = parse_trigger(new_lbls, whb, ehb)
+                    trigger_script(pipe, sid, now, new_lbls, whb, ehb, value,
+                                   threshold)
+                pipe.execute()
+    fan_out(write, group_by_shard(items, lambda item: item[0]))
+
+
+class Coalescer(object):
+    """ Collapses repeated triggers of a service into one write per window.
+
+        The first trigger of a service is written immediately. Triggers
+        within `window` seconds after that are merged and written by
+        flush(), which runs every `window` seconds and at exit.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.written = {}
+        self.pending = {}
+        self.stats = {'triggers': 0, 'coalesced': 0, 'writes': 0}
+
+    def add(self, sid, now, new_lbls, whb, ehb):
+        """ Returns True if the trigger should be written right away.
+        """
+        with self.lock:
+            self.stats['triggers'] += 1
+            if now - self.written.get(sid, 0) >= self.window:
+                self.written[sid] = now
+                self.stats['writes'] += 1
+                return True
+            if sid in self.pending:
+                self.stats['coalesced'] += 1
+                old_lbls, old_whb, old_ehb = self.pending[sid][1:]
+                if not new_lbls:
+                    new_lbls = old_lbls
+                if whb is None and ehb is None:
+                    whb, ehb = old_whb, old_ehb
+            self.pending[sid] = (now, new_lbls, whb, ehb)
+            return False
+
+    def flush(self):
+        now = get_ts()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            for sid, ts in self.written.items():
+                if now - ts >= self.window:
+                    del self.written[sid]
+            for sid in pending:
+                self.written[sid] = now
+        try:
+            for db, sids in group_by_shard(pending):
+                with db.pipeline(False) as pipe:
+                    for sid in sids:
+                        ts, new_lbls, whb, ehb = pending[sid]
+                        trigger_script(pipe, sid, ts, new_lbls, whb, ehb)
+                    pipe.execute()
+        except redis.RedisError:
+            # retry with the next flush, unless superseded by then
+            with self.lock:
+                for sid, p in pending.items():
+                    self.pending.setdefault(sid, p)
+            raise
+        with self.lock:
+            self.stats['writes'] += len(pending)
+
+    def run(self):
+        while 1:
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except redis.RedisError:
+                logging.exception("flushing coalesced triggers failed")
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='coalescer')
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.flush)
+        exit_on_sigterm()
+
+
+def exit_on_sigterm():
+    """ Make SIGTERM exit like sys.exit, so that the atexit handlers run,
+        unless it is already handled. Only the main thread can do this;
+        started elsewhere, the triggers coalesced since the last flush are
+        lost when terminated.
+    """
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM,
+                          lambda signum, frame: sys.exit(128 + signum))
+    except ValueError:
+        pass
+
+
+@app.before_first_request
+def start_coalescer():
+    global coalescer
+    if app.config['COALESCE_WINDOW'] and not coalescer:
+        coalescer = Coalescer(app.config['COALESCE_WINDOW'])
+        coalescer.start()
+
+
+@app.route("/stats", methods = ["GET"])
+def stats():
+    """ Counters of this process. Per route, the number of requests and
+        of their redis round trips, and a histogram of the latency of those
+        that were sampled (see STATS_SAMPLE) in ms. The time spent in some
+        functions during the sampled requests, and the number of retried
+        transactions.
+    """
+    rv = {'routes': {}, 'timers': {}, 'retries': {}}
+    if coalescer:
+        with coalescer.lock:
+            rv['coalescer'] = dict(coalescer.stats,
+                                   pending=len(coalescer.pending))
+    bounds = [str(b) for b in LATENCY_BUCKETS] + ['+Inf']
+    for key, value in instruments.read().items():
+        kind, name = key[:2]
+        if kind in ('requests', 'round_trips', 'latency', 'latency_ms'):
+            route = rv['routes'].setdefault(name, {
+                'requests': 0, 'round_trips': 0, 'sampled': 0,
+                'latency_ms': 0, 'histogram': [0] * len(bounds)})
+            if kind == 'latency':
+                route['histogram'][key[2]] += value
+                route['sampled'] += value
+            else:
+                route[kind] = value
+        elif kind in ('calls', 'time_ms'):
+            timer = rv['timers'].setdefault(name, {'calls': 0, 'time_ms': 0})
+            timer[kind] = value
+        elif kind == 'retries':
+            rv['retries'][name] = value
+    for route in rv['routes'].values():
+        # cumulative, like the histograms of Prometheus
+        counts = route['histogram']
+        route['histogram'] = dict((bound, sum(counts[:i + 1]))
+                                  for i, bound in enumerate(bounds))
+    return jsonify(**rv)
+
+
+class Events(object):
+    """ Passes the events of the services, see publish, to the open event
+        streams of their labels in this process. A single subscription per
+        shard is used for all of them, which is made when the first stream
+        is opened.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.subscribed = []
+        self.threads = None
+
+    def listen(self, lbl):
+        """ Return a queue that gets the events of the label, until passed
+            to unlisten().
+        """
+        queue = Queue.Queue()
+        with self.lock:
+            self.streams.setdefault(lbl, set()).add(queue)
+            if not self.threads:
+                self.threads = []
+                for db in all_shards():
+                    subscribed = threading.Event()
+                    thread = threading.Thread(target=self.run,
+                                              args=(db, subscribed),
+                                              name='events')
+                    thread.daemon = True
+                    thread.start()
+                    self.subscribed.append(subscribed)
+                    self.threads.append(thread)
+        for subscribed in self.subscribed:
+            subscribed.wait(EVENTS_KEEPALIVE)
+        return queue
+
+    def unlisten(self, lbl, queue):
+        with self.lock:
+            self.streams[lbl].discard(queue)
+            if not self.streams[lbl]:
+                del self.streams[lbl]
+
+    def dispatch(self, message, subscribed):
+        if message['type'] == 'psubscribe':
+            subscribed.set()
+        elif message['type'] == 'pmessage':
+            lbl = message['channel'][len("lb:events:"):]
+            with self.lock:
+                queues = list(self.streams.get(lbl, ()))
+            for queue in queues:
+                queue.put(message['data'])
+
+    def run(self, db, subscribed):
+        while 1:
+            pubsub = untimed(db).pubsub()
+            try:
+                pubsub.psubscribe("lb:events:*")
+                for message in pubsub.listen():
+                    self.dispatch(message, subscribed)
+            except Exception:
+                # also of a bad message, which mustn't end the subscription
+                logging.exception("receiving events failed")
+                # events may have been lost
+                with self.lock:
+                    for queues in self.streams.values():
+                        for queue in queues:
+                            queue.put(None)
+                time.sleep(1)
+            finally:
+                pubsub.reset()
+
+
+events = Events()
+
+
+@app.route("/dashboard/<path:lbl>/events", methods = ["GET"])
+def get_events(lbl):
+    """ A stream of server-sent events for the services in a label. Each
+        event is a JSON object with the service 'id', and its 'status' and
+        'last' heartbeat. A 'deleted' service has no status. Events may be
+        lost when the stream ends, so clients should reload when reconnecting.
+    """
+    def generate():
+        queue = events.listen(lbl)
+        try:
+            yield "retry: 3000\n\n"
+            while queue.qsize() <= MAX_QUEUED_EVENTS:
+                try:
+                    event = queue.get(timeout=EVENTS_KEEPALIVE)
+                except Queue.Empty:
+                    yield ":\n\n"
+                    continue
+                if event is None:
+                    return
+                yield "data: %s\n\n" % event
+        finally:
+            events.unlisten(lbl, queue)
+    resp = Response(generate(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
-    def trans(pipe):
-        conf_present, old_conf = load_service_config(pipe, sid)
-        new_conf = copy.deepcopy(old_conf)
-        state = load_service_state(pipe, sid)
-        old_lbls = set(new_conf.get('labels', []))
-        if new_lbls:
-            new_conf['labels'] = sorted(new_lbls)
-        if ehb is not None or whb is not None:
-            new_conf['heartbeat']['error'] = ehb
-            new_conf['heartbeat']['warning'] = whb
-        if state.get('maint', {}).get('type') == 'soft':
-            del state['maint']
-        pipe.multi()
-        update_labels(pipe, sid, old_lbls, new_lbls)
-        state['last']['ts'] = now
-        state['last']['val'] = 1
-        pipe.hset("lb:s:%s" % sid, "state", json.dumps(state))
-        pipe.lpush("lb:s:%s:h" % sid, '%d:1' % now)
-        pipe.ltrim("lb:s:%s:h" % sid, 0, MAX_SAVED - 1)
-        if not conf_present or new_conf != old_conf:
-            pipe.hset("lb:s:%s" % sid, "conf", json.dumps(new_conf))
 
-    g.db.transaction(trans, 'lb:s:%s' % sid)
+def parse_batch_item(item):
+    if not isinstance(item, dict):
+        item = {'id': item}
+    sid = item.get('id')
+    if not sid or not isinstance(sid, basestring) or '/' in sid:
+        raise ValueError("invalid id")
+    lbls = item.get('labels', [])
+    if isinstance(lbls, basestring):
+        lbls = [l.strip() for l in lbls.split(',')]
+    if not isinstance(lbls, list) or \
+            not all(isinstance(l, basestring) for l in lbls):
+        raise ValueError("invalid labels")
+    lbls = [l for l in lbls if l]
+    hb = item.get('heartbeat') or {}
+    whb = hb.get('warning')
+    ehb = hb.get('error')
+    whb = int(whb) if whb is not None else None
+    ehb = int(ehb) if ehb is not None else None
+    return (sid, lbls, whb, ehb, parse_value(item.get('value')),
+            parse_threshold(item.get('threshold')))
+
+
+@app.route("/batch", methods = ["POST"])
+def batch():
+    """ Trigger many services at once. The body is either a JSON array or
+        newline-delimited entries, each of which is a service id or a JSON
+        object in the same format as '/s/<sid>' accepts, plus an 'id'.
+    """
+    if request.json is not None:
+        entries = request.json
+        if not isinstance(entries, list):
+            entries = [entries]
+    else:
+        entries = []
+        for line in request.data.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                try:
+                    line = json.loads(line)
+                except ValueError:
+                    # reported as an invalid entry, not taken as an id
+                    line = None
+            entries.append(line)
+
+    results = []
+    items = []
+    for entry in entries:
+        try:
+            item = parse_batch_item(entry)
+        except (ValueError, TypeError, AttributeError):
+            sid = entry.get('id') if isinstance(entry, dict) else entry
+            results.append({'id': sid, 'status': 'error',
+                            'error': 'invalid entry'})
+            continue
+        items.append(item)
+        results.append({'id': item[0], 'status': 'ok'})
+
+    do_trigger_many(items)
+    return jsonify(results=results)
 
 
 @app.template_filter('pretty_interval')
@@ -274,143 +1527,823 @@ def eval_status(conf, state, now):
         new_status = 'warning'
     if hb_err and last_heartbeat >= hb_err:
         new_status = 'error'
+    # see evaluate_thresholds
+    value_status = state.get('value_status', 'ok')
+    if STATUSES.index(value_status) > STATUSES.index(new_status):
+        new_status = value_status
     if 'maint' in state and \
             state['maint']['expiry'] >= now:
         new_status = 'maint'
     return new_status
 
 
-def update_alert(service, now):
-    state = service['state']
-    alert_status = state['alert']['status']
+def advance_state(conf, state, now):
+    """ Move the status, and the alert if it can do a transition, to `now`.
+        Returns True if the state was modified.
+    """
+    old_status = state['status']
+    state['status'] = eval_status(conf, state, now)
+    alert = state['alert']
     status = 'ok' if state['status'] == 'maint' else state['status']
     # can we do a status transition?
-    if alert_status != status and state['alert']['state'] == 'confirmed':
-        def trans(pipe):
-            state['alert'] = {'id': state['alert']['id'],
-                              'status': status,
-                              'state': 'new',
-                              'ts': get_ts()}
-            if alert_status == 'ok':
-                state['alert']['id'] += 1
-
-            pipe.multi()
-            pipe.hset('lb:s:%s' % service['id'], 'state', json.dumps(state))
-        g.db.transaction(trans, 'lb:s:%s' % service['id'])
-
-
-def update_status(service, now):
-    old_status = service['state']['status']
-    new_status = eval_status(service['config'], service['state'], now)
-    if new_status != old_status:
-        def trans(pipe):
-            state = load_service_state(pipe, service['id'])
-            state['status'] = eval_status(service['config'], state, now)
-            service['state'] = state
-
-            pipe.multi()
-            pipe.hset('lb:s:%s' % service['id'], 'state', json.dumps(state))
-        g.db.transaction(trans, 'lb:s:%s' % service['id'])
-
-
-def eval_service(service, now):
-    update_status(service, now)
-    update_alert(service, now)
+    if alert['status'] != status and alert['state'] == 'confirmed':
+        state['alert'] = {'id': alert['id'],
+                          'status': status,
+                          'state': 'new',
+                          'ts': now}
+        if alert['status'] == 'ok':
+            state['alert']['id'] += 1
+        return True
+    return state['status'] != old_status
+
+
+def next_deadline(conf, state, now):
+    """ Return when the service has to be evaluated next, or None if it
+        will not change status until it is triggered.
+    """
+    if eval_status(conf, state, now) != state['status']:
+        return now
+    alert = state['alert']
+    status = 'ok' if state['status'] == 'maint' else state['status']
+    if alert['status'] != status and alert['state'] == 'confirmed':
+        return now
+    if 'maint' in state and state['maint']['expiry'] >= now:
+        return state['maint']['expiry'] + 1
+    last = state['last'].get('ts', 0)
+    deadlines = [last + hb for hb in (conf['heartbeat']['warning'],
+                                      conf['heartbeat']['error'])
+                 if hb and last + hb > now]
+    return min(deadlines) if deadlines else None
+
+
+def schedule(pipe, sid, deadline):
+    if deadline is None:
+        pipe.zrem("lb:deadlines", sid)
+    else:
+        pipe.zadd("lb:deadlines", deadline, sid)
+
 
+def update_services(db, sids, func):
+    """ Call func(pipe, sid, conf, state) with the raw config and state of
+        each service on the shard `db`, where pipe is a transaction that is
+        executed once all services have been handled. Services that are
+        modified in the meantime are retried one at a time.
+    """
+    keys = ["lb:s:%s" % sid for sid in sids]
+    with db.pipeline(True) as pipe:
+        while 1:
+            try:
+                pipe.watch(*keys)
+                reader = db.pipeline(False)
+                for key in keys:
+                    reader.hmget(key, "conf", "state")
+                loaded = reader.execute()
+                pipe.multi()
+                for sid, (conf, state) in zip(sids, loaded):
+                    func(pipe, sid, conf, state)
+                pipe.execute()
+                return
+            except redis.WatchError:
+                instruments.add(('retries', 'update_services'))
+                if len(sids) > 1:
+                    # Some services are being triggered. Don't let them
+                    # hold up the others.
+                    pipe.reset()
+                    for sid in sids:
+                        update_services(db, [sid], func)
+                    return
+
+
+def advance_services(db, sids, now, reindex=False, value_statuses=None):
+    """ Advance the state of some services on the shard `db` to `now`, and
+        schedule their next evaluation. With `reindex`, the services' labels
+        and statuses are indexed even if they didn't change. `value_statuses`
+        maps sids to the status of their values, see evaluate_thresholds.
+    """
+    def advance(pipe, sid, conf, state):
+        if not conf or not state:
+            # deleted, or put in maintenance before it was ever triggered
+            pipe.zrem("lb:deadlines", sid)
+            return
+        conf = unpack_config(conf)
+        state = unpack(state)
+        old_status = state['status']
+        old_alert = state['alert']
+        modified = False
+        if value_statuses and sid in value_statuses:
+            value_status = value_statuses[sid]
+            if state.get('value_status', 'ok') != value_status:
+                state['value_status'] = value_status
+                modified = True
+            # see evaluate_thresholds
+            if value_status == 'ok':
+                pipe.hdel("lb:value_status", sid)
+            else:
+                pipe.hset("lb:value_status", sid, value_status)
+        if advance_state(conf, state, now) or modified:
+            pipe.hset("lb:s:%s" % sid, "state", pack(state))
+            bump_versions(pipe, service_labels(conf))
+        if reindex:
+            index_labels(pipe, sid, service_labels(conf))
+        if reindex or state['status'] != old_status:
+            index_status(pipe, sid, service_labels(conf), state['status'])
+        if reindex and 'ts' in state['last']:
+            pipe.hset("lb:last", sid, state['last']['ts'])
+        if state['status'] != old_status:
+            publish(pipe, sid, service_labels(conf), state_event(state))
+        if state['alert'] is not old_alert and \
+                state['alert']['status'] in ('warning', 'error'):
+            queue_alert(pipe, sid, state['alert'])
+        schedule(pipe, sid, next_deadline(conf, state, now))
+    update_services(db, sids, advance)
+
+
+def set_delta(service, now):
     last_heartbeat = now - service['state']['last'].get('ts', 0)
     service['state']['last']['delta'] = last_heartbeat
 
 
+@timed('get_services')
 def get_services(lbl):
+    """ Return the services in a label, sorted by id.
+    """
     fields = ("#", "lb:s:*->state", "lb:s:*->conf")
+
+    def read(db):
+        # in the order of the sorted set
+        return db.sort("lb:services:%s" % lbl, by="nosort", get=fields)
+    replies = fan_out(read, read_shards())
     services = []
-    for sid, state, conf in \
-            chunks(g.db.sort("lb:services:%s" % lbl, by="nosort",
-                             get=fields), 3):
-        service = {'id': sid,
-                   'config': json.loads(conf),
-                   'state': json.loads(state)}
-        services.append(service)
+    for reply in replies:
+        for sid, state, conf in chunks(reply, 3):
+            # services that are being moved to another shard
+            if not state:
+                continue
+            service = {'id': sid,
+                       'config': unpack_config(conf),
+                       'state': unpack(state)}
+            services.append(service)
+    if len(replies) > 1:
+        # merges the sorted runs of the shards
+        services.sort(key=operator.itemgetter('id'))
     return services
 
 
-@app.route("/dashboard/<lbl>/", methods = ["GET"])
-def get_list(lbl):
-    now = get_ts()
+def iter_services(lbl, count=BATCH_SIZE):
+    """ Yield the services in a label without loading all of them at once.
+        They are returned in no particular order, one shard at a time.
+    """
+    for db in all_shards():
+        seen = set()
+        cursor = 0
+        while 1:
+            cursor, items = db.execute_command("ZSCAN",
+                                               "lb:services:%s" % lbl,
+                                               cursor, "COUNT", count)
+            # ZSCAN may return an element more than once
+            sids = [sid for sid in items[::2] if sid not in seen]
+            seen.update(sids)
+            with db.pipeline(False) as pipe:
+                for sid in sids:
+                    pipe.hmget("lb:s:%s" % sid, "conf", "state")
+                for sid, (conf, state) in zip(sids, pipe.execute()):
+                    if state:
+                        yield {'id': sid,
+                               'config': unpack_config(conf),
+                               'state': unpack(state)}
+            if int(cursor) == 0:
+                break
+
+
+def stream_services(lbl, now):
+    """ Like read_services, but returns an iterator. See iter_services.
+    """
+    evaluate_inline(now)
+    for service in iter_services(lbl):
+        set_delta(service, now)
+        yield service
+
+
+def read_services(lbl, now):
+    """ Return the services in a label as of `now`. Unless an evaluator is
+        running, their status and alerts are evaluated first.
+    """
+    evaluate_inline(now)
     services = get_services(lbl)
     for service in services:
-        eval_service(service, now)
+        set_delta(service, now)
+    return services
+
+
+def evaluate_inline(now):
+    """ Evaluate the services as of `now` unless an evaluator is running,
+        see INLINE_EVAL. This is done once per request.
+    """
+    if app.config['INLINE_EVAL'] and getattr(g, 'evaluated', None) != now:
+        evaluate(now)
+        g.evaluated = now
+
+
+@timed('evaluate')
+def evaluate(now):
+    """ Advance the services whose deadlines have passed, or whose values
+        have crossed their thresholds. The shards are evaluated in parallel.
+    """
+    fan_out(lambda db: evaluate_shard(db, now), all_shards())
+
+
+def evaluate_shard(db, now):
+    evaluate_thresholds(db, now)
+    while 1:
+        sids = db.zrangebyscore("lb:deadlines", "-inf", now,
+                                start=0, num=BATCH_SIZE)
+        if not sids:
+            return
+        advance_services(db, sids, now)
+
+
+def evaluate_thresholds(db, now):
+    """ Compare the aggregates of the values of all services on the shard
+        `db` having thresholds on a window to them, and advance the services
+        whose value status changed. Thresholds on the last value are
+        evaluated when the value is reported.
+
+        This is done at most once every EVAL_INTERVAL seconds by a process,
+        rather than on every read of a dashboard, which in between shows the
+        value statuses stored by the last evaluation.
+    """
+    last = thresholds_evaluated.get(db.connection_pool)
+    if last is not None and 0 <= now - last < app.config['EVAL_INTERVAL']:
+        return
+    thresholds_evaluated[db.connection_pool] = now
+    # the value status of the services, unless it is ok
+    current = db.hgetall("lb:value_status")
+    changed = {}
+    for tier, services in load_thresholds(db).items():
+        for chunk in chunks(services, THRESHOLD_BATCH_SIZE):
+            sids, aggregates, windows, warnings, errors = zip(*chunk)
+            values = aggregate_windows(db, tier, sids, aggregates, windows,
+                                       now)
+            for sid, value, warning, error in \
+                    zip(sids, values, warnings, errors):
+                status = threshold_status(warning, error, value)
+                if current.get(sid, 'ok') != status:
+                    changed[sid] = status
+    for sids in chunks(changed.keys(), BATCH_SIZE):
+        advance_services(db, sids, now, value_statuses=changed)
+
+
+def load_thresholds(db):
+    """ Return the thresholds on windows of all services on the shard `db`
+        as (sid, aggregate, window, warning, error), grouped by the time
+        series tier that the aggregates are computed from. They are only
+        read again once they have been modified.
+    """
+    version = db.get("lb:thresholds:version")
+    cached = thresholds.get(db.connection_pool)
+    if cached is None or cached[0] != version:
+        groups = {}
+        for sid, entry in db.hgetall("lb:thresholds").items():
+            aggregate, window, warning, error = entry.split('/')
+            # percentiles can't be computed from rollups
+            tier = SERIES_TIERS[0 if aggregate.startswith('p') else 1]
+            groups.setdefault(tier, []).append(
+                (sid, aggregate, int(window),
+                 float(warning) if warning else None,
+                 float(error) if error else None))
+        cached = thresholds[db.connection_pool] = (version, groups)
+    return cached[1]
+
+
+def threshold_status(warning, error, value):
+    if error is not None and value >= error:
+        return 'error'
+    if warning is not None and value >= warning:
+        return 'warning'
+    return 'ok'
+
+
+def aggregate_windows(db, tier, sids, aggregates, windows, now):
+    """ Return the aggregate of the values that each service reported within
+        its window, or nan if there were none.
+    """
+    resolution = tier[0]
+    size = 32 if resolution else 12
+    keys = []
+    per_service = []
+    for sid, window in zip(sids, windows):
+        buckets = series_buckets(tier, now - window, now)
+        keys.extend([series_key(sid, resolution, b) for b in buckets])
+        per_service.append(len(buckets))
+    buckets = db.mget(keys)
+    counts = []
+    i = 0
+    for n in per_service:
+        counts.append(sum(len(d) for d in buckets[i:i + n] if d) // size)
+        i += n
+    data = ''.join(d for d in buckets if d)
+    starts = [now - window for window in windows]
+    if resolution:
+        # include the rollup that the window starts in
+        starts = [start - start % resolution for start in starts]
+        return aggregate_rollups(data, counts, starts, aggregates)
+    return aggregate_raw(data, counts, starts, aggregates)
+
+
+RAW_DTYPE = [('ts', '<u4'), ('value', '<f8')]
+ROLLUP_DTYPE = [('ts', '<u4'), ('count', '<u4'), ('sum', '<f8'),
+                ('min', '<f8'), ('max', '<f8')]
+
+
+def window_records(data, counts, starts, dtype):
+    """ Decode the records of all services, which are `counts` records each,
+        and return those at or after their start along with the index of
+        the service that each of them belongs to.
+    """
+    records = numpy.frombuffer(data, dtype)
+    service = numpy.repeat(numpy.arange(len(counts)), counts)
+    keep = records['ts'] >= numpy.repeat(starts, counts)
+    return records[keep], service[keep]
+
+
+def aggregate_raw(data, counts, starts, aggregates):
+    """ Return the percentiles (nearest rank) named by `aggregates` of the
+        raw samples of each service. See window_records.
+    """
+    quantiles = [int(a[1:]) / 100.0 for a in aggregates]
+    if numpy is None:
+        rv = []
+        offset = 0
+        for count, start, q in zip(counts, starts, quantiles):
+            fields = struct.unpack_from('<' + 'Id' * count, data, offset)
+            offset += count * 12
+            # samples are stored in time order
+            i = bisect.bisect_left(fields[0::2], start)
+            values = sorted(fields[1::2][i:])
+            rank = max(int(math.ceil(q * len(values))) - 1, 0)
+            rv.append(values[rank] if values else float('nan'))
+        return rv
+
+    records, service = window_records(data, counts, starts, RAW_DTYPE)
+    values = records['value']
+    n = numpy.bincount(service, minlength=len(counts))
+    begins = numpy.cumsum(n) - n
+    ranks = numpy.ceil(numpy.array(quantiles) * n).astype(int) - 1
+    rv = numpy.full(len(counts), numpy.nan)
+    # Sort the values of all services having the same number of them at
+    # once, as the rows of a matrix. There are few distinct numbers, as
+    # services tend to report at a fixed interval.
+    for count in numpy.unique(n[n > 0]):
+        i = numpy.nonzero(n == count)[0]
+        rows = numpy.sort(values[begins[i, None] + numpy.arange(count)],
+                          axis=1)
+        rv[i] = rows[numpy.arange(len(i)), ranks[i]]
+    return rv.tolist()
+
+
+def aggregate_rollups(data, counts, starts, aggregates):
+    """ Return the 'avg', 'min' or 'max' of the minute rollups of each
+        service. See window_records.
+    """
+    if numpy is None:
+        rv = []
+        offset = 0
+        for count, start, aggregate in zip(counts, starts, aggregates):
+            fields = struct.unpack_from('<' + 'IIddd' * count, data, offset)
+            offset += count * 32
+            i = bisect.bisect_left(fields[0::5], start)
+            if i == count:
+                rv.append(float('nan'))
+            elif aggregate == 'avg':
+                rv.append(sum(fields[2::5][i:]) / sum(fields[1::5][i:]))
+            elif aggregate == 'min':
+                rv.append(min(fields[3::5][i:]))
+            else:
+                rv.append(max(fields[4::5][i:]))
+        return rv
+
+    records, service = window_records(data, counts, starts, ROLLUP_DTYPE)
+    size = len(counts)
+    n = numpy.bincount(service, minlength=size)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        avg = numpy.bincount(service, records['sum'], minlength=size) / \
+            numpy.bincount(service, records['count'], minlength=size)
+    lo = numpy.full(size, numpy.nan)
+    hi = numpy.full(size, numpy.nan)
+    if len(records):
+        # the records of each service are contiguous
+        begins = (numpy.cumsum(n) - n)[n > 0]
+        lo[n > 0] = numpy.minimum.reduceat(records['min'], begins)
+        hi[n > 0] = numpy.maximum.reduceat(records['max'], begins)
+    columns = {'avg': avg.tolist(), 'min': lo.tolist(), 'max': hi.tolist()}
+    return [columns[a][i] for i, a in enumerate(aggregates)]
+
+
+def upgrade_label_index(db):
+    """ Turn the label indexes into sorted sets, if a previous version
+        stored them as plain sets.
+    """
+    def upgrade(key):
+        if db.type(key) != 'set':
+            return
+        members = list(db.smembers(key))
+        with db.pipeline() as pipe:
+            pipe.delete(key)
+            for chunk in chunks(members, BATCH_SIZE):
+                pipe.zadd(key, *[x for member in chunk for x in (0, member)])
+            pipe.execute()
+    upgrade('lb:labels')
+    for lbl in ['all'] + db.zrange('lb:labels', 0, -1):
+        upgrade('lb:services:%s' % lbl)
+
+
+def reindex_all(now):
+    """ Rebuild the label, deadline and status indexes from all services.
+        Only needed when upgrading from a version without them.
+    """
+    if app.config['SHARDS']:
+        # configured labels are stored on the default instance
+        upgrade_label_index(conn())
+    for db in all_shards():
+        upgrade_label_index(db)
+        sids = db.zrange("lb:services:all", 0, -1)
+        for chunk in chunks(sids, BATCH_SIZE):
+            advance_services(db, chunk, now, reindex=True)
+
+
+def migrate_all(now):
+    """ Store all service configs and states using the configured
+        SERIALIZER. Services are converted as they are triggered anyway,
+        so this is only needed for the ones that aren't.
+    """
+    def migrate(pipe, sid, conf, state):
+        if conf and state:
+            pipe.hmset("lb:s:%s" % sid, {"conf": pack(unpack_config(conf)),
+                                          "state": pack(unpack(state))})
+    for db in all_shards():
+        sids = db.zrange("lb:services:all", 0, -1)
+        for chunk in chunks(sids, BATCH_SIZE):
+            update_services(db, chunk, migrate)
+
+
+def evaluator_tick(func=evaluate):
+    with app.test_request_context():
+        app.preprocess_request()
+        func(get_ts())
+
+
+def run_evaluator(interval):
+    """ Evaluate all services every `interval` seconds, forever. Run this
+        in a separate process, and set INLINE_EVAL to False in the web
+        servers so that they never write when serving dashboards.
+    """
+    while 1:
+        started = time.time()
+        try:
+            evaluator_tick()
+        except Exception:
+            # deadlines must go on being processed
+            app.logger.exception("evaluation failed")
+        time.sleep(max(0, interval - (time.time() - started)))
+
+
+def set_etag(resp, etag, weak=False):
+    # werkzeug writes weak ETags with a lowercase w/
+    resp.headers['ETag'] = ('W/"%s"' if weak else '"%s"') % etag
+    return resp
+
+
+def not_modified(etag, weak=False):
+    return set_etag(Response(status=304), etag, weak)
+
+
+def cached(weak=False):
+    """ Serve a dashboard of a label with the version of the label as its
+        ETag (see label_version), or 304 Not Modified if the client has that
+        version already. With RESPONSE_CACHE, the rendered response is
+        reused while the version stays the same. Dashboards that show the
+        age of the heartbeats have weak ETags, as the ages change anyway.
+        Streamed responses are passed through.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(lbl):
+            if request.args.get('stream'):
+                return func(lbl)
+            now = get_ts()
+            evaluate_inline(now)
+            etag = str(label_version(lbl))
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag, weak)
+            ttl = app.config['RESPONSE_CACHE']
+            key = (func.__name__, lbl)
+            entry = response_cache.get(key)
+            if ttl and entry and entry[0] == etag and entry[1] > now:
+                resp = Response(entry[2], headers=entry[3])
+            else:
+                resp = make_response(func(lbl))
+                if ttl:
+                    if len(response_cache) >= MAX_CACHED_RESPONSES:
+                        response_cache.clear()
+                    response_cache[key] = (etag, now + ttl, resp.data,
+                                           list(resp.headers))
+            return set_etag(resp, etag, weak)
+        return wrapper
+    return decorator
+
+
+# not cached, as the page counts the ages of the heartbeats on from `now`
+@app.route("/dashboard/<path:lbl>/", methods = ["GET"])
+def get_list(lbl):
+    now = get_ts()
+    services = read_services(lbl, now)
 
     has_warnings = len([s for s in services if s['state']['status'] == 'warning']) > 0
     has_errors = len([s for s in services if s['state']['status'] == 'error']) > 0
-    services.sort(lambda a, b: cmp(a['id'], b['id']))
+    with timing('render'):
+        return render_template("dashboardui.html", services=services,
+                               has_warnings=has_warnings,
+                               has_errors=has_errors,
+                               lbl=lbl, now=now)
+
 
-    return render_template("dashboardui.html", services=services,
-                           has_warnings=has_warnings,
-                           has_errors=has_errors,
-                           lbl=lbl)
+def all_labels(dbs):
+    """ Return the names of all labels, sorted, with "all" first. The labels
+        of services are read from the shards `dbs`, and configured labels
+        from the default instance.
+    """
+    labels = set(read_conn().zrange('lb:labels', 0, -1))
+    if app.config['SHARDS']:
+        for names in fan_out(lambda db: db.zrange('lb:labels', 0, -1), dbs):
+            labels.update(names)
+    labels.discard('all')
+    return ['all'] + sorted(labels, key=lambda lbl: lbl.upper())
 
 
 @app.route("/dashboard/", methods = ["GET"])
 def list_labels():
-    labels = list(g.db.smembers('lb:labels'))
-    labels.sort(lambda a, b: cmp(a.upper(), b.upper()))
-    return render_template("list_labels.html",
-                           labels=labels)
+    """ An overview of the labels, with their number of services and worst
+        status. Only the label and status indexes are read.
+    """
+    if app.config['INLINE_EVAL']:
+        evaluate(get_ts())
+    dbs = read_shards()
+    labels = all_labels(dbs)
+    overview = []
+    for lbl, summary in zip(labels, label_summaries(labels, dbs)):
+        overview.append({'name': lbl, 'size': sum(summary.values()),
+                         'status': worst_status(summary),
+                         'summary': summary})
+    return render_template("list_labels.html", labels=overview)
+
 
+RAW_STATUS = {'ok': 'OK', 'warning': 'WARN', 'error': 'ERROR',
+              'maint': 'MAINT'}
 
-@app.route("/dashboard/<lbl>/raw", methods = ["GET"])
+
+@app.route("/dashboard/<path:lbl>/raw", methods = ["GET"])
+@cached()
 def get_list_raw(lbl):
     now = get_ts()
-    services = get_services(lbl)
-    for service in services:
-        eval_service(service, now)
+    if request.args.get('stream'):
+        services = stream_services(lbl, now)
+
+        def generate():
+            seen = set()
+            for service in services:
+                status = service['state']['status']
+                seen.add(status)
+                yield "[%s] %s\n" % (RAW_STATUS.get(status, 'INTERNAL ERROR'),
+                                     service['id'])
+            yield "\nwarnings: %s\n" % ('warning' in seen)
+            yield "errors: %s\n" % ('error' in seen)
+            yield "maint: %s\n" % ('maint' in seen)
+            yield "all good: %s" % (not seen & set(['warning', 'error']))
+        return Response(stream_with_context(generate()),
+                        mimetype='text/plain')
+
+    services = read_services(lbl, now)
 
     has_warnings = len([s for s in services if s['state']['status'] == 'warning']) > 0
     has_errors = len([s for s in services if s['state']['status'] == 'error']) > 0
     has_maint = len([s for s in services if s['state']['status'] == 'maint']) > 0
-    services.sort(lambda a, b: cmp(a['id'], b['id']))
-    html = render_template("dashboard.html", services=services,
-                           has_warnings=has_warnings,
-                           has_errors=has_errors,
-                           has_maint=has_maint)
+    with timing('render'):
+        html = render_template("dashboard.html", services=services,
+                               has_warnings=has_warnings,
+                               has_errors=has_errors,
+                               has_maint=has_maint)
     resp = make_response(html)
     resp.headers["Content-type"] = "text/plain"
     return resp
 
 
-@app.route("/dashboard/<lbl>/status", methods = ["GET"])
-def show_short(lbl):
-    now = get_ts()
-    services = get_services(lbl)
-    for service in services:
-        eval_service(service, now)
+SHORT_STATUS = {'error': 'down+error', 'warning': 'down+warning',
+                'maint': 'up+maint', 'ok': 'up+flawless', None: 'up+flawless'}
 
-    has_warnings = len([s for s in services if s['state']['status'] == 'warning']) > 0
-    has_errors = len([s for s in services if s['state']['status'] == 'error']) > 0
-    has_maint = len([s for s in services if s['state']['status'] == 'maint']) > 0
 
-    if has_errors:
-        s = "down+error"
-    elif has_warnings:
-        s = "down+warning"
-    elif has_maint:
-        s = "up+maint"
-    else:
-        s = "up+flawless"
+@app.route("/dashboard/<path:lbl>/status", methods = ["GET"])
+def show_short(lbl):
+    if app.config['INLINE_EVAL']:
+        evaluate(get_ts())
+    s = SHORT_STATUS[worst_status(label_summary(lbl))]
 
     resp = make_response(s)
     resp.headers["Content-type"] = "text/plain"
     return resp
 
 
-@app.route("/dashboard/<lbl>/json", methods = ["GET"])
+def metric_value(value):
+    """ Escape a label value of a metric. """
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def generate_metrics(now):
+    """ Yield the output of /metrics in chunks. It is read from the indexes
+        only: the counts of the status indexes of the labels, the status
+        indexes of the services that aren't ok, and lb:last.
+    """
+    dbs = read_shards()
+    lbls = all_labels(dbs)
+    lines = ["# HELP lovebeat_services Services in a label, per status.\n",
+             "# TYPE lovebeat_services gauge\n"]
+    for lbl, summary in zip(lbls, label_summaries(lbls, dbs)):
+        for status in STATUSES:
+            lines.append('lovebeat_services{label="%s",status="%s"} %d\n'
+                         % (metric_value(lbl), status, summary[status]))
+    yield ''.join(lines)
+
+    yield ("# HELP lovebeat_service_heartbeat_age_seconds Seconds since the "
+           "last heartbeat.\n"
+           "# TYPE lovebeat_service_heartbeat_age_seconds gauge\n")
+    statuses = {}
+    for db in dbs:
+        # only the services that aren't ok are read from the status indexes
+        failing = {}
+        with db.pipeline(False) as pipe:
+            for status in STATUSES[1:]:
+                pipe.zrange("lb:status:all:%s" % status, 0, -1)
+            for status, sids in zip(STATUSES[1:], pipe.execute()):
+                failing.update((sid, status) for sid in sids)
+        cursor = 0
+        while 1:
+            cursor, items = db.execute_command("HSCAN", "lb:last", cursor,
+                                               "COUNT", BATCH_SIZE)
+            lines = []
+            for sid, ts in chunks(items, 2):
+                # HSCAN may return an entry more than once
+                if sid in statuses:
+                    continue
+                statuses[sid] = failing.get(sid, 'ok')
+                lines.append('lovebeat_service_heartbeat_age_seconds'
+                             '{service="%s"} %d\n'
+                             % (metric_value(sid), now - int(ts)))
+            yield ''.join(lines)
+            if int(cursor) == 0:
+                break
+
+    yield ("# HELP lovebeat_service_status The status of a service.\n"
+           "# TYPE lovebeat_service_status gauge\n")
+    for sids in chunks(statuses.keys(), BATCH_SIZE):
+        yield ''.join('lovebeat_service_status{service="%s",status="%s"} 1\n'
+                      % (metric_value(sid), statuses[sid]) for sid in sids)
+
+
+@app.route("/metrics", methods = ["GET"])
+def metrics():
+    """ The number of services per label and status, and the age of the
+        last heartbeat and the status of every service, for Prometheus.
+        The output is reused for METRICS_CACHE seconds, if set.
+    """
+    global metrics_cache
+    now = get_ts()
+    if 'application/openmetrics-text' in request.headers.get('Accept', ''):
+        mimetype = 'application/openmetrics-text; version=1.0.0'
+        end = ['# EOF\n']
+    else:
+        mimetype = 'text/plain; version=0.0.4'
+        end = []
+    ttl = app.config['METRICS_CACHE']
+    if not ttl:
+        if app.config['INLINE_EVAL']:
+            evaluate(now)
+        return Response(stream_with_context(
+            itertools.chain(generate_metrics(now), end)), mimetype=mimetype)
+    with metrics_lock:
+        if metrics_cache is None or metrics_cache[0] + ttl <= now:
+            if app.config['INLINE_EVAL']:
+                evaluate(now)
+            metrics_cache = (now, ''.join(generate_metrics(now)))
+        output = metrics_cache[1]
+    return Response([output] + end, mimetype=mimetype)
+
+
+@app.route("/dashboard/<path:lbl>/json", methods = ["GET"])
+@cached(weak=True)
 def get_list_json(lbl):
     now = get_ts()
-    services = get_services(lbl)
+    if request.args.get('stream'):
+        services = stream_services(lbl, now)
+
+        def generate():
+            sep = '\n'
+            yield '{"services": ['
+            for service in services:
+                yield sep + json.dumps(service)
+                sep = ',\n'
+            yield '\n]}\n'
+        return Response(stream_with_context(generate()),
+                        mimetype='application/json')
+    services = read_services(lbl, now)
+    with timing('render'):
+        return jsonify(services=services)
+
+
+@app.route("/dashboard/<path:lbl>/ndjson", methods = ["GET"])
+def get_list_ndjson(lbl):
+    services = stream_services(lbl, get_ts())
+
+    def generate():
+        for service in services:
+            yield json.dumps(service) + '\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+@timed('list_services')
+def list_services(lbl, statuses, prefix='', after=None, limit=PAGE_SIZE):
+    """ Return up to `limit` services in the label having any of `statuses`
+        and an id starting with `prefix`, ordered by id and starting after
+        the id `after`. Also returns the id to continue after, or None if
+        this was the last page.
+    """
+    lo = "(" + after if after is not None else "[" + prefix
+    hi = "[" + prefix + "\xff" if prefix else "+"
+
+    def read_index(db):
+        with db.pipeline(False) as pipe:
+            for status in statuses:
+                pipe.execute_command("ZRANGEBYLEX",
+                                     "lb:status:%s:%s" % (lbl, status),
+                                     lo, hi, "LIMIT", 0, limit + 1)
+            return [(sid, db) for page in pipe.execute() for sid in page]
+    # the shards of the services, merged by id
+    found = dict(entry for page in fan_out(read_index, all_shards())
+                 for entry in page)
+    sids = sorted(found)
+    more = len(sids) > limit
+    sids = sids[:limit]
+    last = sids[-1] if more else None
+
+    def load(group):
+        db, sids = group
+        with db.pipeline(False) as pipe:
+            for sid in sids:
+                pipe.hmget("lb:s:%s" % sid, "conf", "state")
+            return dict(zip(sids, pipe.execute()))
+    groups = {}
+    for sid in sids:
+        db = found[sid]
+        groups.setdefault(id(db.connection_pool), (db, []))[1].append(sid)
+    loaded = {}
+    for services in fan_out(load, groups.values()):
+        loaded.update(services)
+    services = [{'id': sid,
+                 'config': unpack_config(loaded[sid][0]),
+                 'state': unpack(loaded[sid][1])}
+                for sid in sids if loaded[sid][1]]
+    return services, last
+
+
+@app.route("/dashboard/<path:lbl>/list", methods = ["GET"])
+def get_list_page(lbl):
+    """ A page of services, optionally filtered by 'status' (comma-separated)
+        and by id 'prefix'. Pass the returned 'cursor' to get the next page.
+    """
+    now = get_ts()
+    statuses = request.args.get('status', ','.join(STATUSES)).split(',')
+    if not set(statuses) <= set(STATUSES):
+        abort(400)
+    try:
+        limit = min(int(request.args.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+        after = request.args.get('cursor')
+        if after is not None:
+            after = base64.urlsafe_b64decode(str(after))
+    except (ValueError, TypeError):
+        abort(400)
+    if limit < 1:
+        abort(400)
+
+    if app.config['INLINE_EVAL']:
+        evaluate(now)
+    prefix = request.args.get('prefix', '').encode('utf-8')
+    services, last = list_services(lbl, statuses, prefix, after, limit)
     for service in services:
-        eval_service(service, now)
-    return jsonify(services=services)
+        set_delta(service, now)
+    cursor = None
+    if last is not None:
+        cursor = base64.urlsafe_b64encode(last)
+    return jsonify(services=services, cursor=cursor)
 
 
 @app.route("/", methods = ["GET"])
@@ -418,11 +2351,12 @@ def index():
     return redirect(url_for('.get_list', lbl='all'))
 
 
-def get_labels():
+def get_labels(db=None):
     fields = ("#", "lb:l:*->config")
     labels = {}
+    db = db or read_conn()
     for lbl, config in \
-            chunks(g.db.sort("lb:labels", by="nosort", get=fields), 2):
+            chunks(db.sort("lb:labels", by="nosort", get=fields), 2):
         if config:
             labels[lbl] = json.loads(config)
     return labels
@@ -435,98 +2369,270 @@ def plain(t):
 @app.route("/agent/<agent>/claim/<service>/<int:alert_id>/<status>",
            methods = ["POST"])
 def claim(agent, service, alert_id, status):
-    def trans(pipe):
-        state = load_service_state(pipe, service)
-        # claiming an old alert - a race condition.
-        if state['alert']['id'] != alert_id:
-            return plain("already_claimed")
-        if state['alert']['status'] != status:
-            return plain("already_claimed")
-        # Already claimed?
-        if state['alert']['state'] == 'claimed':
-            if state['alert']['claim']['agent'] == agent:
-                return plain("ok")
-            else:
-                return plain("already_claimed")
-        elif state['alert']['state'] != 'new':
-            return plain('already_claimed')
-        pipe.multi()
-        state['alert']['state'] = 'claimed'
-        state['alert']['claim'] = {'agent': agent}
-        pipe.hset('lb:s:%s' % service, 'state', json.dumps(state))
-        return plain("ok")
-    return rvtrans(g.db, trans, 'lb:s:%s' % service)
+    """ Claim an alert for the agent, so that no other agent sends it. A
+        claim that hasn't been confirmed within CLAIM_TIMEOUT seconds can
+        be taken over by another agent.
+    """
+    db = shard(service)
+    reply = run_script('claim.lua', db, keys=['lb:s:%s' % service],
+                       args=[agent, alert_id, status, get_ts(),
+                             app.config['CLAIM_TIMEOUT'],
+                             app.config['SERIALIZER']])
+    if reply == 'ok':
+        bump_service(db, service)
+    return plain(reply)
 
 
 @app.route("/agent/<agent>/confirm/<service>/<int:alert_id>/<status>",
            methods = ["POST"])
 def confirm(agent, service, alert_id, status):
-    def trans(pipe):
-        state = load_service_state(pipe, service)
-        # confirming an old alert - a race condition.
-        if state['alert']['state'] in ('new', 'claimed') and \
-                state['alert']['id'] == alert_id and \
-                state['alert']['status'] == status:
-            pass
-        # confirming an already confirmed alert - client retrying?
-        elif state['alert']['state'] == 'confirmed' and \
-                state['alert']['id'] == alert_id and \
-                state['alert']['status'] == status:
-            return plain('ok')
-        else:
-            return plain('already_confirmed')
-        pipe.multi()
-        state['alert']['state'] = 'confirmed'
-        state['alert']['confirmed'] = {'agent': agent}
-        pipe.hset('lb:s:%s' % service, 'state', json.dumps(state))
-        return plain("ok")
-    return rvtrans(g.db, trans, 'lb:s:%s' % service)
+    """ Confirm that an alert has been sent. This also acknowledges its
+        entry in the feed, see alert_feed.
+    """
+    db = shard(service)
+    reply = run_script('confirm.lua', db,
+                       keys=['lb:s:%s' % service, 'lb:alerts',
+                             'lb:alerts:entries', 'lb:deadlines'],
+                       args=[service, agent, alert_id, status, get_ts(),
+                             app.config['SERIALIZER']])
+    if reply == 'ok':
+        bump_service(db, service)
+    return plain(reply)
+
+
+def bump_service(db, sid):
+    """ Bump the versions of the labels of a service after its alert has
+        been claimed or confirmed.
+    """
+    conf_present, conf = load_service_config(db, sid)
+    with db.pipeline(False) as pipe:
+        bump_versions(pipe, service_labels(conf))
+        pipe.execute()
+
+
+def load_routing():
+    """ Return the recipients of the alerts of every configured label, as
+        a dict of status -> frozenset per label, and a dict remembering the
+        recipients of the label sets of services, see gather_rcpt. They are
+        only read again once a label has been configured.
+    """
+    global routing
+    # the version and the labels are read from the same replica
+    db = read_conn()
+    version = db.get("lb:labels:version")
+    if routing is None or routing[0] != version:
+        table = {}
+        for lbl, config in get_labels(db).items():
+            table[lbl] = dict((status, frozenset(rcpt))
+                              for status, rcpt in config['alerts'].items())
+        routing = (version, table, {})
+    return routing[1:]
+
+
+def gather_rcpt(routes, labels, status):
+    """ Return the recipients of an alert of a service with some labels.
+        The recipients of the ancestors of the labels are included, see
+        expand_labels. `routes` is returned by load_routing.
+    """
+    table, memo = routes
+    key = (tuple(labels), status)
+    rcpt = memo.get(key)
+    if rcpt is None:
+        rcpt = set()
+        for lbl in expand_labels(labels + ["all"]):
+            config = table.get(lbl)
+            if config:
+                rcpt.update(config[status])
+        rcpt = list(rcpt)
+        if len(memo) >= MAX_ROUTES:
+            memo.clear()
+        memo[key] = rcpt
+    return rcpt
+
+
+def format_alert(sid, alert_id, status, rcpt):
+    return ("SERVICE\n%s\n" % sid +
+            "ALERTID\n%s\n" % alert_id +
+            "TYPE\n%s\n" % status +
+            "TO\n%s\n" % (" ".join(rcpt),) +
+            "SUBJECT\nDOWN alert: %s is DOWN [#%d]\n" % (sid, alert_id) +
+            "MESSAGE\n" +
+            "%s is down with %s status.\n" % (sid, status) +
+            "\nYours Sincerely\nLovebeat\nEOF\n" +
+            "ENDSERVICE\n")
 
 
 @app.route("/agent/<agent>/alerts.txt", methods = ["GET"])
 def alerts_txt(agent):
     now = get_ts()
-    services = get_services("all")
-    label_configs = get_labels()
+    services = read_services("all", now)
+    routes = load_routing()
 
     def generate():
-        def gather_rcpt(labels, status):
-            rcpt = set()
-            for lbl in labels + ["all"]:
-                config = label_configs.get(lbl)
-                if config:
-                    rcpt.update(set(config['alerts'][status]))
-            return list(rcpt)
-
         # API version
         yield '1\n'
 
         for service in services:
-            eval_service(service, now)
             if service['state']['status'] in ('warning', 'error'):
                 status = service['state']['status']
-                rcpt = gather_rcpt(service['config']['labels'], status)
+                rcpt = gather_rcpt(routes, service['config']['labels'],
+                                   status)
                 if not rcpt:
                     continue
-                sid = service['id']
-                alert_id = service['state']['alert']['id']
-                yield "SERVICE\n%s\n" % sid
-                yield "ALERTID\n%s\n" % alert_id
-                yield "TYPE\n%s\n" % status
-                yield "TO\n%s\n" % (" ".join(rcpt),)
-                yield "SUBJECT\nDOWN alert: %s is DOWN [#%d]\n" % (sid, alert_id)
-                yield "MESSAGE\n"
-                yield "%s is down with %s status.\n" % (sid, status)
-                yield "\nYours Sincerely\nLovebeat\nEOF\n"
-                yield "ENDSERVICE\n"
+                yield format_alert(service['id'],
+                                   service['state']['alert']['id'],
+                                   status, rcpt)
 
         yield "ENDFILE\n"
     return Response(stream_with_context(generate()), mimetype='text/plain')
 
 
+def parse_entries(db, entries):
+    # entries that have been trimmed from the stream have no fields
+    return [(db, entry[0], dict(zip(entry[1][::2], entry[1][1::2])))
+            for entry in entries if entry and entry[1]]
+
+
+def read_alert_feed(agent, wait, count=BATCH_SIZE):
+    """ Return up to `count` entries of the alert feed, as (shard, entry id,
+        fields). Entries are pending until their alerts are confirmed, and
+        entries that have been pending for more than CLAIM_TIMEOUT seconds,
+        as their agent may have died, are handed out again before any new
+        ones. If there are none, waits up to `wait` seconds for a new one.
+        Each shard has a feed of its own. When there are several, they are
+        polled every second while waiting.
+    """
+    dbs = all_shards()
+    entries = []
+    for db in dbs:
+        try:
+            db.execute_command("XGROUP", "CREATE", "lb:alerts", "agents", "0",
+                               "MKSTREAM")
+        except redis.ResponseError as e:
+            if not str(e).startswith("BUSYGROUP"):
+                raise
+        if len(entries) < count:
+            reply = db.execute_command("XAUTOCLAIM", "lb:alerts", "agents",
+                                       agent,
+                                       app.config['CLAIM_TIMEOUT'] * 1000,
+                                       "0-0", "COUNT", count - len(entries))
+            entries.extend(parse_entries(db, reply[1]))
+    if entries:
+        return entries
+    deadline = time.time() + wait
+    while 1:
+        for db in dbs:
+            args = ["GROUP", "agents", agent, "COUNT", count - len(entries)]
+            reader = db
+            if len(dbs) == 1 and wait:
+                args += ["BLOCK", wait * 1000]
+                reader = untimed(db)
+            reply = reader.execute_command("XREADGROUP", *(args + [
+                "STREAMS", "lb:alerts", ">"]))
+            if reply:
+                entries.extend(parse_entries(db, reply[0][1]))
+            if len(entries) >= count:
+                break
+        if entries or len(dbs) == 1 or time.time() >= deadline:
+            return entries
+        time.sleep(min(1, deadline - time.time()))
+
+
+@app.route("/agent/<agent>/feed.txt", methods = ["GET"])
+def alert_feed(agent):
+    """ Like alerts.txt, but only with the alerts that have become new
+        since they were last read, by any agent, and those that were read
+        or claimed but not confirmed within CLAIM_TIMEOUT seconds. If there
+        are none, waits for up to 'wait' seconds (default: 30) for one, and
+        returns at most 'count' alerts. Agents sharing the work must use
+        different names, and still have to claim the alerts.
+    """
+    try:
+        wait = min(int(request.args.get('wait', 30)), MAX_FEED_WAIT)
+        count = min(int(request.args.get('count', BATCH_SIZE)), BATCH_SIZE)
+    except ValueError:
+        abort(400)
+    if count < 1:
+        abort(400)
+    now = get_ts()
+    if app.config['INLINE_EVAL']:
+        evaluate(now)
+    entries = read_alert_feed(agent, max(wait, 0), count)
+    loaded = {}
+    for db, sids in group_by_shard(set(fields['service']
+                                       for _, _, fields in entries)):
+        with db.pipeline(False) as pipe:
+            for sid in sids:
+                pipe.hmget("lb:s:%s" % sid, "conf", "state")
+            loaded.update(zip(sids, pipe.execute()))
+    routes = load_routing() if entries else None
+
+    alerts = []
+    handled = {}
+    stored = {}
+    for db, entry_id, fields in entries:
+        sid = fields['service']
+        conf, state = loaded[sid]
+        alert = unpack(state)['alert'] if state else None
+        if not alert or alert['state'] == 'confirmed' or \
+                alert['id'] != int(fields['id']) or \
+                alert['status'] != fields['status']:
+            handled.setdefault(id(db), (db, []))[1].append(entry_id)
+            continue
+        # another agent is still working on it
+        if alert['state'] == 'claimed' and \
+                alert['claim']['agent'] != agent and \
+                alert['claim'].get('ts', now) + \
+                app.config['CLAIM_TIMEOUT'] > now:
+            continue
+        rcpt = gather_rcpt(routes, unpack_config(conf)['labels'],
+                           alert['status'])
+        if not rcpt:
+            # nobody will confirm it
+            handled.setdefault(id(db), (db, []))[1].append(entry_id)
+            continue
+        # confirm.lua acknowledges the entry. If the alert is confirmed
+        # before this is stored, the entry is acknowledged above when it is
+        # handed out again.
+        stored.setdefault(id(db), (db, {}))[1][sid] = entry_id
+        alerts.append(format_alert(sid, alert['id'], alert['status'], rcpt))
+    for db, entry_ids in handled.values():
+        db.execute_command("XACK", "lb:alerts", "agents", *entry_ids)
+    for db, entry_ids in stored.values():
+        db.hmset("lb:alerts:entries", entry_ids)
+
+    def generate():
+        # API version
+        yield '1\n'
+        for alert in alerts:
+            yield alert
+        yield "ENDFILE\n"
+    return Response(generate(), mimetype='text/plain')
+
+
 if app.debug:
     logging.basicConfig(level=logging.DEBUG)
 
+# fail at startup rather than on the first request
+for urls in app.config['SHARDS'], app.config['PREVIOUS_SHARDS']:
+    if urls:
+        get_ring(urls)
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=18000,
-            debug = True, threaded = True)
+    if '--reindex' in sys.argv[1:]:
+        evaluator_tick(reindex_all)
+    elif '--migrate' in sys.argv[1:]:
+        evaluator_tick(migrate_all)
+    elif '--rebalance' in sys.argv[1:]:
+        logging.basicConfig(level=logging.INFO)
+        evaluator_tick(rebalance)
+    elif '--evaluator' in sys.argv[1:]:
+        if app.config['STORAGE'] == 'memory':
+            sys.exit("the memory store can only be used by one process; "
+                     "set INLINE_EVAL instead")
+        logging.basicConfig(level=logging.INFO)
+        run_evaluator(app.config['EVAL_INTERVAL'])
+    else:
+        exit_on_sigterm()
+        app.run(host='0.0.0.0', port=18000,
+                debug = True, threaded = True)
@@ -0,0 +1,43 @@
+"""Serves lovebeat from a single process using gevent.
+
+Every request runs in a greenlet instead of a thread, and the redis
+connections are made non-blocking by gevent's monkey patching, so thousands
+of agents reporting at the same time only cost a greenlet and a pooled
+connection each. All routes are the same as when running lovebeat.py.
+
+    $ pip install gevent
+    $ python lovebeat_gevent.py --port 18000
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+import optparse
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+import lovebeat
+
+
+def serve(host, port, max_clients):
+    server = WSGIServer((host, port), lovebeat.app,
+                        spawn=Pool(max_clients), log=None)
+    server.serve_forever()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', default='0.0.0.0')
+    parser.add_option('--port', type='int', default=18000)
+    parser.add_option('--max-clients', type='int', default=10000,
+                      help='maximum number of concurrent requests')
+    opts, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    lovebeat.exit_on_sigterm()
+    serve(opts.host, opts.port, opts.max_clients)
+
+
+if __name__ == '__main__':
+    main()
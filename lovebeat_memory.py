@@ -0,0 +1,1516 @@
+"""Stores lovebeat's data in the memory of the lovebeat process.
+
+For small deployments, and for running the tests, lovebeat can do without a
+redis server:
+
+    STORAGE = 'memory'
+    MEMORY_LOG = '/var/lib/lovebeat/lovebeat.log'
+
+MemoryStore implements the commands of redis-py's StrictRedis that lovebeat
+uses, with the same replies, so the rest of lovebeat doesn't know which one
+it talks to. The server-side scripts in lua/ are run by their python
+versions below, which work on the data directly. Every command holds the
+same lock, which makes pipelines, transactions and scripts atomic, as they
+are on redis. Only one process can use a store, so the evaluator must run
+inline (see INLINE_EVAL), and the services can't be sharded.
+
+Every write, or script call, is appended to MEMORY_LOG, if set, which is
+replayed when starting. The log is rewritten as a snapshot of all data when
+starting, and whenever it has grown to COMPACT_RATIO times the size of the
+last snapshot.
+"""
+import bisect
+import contextlib
+import cPickle as pickle
+import fnmatch
+import hashlib
+import heapq
+import json
+import os
+import Queue
+import struct
+import threading
+import time
+
+import redis
+from redis.client import Script
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+LUA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lua')
+# the log is compacted when it has grown this many times larger than the last
+# snapshot, and is at least MIN_COMPACT_SIZE bytes.
+COMPACT_RATIO = 2
+MIN_COMPACT_SIZE = 64 * 1024 * 1024
+# stream entries above MAXLEN before the stream is trimmed, see XADD
+TRIM_SLACK = 100
+# commands that are written to the log as they are. See cmd_expire, cmd_xadd,
+# cmd_xgroup and deliver for those that are logged in another form.
+WRITES = frozenset(['SET', 'APPEND', 'SETRANGE', 'INCRBY', 'DEL', 'PEXPIREAT',
+                    'HSET', 'HMSET', 'HINCRBY', 'HDEL', 'SADD', 'SREM', 'ZADD',
+                    'ZREM', 'LPUSH', 'LTRIM', 'XACK', 'XDELIVER', 'FLUSHDB'])
+
+
+def encode(value):
+    """ Convert an argument to a string, like redis-py does. """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def redis_slice(start, end):
+    """ The python slice of an inclusive range, like LRANGE takes. """
+    end = int(end)
+    return slice(int(start), end + 1 if end != -1 else None)
+
+
+def apply_limit(items, options):
+    """ Apply the LIMIT offset count among the options of a command. """
+    upper = [option.upper() for option in options]
+    if 'LIMIT' not in upper:
+        return items
+    i = upper.index('LIMIT')
+    offset, count = int(options[i + 1]), int(options[i + 2])
+    return items[offset:offset + count if count >= 0 else None]
+
+
+def list_or_args(keys, args):
+    if isinstance(keys, (basestring, int, long)):
+        keys = [keys]
+    return list(keys) + list(args)
+
+
+def error(message):
+    return redis.ResponseError(message)
+
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+class Top(object):
+    """ Sorts after all members, for bisecting past the members of a score.
+    """
+    def __cmp__(self, other):
+        return 0 if isinstance(other, Top) else 1
+
+TOP = Top()
+
+
+def parse_score(value):
+    """ Return a ZRANGEBYSCORE bound as (score, exclusive). """
+    if value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+class SortedSet(object):
+    """ The members of a sorted set, ordered by (score, member) in runs of
+        at most 2 * RUN items, so that adding or removing a member only
+        moves the items of its run.
+    """
+    RUN = 256
+
+    def __init__(self):
+        self.scores = {}
+        self.runs = []
+        # the last item of each run
+        self.lasts = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self):
+        for run in self.runs:
+            for item in run:
+                yield item
+
+    def __getstate__(self):
+        return {'scores': self.scores}
+
+    def __setstate__(self, state):
+        # snapshots of older versions also have all items in one list
+        self.__init__()
+        self.scores = state['scores']
+        items = sorted((score, member)
+                       for member, score in self.scores.iteritems())
+        for i in xrange(0, len(items), self.RUN):
+            self.runs.append(items[i:i + self.RUN])
+            self.lasts.append(self.runs[-1][-1])
+
+    def insert(self, item):
+        i = bisect.bisect_left(self.lasts, item)
+        if i == len(self.runs):
+            if not self.runs:
+                self.runs.append([item])
+                self.lasts.append(item)
+                return
+            i -= 1
+        run = self.runs[i]
+        bisect.insort(run, item)
+        self.lasts[i] = run[-1]
+        if len(run) > 2 * self.RUN:
+            self.runs[i:i + 1] = [run[:self.RUN], run[self.RUN:]]
+            self.lasts[i:i + 1] = [run[self.RUN - 1], run[-1]]
+
+    def delete(self, item):
+        i = bisect.bisect_left(self.lasts, item)
+        run = self.runs[i]
+        del run[bisect.bisect_left(run, item)]
+        if run:
+            self.lasts[i] = run[-1]
+        else:
+            del self.runs[i]
+            del self.lasts[i]
+
+    def add(self, member, score):
+        old = self.scores.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            self.delete((old, member))
+        self.scores[member] = score
+        self.insert((score, member))
+        return old is None
+
+    def remove(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        self.delete((score, member))
+        return True
+
+    def index(self, item, right=False):
+        """ The position of `item` in the order, like bisect. """
+        find = bisect.bisect_right if right else bisect.bisect_left
+        i = find(self.lasts, item)
+        if i == len(self.runs):
+            return len(self.scores)
+        return sum(len(run) for run in self.runs[:i]) + find(self.runs[i],
+                                                             item)
+
+    def range(self, positions):
+        """ Return the items at the python slice `positions` of the order.
+        """
+        start, stop, step = positions.indices(len(self.scores))
+        items = []
+        for run in self.runs:
+            if stop <= 0:
+                break
+            if start < len(run):
+                items.extend(run[max(start, 0):stop])
+            start -= len(run)
+            stop -= len(run)
+        return items
+
+    def range_by_score(self, lo, hi):
+        lo, lo_exclusive = parse_score(lo)
+        hi, hi_exclusive = parse_score(hi)
+        start = self.index((lo, TOP) if lo_exclusive else (lo,))
+        end = self.index((hi,) if hi_exclusive else (hi, TOP))
+        return self.range(slice(start, end))
+
+    def range_by_lex(self, lo, hi):
+        """ Like ZRANGEBYLEX, assumes that all members have the same score.
+        """
+        if not self.runs:
+            return []
+        score = self.runs[0][0][0]
+
+        def bound(value, high):
+            if value == '-':
+                return 0
+            if value == '+':
+                return len(self.scores)
+            if not value or value[0] not in '[(':
+                raise error("ERR min or max not valid string range item")
+            inclusive = value[0] == '['
+            return self.index((score, value[1:]), right=inclusive == high)
+        start, end = bound(lo, False), bound(hi, True)
+        return [member for score, member in self.range(slice(start, end))]
+
+
+def parse_id(value, seq=0):
+    if value == '-':
+        return (0, 0)
+    if '-' in value:
+        ms, seq = value.split('-', 1)
+        return (int(ms), int(seq))
+    return (int(value), seq)
+
+
+def format_id(entry_id):
+    return '%d-%d' % entry_id
+
+
+class Group(object):
+    """ A consumer group of a stream. `pending` maps the ids of the entries
+        that have been delivered but not acknowledged to [consumer, time of
+        delivery in milliseconds, number of deliveries].
+    """
+    def __init__(self, last):
+        self.last = last
+        self.pending = {}
+
+
+class Stream(object):
+    def __init__(self):
+        self.ids = []
+        self.entries = {}
+        self.last = (0, 0)
+        self.groups = {}
+
+    def __len__(self):
+        # streams with consumer groups exist even when they are empty
+        return len(self.ids) + len(self.groups)
+
+    def reply(self, entry_id):
+        fields = self.entries.get(entry_id)
+        return [format_id(entry_id), fields and list(fields)]
+
+
+# the replies of TYPE
+TYPES = {str: 'string', list: 'list', set: 'set', dict: 'hash',
+         SortedSet: 'zset', Stream: 'stream'}
+
+
+class PubSub(object):
+    """ Like redis-py's PubSub. Messages are put on a queue by publish. """
+    def __init__(self, store):
+        self.store = store
+        self.channels = set()
+        self.patterns = set()
+        self.queue = Queue.Queue()
+
+    def subscribe(self, *args):
+        for channel in list_or_args(args[0], args[1:]):
+            channel = encode(channel)
+            self.channels.add(channel)
+            self.confirm('subscribe', channel)
+        self.store.subscribers.add(self)
+
+    def psubscribe(self, *args):
+        for pattern in list_or_args(args[0], args[1:]):
+            pattern = encode(pattern)
+            self.patterns.add(pattern)
+            self.confirm('psubscribe', pattern)
+        self.store.subscribers.add(self)
+
+    def confirm(self, kind, channel):
+        self.queue.put({'type': kind, 'pattern': None, 'channel': channel,
+                        'data': len(self.channels) + len(self.patterns)})
+
+    def reset(self):
+        self.store.subscribers.discard(self)
+        self.channels.clear()
+        self.patterns.clear()
+        # wake up listen
+        self.queue.put(None)
+
+    def deliver(self, channel, message):
+        if channel in self.channels:
+            self.queue.put({'type': 'message', 'pattern': None,
+                            'channel': channel, 'data': message})
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(channel, pattern):
+                self.queue.put({'type': 'pmessage', 'pattern': pattern,
+                                'channel': channel, 'data': message})
+
+    def listen(self):
+        while self.channels or self.patterns:
+            message = self.queue.get()
+            if message is not None:
+                yield message
+
+
+class Commands(object):
+    """ The methods of redis-py's StrictRedis that lovebeat uses, which are
+        all implemented by execute_command.
+    """
+    def get(self, name):
+        return self.execute_command('GET', name)
+
+    def mget(self, keys, *args):
+        return self.execute_command('MGET', *list_or_args(keys, args))
+
+    def set(self, name, value):
+        return self.execute_command('SET', name, value)
+
+    def incr(self, name, amount=1):
+        return self.execute_command('INCRBY', name, amount)
+
+    def append(self, key, value):
+        return self.execute_command('APPEND', key, value)
+
+    def setrange(self, name, offset, value):
+        return self.execute_command('SETRANGE', name, offset, value)
+
+    def getrange(self, key, start, end):
+        return self.execute_command('GETRANGE', key, start, end)
+
+    def strlen(self, name):
+        return self.execute_command('STRLEN', name)
+
+    def delete(self, *names):
+        return self.execute_command('DEL', *names)
+
+    def exists(self, name):
+        return self.execute_command('EXISTS', name)
+
+    def type(self, name):
+        return self.execute_command('TYPE', name)
+
+    def keys(self, pattern='*'):
+        return self.execute_command('KEYS', pattern)
+
+    def ttl(self, name):
+        return self.execute_command('TTL', name)
+
+    def expire(self, name, time):
+        return self.execute_command('EXPIRE', name, time)
+
+    def flushdb(self):
+        return self.execute_command('FLUSHDB')
+
+    def hget(self, name, key):
+        return self.execute_command('HGET', name, key)
+
+    def hmget(self, name, keys, *args):
+        return self.execute_command('HMGET', name, *list_or_args(keys, args))
+
+    def hset(self, name, key, value):
+        return self.execute_command('HSET', name, key, value)
+
+    def hincrby(self, name, key, amount=1):
+        return self.execute_command('HINCRBY', name, key, amount)
+
+    def hmset(self, name, mapping):
+        items = []
+        for pair in mapping.iteritems():
+            items.extend(pair)
+        return self.execute_command('HMSET', name, *items)
+
+    def hdel(self, name, *keys):
+        return self.execute_command('HDEL', name, *keys)
+
+    def hgetall(self, name):
+        return self.execute_command('HGETALL', name)
+
+    def hkeys(self, name):
+        return self.execute_command('HKEYS', name)
+
+    def sadd(self, name, *values):
+        return self.execute_command('SADD', name, *values)
+
+    def srem(self, name, *values):
+        return self.execute_command('SREM', name, *values)
+
+    def smembers(self, name):
+        return self.execute_command('SMEMBERS', name)
+
+    def scard(self, name):
+        return self.execute_command('SCARD', name)
+
+    def zadd(self, name, *args, **kwargs):
+        pieces = list(args)
+        for member, score in kwargs.iteritems():
+            pieces.extend((score, member))
+        return self.execute_command('ZADD', name, *pieces)
+
+    def zrem(self, name, *values):
+        return self.execute_command('ZREM', name, *values)
+
+    def zcard(self, name):
+        return self.execute_command('ZCARD', name)
+
+    def zrange(self, name, start, end):
+        return self.execute_command('ZRANGE', name, start, end)
+
+    def zscore(self, name, value):
+        return self.execute_command('ZSCORE', name, value)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        args = [name, min, max]
+        if start is not None and num is not None:
+            args.extend(('LIMIT', start, num))
+        if withscores:
+            args.append('WITHSCORES')
+        reply = self.execute_command('ZRANGEBYSCORE', *args)
+        if withscores and not isinstance(reply, Commands):
+            return [(member, score_cast_func(score))
+                    for member, score in zip(reply[::2], reply[1::2])]
+        return reply
+
+    def lpush(self, name, *values):
+        return self.execute_command('LPUSH', name, *values)
+
+    def ltrim(self, name, start, end):
+        return self.execute_command('LTRIM', name, start, end)
+
+    def lrange(self, name, start, end):
+        return self.execute_command('LRANGE', name, start, end)
+
+    def sort(self, name, start=None, num=None, by=None, get=None):
+        args = [name]
+        if by is not None:
+            args.extend(('BY', by))
+        if start is not None and num is not None:
+            args.extend(('LIMIT', start, num))
+        if isinstance(get, basestring):
+            get = [get]
+        for pattern in get or ():
+            args.extend(('GET', pattern))
+        return self.execute_command('SORT', *args)
+
+    def publish(self, channel, message):
+        return self.execute_command('PUBLISH', channel, message)
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        return self.execute_command('EVALSHA', sha, numkeys, *keys_and_args)
+
+    def script_load(self, script):
+        return self.execute_command('SCRIPT', 'LOAD', script)
+
+
+class Pipeline(Commands):
+    """ Like redis-py's pipelines: commands are run right away after watch
+        and until multi, and are otherwise queued until execute.
+    """
+    def __init__(self, store, transaction=True):
+        self.store = store
+        self.transaction = transaction
+        self.commands = []
+        self.watched = []
+        self.watching = False
+        self.explicit = False
+        self.dirty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def execute_command(self, *args, **options):
+        if self.watching and not self.explicit:
+            return self.store.execute_command(*args)
+        self.commands.append(args)
+        return self
+
+    def watch(self, *names):
+        with self.store.lock:
+            for name in names:
+                key = encode(name)
+                self.store.watchers.setdefault(key, set()).add(self)
+                self.watched.append(key)
+        self.watching = True
+
+    def unwatch(self):
+        with self.store.lock:
+            for key in self.watched:
+                pipes = self.store.watchers.get(key, set())
+                pipes.discard(self)
+                if not pipes:
+                    self.store.watchers.pop(key, None)
+        self.watched = []
+        self.watching = False
+        self.dirty = False
+
+    def multi(self):
+        self.explicit = True
+
+    def reset(self):
+        self.commands = []
+        if self.watching:
+            self.unwatch()
+        self.explicit = False
+
+    def execute(self):
+        try:
+            with self.store.writing():
+                if self.dirty:
+                    raise redis.WatchError("Watched variable changed.")
+                self.unwatch()
+                results = []
+                for args in self.commands:
+                    try:
+                        results.append(self.store.call(*args))
+                    except redis.ResponseError as e:
+                        results.append(e)
+        finally:
+            self.reset()
+        for result in results:
+            if isinstance(result, redis.ResponseError):
+                raise result
+        return results
+
+
+class Direct(object):
+    """ The commands used by the python versions of the scripts, which are
+        run right on the data of a store whose lock is held. Unlike those
+        run by call, they aren't parsed or logged one by one, as the script
+        call is logged instead, see run_script.
+    """
+    def __init__(self, store, at):
+        self.store = store
+        # the time the script was first run at, which expiries are relative
+        # to when it is replayed
+        self.at = at
+
+    def hget(self, key, field):
+        return self.store.cmd_hget(key, field)
+
+    def hmget(self, key, *fields):
+        return self.store.cmd_hmget(key, *fields)
+
+    def hset(self, key, field, value):
+        self.store.create(key, dict)[field] = encode(value)
+
+    def hdel(self, key, field):
+        self.store.cmd_hdel(key, field)
+
+    def hincrby(self, key, field, amount):
+        self.store.cmd_hincrby(key, field, amount)
+
+    def incr(self, key):
+        self.store.cmd_incrby(key, 1)
+
+    def zadd(self, key, score, member):
+        self.store.create(key, SortedSet).add(member, float(score))
+
+    def zrem(self, key, member):
+        # mostly of members that aren't there, see index_status
+        z = self.store.lookup(key, SortedSet)
+        if z is not None and z.remove(member):
+            self.store.touch(key)
+            self.store.cleanup(key)
+
+    def strlen(self, key):
+        return self.store.cmd_strlen(key)
+
+    def getrange(self, key, start, end):
+        return self.store.cmd_getrange(key, start, end)
+
+    def setrange(self, key, offset, value):
+        self.store.cmd_setrange(key, offset, value)
+
+    def append(self, key, value):
+        self.store.cmd_append(key, value)
+
+    def expire(self, key, seconds):
+        self.store.cmd_pexpireat(key, int((self.at + seconds) * 1000))
+
+    def lpush(self, key, value):
+        self.store.cmd_lpush(key, value)
+
+    def ltrim(self, key, start, end):
+        self.store.cmd_ltrim(key, start, end)
+
+    def publish(self, channel, message):
+        self.store.cmd_publish(channel, message)
+
+    def xack(self, key, name, entry_id):
+        self.store.cmd_xack(key, name, entry_id)
+
+
+class MemoryStore(Commands):
+    def __init__(self, path=None):
+        self.lock = threading.RLock()
+        # notified when entries are added to a stream, see XREADGROUP
+        self.added = threading.Condition(self.lock)
+        self.data = {}
+        # the time each key expires at, and a heap of them
+        self.expires = {}
+        self.expiring = []
+        # see Pipeline.watch
+        self.watchers = {}
+        self.subscribers = set()
+        self.scripts = {}
+        # commands run by the scripts and pipelines of each thread, see
+        # execute_command
+        self.nested = threading.local()
+        self.path = path
+        self.log = None
+        self.replaying = False
+        self.snapshot_size = 0
+        if path:
+            self.replay()
+            self.compact()
+
+    # redis-py's StrictRedis also has a connection pool per server
+    @property
+    def connection_pool(self):
+        return self
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(self, transaction)
+
+    def transaction(self, func, *watches, **kwargs):
+        with self.pipeline(True) as pipe:
+            while 1:
+                try:
+                    if watches:
+                        pipe.watch(*watches)
+                    func(pipe)
+                    return pipe.execute()
+                except redis.WatchError:
+                    continue
+
+    def pubsub(self, shard_hint=None):
+        return PubSub(self)
+
+    def register_script(self, script):
+        return Script(self, script)
+
+    def execute_command(self, *args, **options):
+        with self.writing():
+            return self.call(*args)
+
+    @contextlib.contextmanager
+    def writing(self):
+        """ Hold the lock while running commands with call, after which
+            what they logged is written once.
+        """
+        with self.lock:
+            depth = getattr(self.nested, 'depth', 0)
+            self.nested.depth = depth + 1
+            try:
+                self.sweep()
+                yield
+            finally:
+                self.nested.depth = depth
+                if not depth and self.log:
+                    self.log.flush()
+                    if self.log.tell() > max(MIN_COMPACT_SIZE, COMPACT_RATIO *
+                                             self.snapshot_size):
+                        self.compact()
+
+    def call(self, *args):
+        """ Run a command, holding the lock. """
+        name = args[0].upper()
+        handler = getattr(self, 'cmd_' + name.lower(), None)
+        if handler is None:
+            raise error("ERR unknown command '%s'" % args[0])
+        args = [encode(arg) for arg in args[1:]]
+        result = handler(*args)
+        if name in WRITES:
+            self.write_log(name, *args)
+        return result
+
+    # keys
+
+    def lookup(self, key, kind):
+        """ Return the value of a key, or None if it doesn't exist. """
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, kind):
+            raise error(WRONGTYPE)
+        return value
+
+    def create(self, key, kind):
+        """ Return the value of a key that is about to be modified, creating
+            it if it doesn't exist.
+        """
+        value = self.lookup(key, kind)
+        if value is None:
+            value = self.data[key] = kind()
+        self.touch(key)
+        return value
+
+    def store(self, key, value):
+        self.data[key] = value
+        self.touch(key)
+
+    def cleanup(self, key):
+        """ Delete the key if its value has become empty, like redis does. """
+        if not len(self.data[key]):
+            self.remove(key)
+
+    def remove(self, key):
+        if key in self.data:
+            del self.data[key]
+            self.expires.pop(key, None)
+            self.touch(key)
+            return True
+        return False
+
+    def touch(self, key):
+        for pipe in self.watchers.get(key, ()):
+            pipe.dirty = True
+
+    def sweep(self):
+        now = time.time()
+        while self.expiring and self.expiring[0][0] <= now:
+            at, key = heapq.heappop(self.expiring)
+            if self.expires.get(key) == at:
+                self.remove(key)
+
+    def cmd_del(self, *keys):
+        return sum(self.remove(key) for key in keys)
+
+    def cmd_exists(self, key):
+        return key in self.data
+
+    def cmd_type(self, key):
+        value = self.data.get(key)
+        if value is None:
+            return 'none'
+        return TYPES[type(value)]
+
+    def cmd_keys(self, pattern):
+        return [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]
+
+    def cmd_flushdb(self):
+        for key in self.data.keys():
+            self.remove(key)
+        return True
+
+    def cmd_expire(self, key, seconds):
+        at = time.time() + int(seconds)
+        reply = self.cmd_pexpireat(key, int(at * 1000))
+        self.write_log('PEXPIREAT', key, int(at * 1000))
+        return reply
+
+    def cmd_pexpireat(self, key, ms):
+        if key not in self.data:
+            return False
+        at = int(ms) / 1000.0
+        self.expires[key] = at
+        heapq.heappush(self.expiring, (at, key))
+        self.touch(key)
+        return True
+
+    def cmd_ttl(self, key):
+        if key not in self.data:
+            return -2
+        if key not in self.expires:
+            return -1
+        return int(round(self.expires[key] - time.time()))
+
+    # strings
+
+    def cmd_get(self, key):
+        return self.lookup(key, str)
+
+    def cmd_mget(self, *keys):
+        return [self.lookup(key, str) for key in keys]
+
+    def cmd_set(self, key, value):
+        self.expires.pop(key, None)
+        self.store(key, value)
+        return True
+
+    def cmd_incrby(self, key, amount):
+        try:
+            value = int(self.lookup(key, str) or 0) + int(amount)
+        except ValueError:
+            raise error("ERR value is not an integer or out of range")
+        self.store(key, str(value))
+        return value
+
+    def cmd_append(self, key, value):
+        value = (self.lookup(key, str) or '') + value
+        self.store(key, value)
+        return len(value)
+
+    def cmd_setrange(self, key, offset, value):
+        offset = int(offset)
+        old = self.lookup(key, str) or ''
+        old = old.ljust(offset, '\0')
+        value = old[:offset] + value + old[offset + len(value):]
+        self.store(key, value)
+        return len(value)
+
+    def cmd_getrange(self, key, start, end):
+        return (self.lookup(key, str) or '')[redis_slice(start, end)]
+
+    def cmd_strlen(self, key):
+        return len(self.lookup(key, str) or '')
+
+    # hashes
+
+    def cmd_hget(self, key, field):
+        return (self.lookup(key, dict) or {}).get(field)
+
+    def cmd_hmget(self, key, *fields):
+        value = self.lookup(key, dict) or {}
+        return [value.get(field) for field in fields]
+
+    def cmd_hset(self, key, field, value):
+        h = self.create(key, dict)
+        added = field not in h
+        h[field] = value
+        return int(added)
+
+    def cmd_hincrby(self, key, field, amount):
+        h = self.lookup(key, dict) or {}
+        try:
+            value = int(h.get(field, 0)) + int(amount)
+        except ValueError:
+            raise error("ERR hash value is not an integer")
+        self.create(key, dict)[field] = str(value)
+        return value
+
+    def cmd_hmset(self, key, *items):
+        self.create(key, dict).update(zip(items[::2], items[1::2]))
+        return True
+
+    def cmd_hdel(self, key, *fields):
+        h = self.lookup(key, dict)
+        if h is None:
+            return 0
+        self.touch(key)
+        removed = sum(h.pop(field, None) is not None for field in fields)
+        self.cleanup(key)
+        return removed
+
+    def cmd_hgetall(self, key):
+        return dict(self.lookup(key, dict) or {})
+
+    def cmd_hkeys(self, key):
+        return (self.lookup(key, dict) or {}).keys()
+
+    def cmd_hscan(self, key, cursor, *options):
+        # all of it at once, see SSCAN
+        h = self.lookup(key, dict) or {}
+        return ['0', [x for item in h.iteritems() for x in item]]
+
+    # sets
+
+    def cmd_sadd(self, key, *members):
+        s = self.create(key, set)
+        size = len(s)
+        s.update(members)
+        return len(s) - size
+
+    def cmd_srem(self, key, *members):
+        s = self.lookup(key, set)
+        if s is None:
+            return 0
+        self.touch(key)
+        size = len(s)
+        s.difference_update(members)
+        removed = size - len(s)
+        self.cleanup(key)
+        return removed
+
+    def cmd_smembers(self, key):
+        return set(self.lookup(key, set) or ())
+
+    def cmd_scard(self, key):
+        return len(self.lookup(key, set) or ())
+
+    def cmd_sscan(self, key, cursor, *options):
+        # all of it at once, which is allowed
+        return ['0', list(self.lookup(key, set) or ())]
+
+    # sorted sets
+
+    def cmd_zadd(self, key, *pairs):
+        z = self.create(key, SortedSet)
+        try:
+            scores = [float(score) for score in pairs[::2]]
+        except ValueError:
+            raise error("ERR value is not a valid float")
+        added = sum(z.add(member, score)
+                    for score, member in zip(scores, pairs[1::2]))
+        self.cleanup(key)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        z = self.lookup(key, SortedSet)
+        if z is None:
+            return 0
+        self.touch(key)
+        removed = sum(z.remove(member) for member in members)
+        self.cleanup(key)
+        return removed
+
+    def cmd_zcard(self, key):
+        return len(self.lookup(key, SortedSet) or ())
+
+    def cmd_zrange(self, key, start, end):
+        z = self.lookup(key, SortedSet) or SortedSet()
+        return [member for score, member in z.range(redis_slice(start, end))]
+
+    def cmd_zscore(self, key, member):
+        return (self.lookup(key, SortedSet) or SortedSet()).scores.get(member)
+
+    def cmd_zrangebyscore(self, key, lo, hi, *options):
+        z = self.lookup(key, SortedSet) or SortedSet()
+        items = apply_limit(z.range_by_score(lo, hi), options)
+        if 'WITHSCORES' in [option.upper() for option in options]:
+            return [x for score, member in items for x in (member, score)]
+        return [member for score, member in items]
+
+    def cmd_zrangebylex(self, key, lo, hi, *options):
+        z = self.lookup(key, SortedSet) or SortedSet()
+        return apply_limit(z.range_by_lex(lo, hi), options)
+
+    def cmd_zscan(self, key, cursor, *options):
+        # all of it at once, see SSCAN
+        z = self.lookup(key, SortedSet) or SortedSet()
+        return ['0', [x for score, member in z
+                      for x in (member, repr(score))]]
+
+    # lists
+
+    def cmd_lpush(self, key, *values):
+        l = self.create(key, list)
+        l[:0] = reversed(values)
+        return len(l)
+
+    def cmd_ltrim(self, key, start, end):
+        l = self.lookup(key, list)
+        if l is not None:
+            l[:] = l[redis_slice(start, end)]
+            self.touch(key)
+            self.cleanup(key)
+        return True
+
+    def cmd_lrange(self, key, start, end):
+        return (self.lookup(key, list) or [])[redis_slice(start, end)]
+
+    # SORT ... BY nosort, as used by lovebeat
+
+    def cmd_sort(self, key, *options):
+        value = self.lookup(key, (set, SortedSet))
+        if isinstance(value, SortedSet):
+            members = [member for score, member in value]
+        else:
+            members = list(value or ())
+        upper = [option.upper() for option in options]
+        if 'BY' not in upper or options[upper.index('BY') + 1] != 'nosort':
+            members.sort()
+        members = apply_limit(members, options)
+        gets = [options[i + 1] for i, option in enumerate(upper)
+                if option == 'GET']
+        if not gets:
+            return members
+        reply = []
+        for member in members:
+            for pattern in gets:
+                reply.append(self.sort_get(pattern, member))
+        return reply
+
+    def sort_get(self, pattern, member):
+        if pattern == '#':
+            return member
+        if '->' in pattern:
+            pattern, field = pattern.split('->', 1)
+            return self.cmd_hget(pattern.replace('*', member, 1), field)
+        return self.cmd_get(pattern.replace('*', member, 1))
+
+    # publish/subscribe
+
+    def cmd_publish(self, channel, message):
+        for pubsub in list(self.subscribers):
+            pubsub.deliver(channel, message)
+        return len(self.subscribers)
+
+    # streams, see read_alert_feed
+
+    def stream(self, key):
+        s = self.lookup(key, Stream)
+        if s is None:
+            raise error("NOGROUP No such key '%s' or consumer group" % key)
+        return s
+
+    def group(self, key, name):
+        s = self.stream(key)
+        if name not in s.groups:
+            raise error("NOGROUP No such key '%s' or consumer group '%s'"
+                        % (key, name))
+        return s, s.groups[name]
+
+    def cmd_xadd(self, key, *args):
+        maxlen = None
+        if args[0].upper() == 'MAXLEN':
+            args = args[1:]
+            if args[0] in ('~', '='):
+                args = args[1:]
+            maxlen, args = int(args[0]), args[1:]
+        s = self.create(key, Stream)
+        if args[0] == '*':
+            ms = int(time.time() * 1000)
+            entry_id = (ms, 0) if ms > s.last[0] else (s.last[0],
+                                                       s.last[1] + 1)
+        else:
+            entry_id = parse_id(args[0])
+            if entry_id <= s.last:
+                raise error("ERR The ID specified in XADD is equal or smaller "
+                            "than the target stream top item")
+        fields = args[1:]
+        s.last = entry_id
+        s.ids.append(entry_id)
+        s.entries[entry_id] = fields
+        if maxlen is not None and len(s.ids) > maxlen + TRIM_SLACK:
+            for old in s.ids[:-maxlen]:
+                del s.entries[old]
+            del s.ids[:-maxlen]
+        if maxlen is None:
+            self.write_log('XADD', key, format_id(entry_id), *fields)
+        else:
+            self.write_log('XADD', key, 'MAXLEN', '~', maxlen,
+                           format_id(entry_id), *fields)
+        self.added.notify_all()
+        return format_id(entry_id)
+
+    def cmd_xgroup(self, subcommand, key, name, start, *options):
+        if subcommand.upper() != 'CREATE':
+            raise error("ERR unknown XGROUP subcommand '%s'" % subcommand)
+        s = self.lookup(key, Stream)
+        if s is None:
+            if 'MKSTREAM' not in [option.upper() for option in options]:
+                raise error("ERR The XGROUP subcommand requires the key to "
+                            "exist")
+            s = self.create(key, Stream)
+        if name in s.groups:
+            raise error("BUSYGROUP Consumer Group name already exists")
+        last = s.last if start == '$' else parse_id(start)
+        s.groups[name] = Group(last)
+        self.touch(key)
+        self.write_log('XGROUP', 'CREATE', key, name, format_id(last))
+        return True
+
+    def deliver(self, key, s, name, consumer, ids):
+        """ Hand out entries to a consumer, and log that they were. """
+        ms = int(time.time() * 1000)
+        self.cmd_xdeliver(key, name, consumer, ms, *map(format_id, ids))
+        self.write_log('XDELIVER', key, name, consumer, ms,
+                       *map(format_id, ids))
+        return [s.reply(entry_id) for entry_id in ids]
+
+    def cmd_xdeliver(self, key, name, consumer, ms, *ids):
+        """ Not a redis command. Records the delivery of entries, for
+            XREADGROUP and XAUTOCLAIM.
+        """
+        s, group = self.group(key, name)
+        for entry_id in map(parse_id, ids):
+            count = group.pending.get(entry_id, (None, None, 0))[2]
+            group.pending[entry_id] = [consumer, int(ms), count + 1]
+            group.last = max(group.last, entry_id)
+        self.touch(key)
+        return len(ids)
+
+    def cmd_xreadgroup(self, *args):
+        upper = [arg.upper() for arg in args]
+        i = upper.index('GROUP')
+        name, consumer = args[i + 1:i + 3]
+        count = int(args[upper.index('COUNT') + 1]) \
+            if 'COUNT' in upper else None
+        block = int(args[upper.index('BLOCK') + 1]) \
+            if 'BLOCK' in upper else None
+        streams = list(args[upper.index('STREAMS') + 1:])
+        if streams != [streams[0], '>']:
+            raise error("ERR only reading new entries of one stream is "
+                        "supported")
+        key = streams[0]
+        deadline = time.time() + block / 1000.0 if block else None
+        while 1:
+            s, group = self.group(key, name)
+            i = bisect.bisect_right(s.ids, group.last)
+            ids = s.ids[i:i + count if count else None]
+            if ids:
+                return [[key, self.deliver(key, s, name, consumer, ids)]]
+            if block is None:
+                return None
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                return None
+            self.added.wait(remaining)
+
+    def cmd_xautoclaim(self, key, name, consumer, min_idle, start, *options):
+        s, group = self.group(key, name)
+        upper = [option.upper() for option in options]
+        count = int(options[upper.index('COUNT') + 1]) \
+            if 'COUNT' in upper else 100
+        ms = int(time.time() * 1000)
+        start = parse_id(start)
+        ids = sorted(entry_id for entry_id, (_, delivered, _)
+                     in group.pending.iteritems()
+                     if entry_id >= start and ms - delivered >= int(min_idle))
+        claimed = ids[:count]
+        cursor = format_id(ids[count]) if len(ids) > count else '0-0'
+        return [cursor, self.deliver(key, s, name, consumer, claimed)
+                if claimed else []]
+
+    def cmd_xack(self, key, name, *ids):
+        s, group = self.group(key, name)
+        acked = sum(group.pending.pop(parse_id(entry_id), None) is not None
+                    for entry_id in ids)
+        self.touch(key)
+        return acked
+
+    def cmd_xpending(self, key, name):
+        s, group = self.group(key, name)
+        if not group.pending:
+            return [0, None, None, None]
+        consumers = {}
+        for consumer, _, _ in group.pending.itervalues():
+            consumers[consumer] = consumers.get(consumer, 0) + 1
+        return [len(group.pending), format_id(min(group.pending)),
+                format_id(max(group.pending)),
+                [[consumer, str(n)] for consumer, n in consumers.items()]]
+
+    def cmd_migrate(self, *args):
+        raise error("ERR services can't be sharded with the memory store")
+
+    # scripts
+
+    def cmd_script(self, subcommand, *args):
+        if subcommand.upper() != 'LOAD':
+            raise error("ERR unknown SCRIPT subcommand '%s'" % subcommand)
+        sha = hashlib.sha1(args[0]).hexdigest()
+        name = ported_scripts().get(sha)
+        if name is None:
+            raise error("ERR the memory store can only run the scripts in "
+                        "lua/")
+        self.scripts[sha] = name
+        return sha
+
+    def cmd_evalsha(self, sha, numkeys, *keys_and_args):
+        name = self.scripts.get(sha)
+        if name is None:
+            raise error("NOSCRIPT No matching script. Please use EVAL.")
+        return self.run_script(name, time.time(), numkeys, *keys_and_args)
+
+    def run_script(self, name, at, numkeys, *keys_and_args):
+        """ Run the python version of the script `name` as if at the time
+            `at`. The call is logged by the name of the script, rather than
+            everything that it writes.
+        """
+        numkeys = int(numkeys)
+        try:
+            return PORTS[name](Direct(self, float(at)),
+                               keys_and_args[:numkeys],
+                               keys_and_args[numkeys:])
+        finally:
+            # also if it failed half way, as it is then again when replayed
+            self.write_log('EVAL', name, repr(at), numkeys, *keys_and_args)
+
+    # the log
+
+    def write_log(self, *args):
+        if self.log and not self.replaying:
+            pickle.dump(tuple(encode(arg) for arg in args), self.log,
+                        pickle.HIGHEST_PROTOCOL)
+
+    def replay(self):
+        """ Load the data that was written to the log. """
+        if not os.path.exists(self.path):
+            return
+        self.replaying = True
+        try:
+            with open(self.path, 'rb') as f:
+                while 1:
+                    try:
+                        record = pickle.load(f)
+                    except EOFError:
+                        break
+                    if record[0] == 'SNAPSHOT':
+                        self.data, self.expires = record[1:]
+                        self.expiring = [(at, key) for key, at
+                                         in self.expires.iteritems()]
+                        heapq.heapify(self.expiring)
+                    elif record[0] == 'EVAL':
+                        try:
+                            with self.writing():
+                                self.run_script(*record[1:])
+                        except redis.ResponseError:
+                            pass
+                    else:
+                        self.execute_command(*record)
+        finally:
+            self.replaying = False
+
+    def compact(self):
+        """ Replace the log with a snapshot of all data. """
+        with self.lock:
+            if self.log:
+                self.log.close()
+            self.sweep()
+            path = self.path + '.tmp'
+            with open(path, 'wb') as f:
+                pickle.dump(('SNAPSHOT', self.data, self.expires), f,
+                            pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path, self.path)
+            self.log = open(self.path, 'ab')
+            self.snapshot_size = self.log.tell()
+
+
+# python versions of the scripts in lua/
+
+def lua_number(value):
+    """ Like tonumber, but integers are returned as ints. """
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else number
+
+
+def lua_str(number):
+    """ Format a number like lua's tostring. """
+    if isinstance(number, float):
+        return '%.14g' % number
+    return str(number)
+
+
+def unpack(data):
+    if data[:1] == '{':
+        return json.loads(data)
+    return msgpack.unpackb(data, raw=False)
+
+
+def pack(obj, fmt):
+    if fmt == 'msgpack':
+        return msgpack.packb(obj, use_bin_type=False)
+    return json.dumps(obj)
+
+
+def expand_labels(lbls):
+    """ The labels and their ancestors, see lovebeat.expand_labels. """
+    expanded = set()
+    for lbl in lbls:
+        parts = lbl.split('/')
+        for i in range(1, len(parts) + 1):
+            expanded.add('/'.join(parts[:i]))
+    return expanded
+
+
+def same_threshold(a, b):
+    if a is None or b is None:
+        return a is b
+    return all(a.get(k) == b.get(k)
+               for k in ('warning', 'error', 'aggregate', 'window'))
+
+
+def trigger(r, keys, args):
+    """ See lua/trigger.lua. """
+    sid = args[0]
+    now = int(args[1])
+    max_saved = int(args[2])
+    new_lbls = json.loads(args[3])
+    whb, ehb = lua_number(args[4]), lua_number(args[5])
+    fmt = args[7]
+    value = lua_number(args[8])
+    threshold = json.loads(args[10]) if args[10] else None
+
+    def rollup(key, slot, expireat):
+        length = r.strlen(key)
+        if length >= 32:
+            last = r.getrange(key, length - 32, length - 1)
+            ts, count, total, lo, hi = struct.unpack('<IIddd', last)
+            if ts == slot:
+                r.setrange(key, length - 32, struct.pack(
+                    '<IIddd', ts, count + 1, total + value, min(lo, value),
+                    max(hi, value)))
+                return
+        r.append(key, struct.pack('<IIddd', slot, 1, value, value, value))
+        r.expire(key, expireat - now)
+
+    def publish(lbl, event):
+        r.publish('lb:events:' + lbl, event)
+        r.hincrby('lb:versions', lbl, 1)
+
+    def index_status(lbl, status):
+        for s in ('ok', 'warning', 'error', 'maint'):
+            key = 'lb:status:%s:%s' % (lbl, s)
+            if s == status:
+                r.zadd(key, 0, sid)
+            else:
+                r.zrem(key, sid)
+
+    raw = r.hmget(keys[0], 'conf', 'state')
+    conf_changed = not raw[0] or (raw[0][:1] == '{') == (fmt == 'msgpack')
+    conf = unpack(raw[0]) if raw[0] else json.loads(args[6])
+    conf['heartbeat'].setdefault('warning', None)
+    conf['heartbeat'].setdefault('error', None)
+    conf.setdefault('labels', [])
+    if 'threshold' in conf:
+        conf['threshold'].setdefault('warning', None)
+        conf['threshold'].setdefault('error', None)
+    if raw[1]:
+        state = unpack(raw[1])
+    else:
+        state = {'last': {}, 'status': 'ok',
+                 'alert': {'status': 'ok', 'id': 0, 'state': 'confirmed'}}
+    old_status = state['status']
+    if state['last'].get('ts') is not None and state['last']['ts'] > now:
+        now = state['last']['ts']
+    reindex = not raw[0]
+
+    r.zadd('lb:services:all', 0, sid)
+    if new_lbls:
+        old = expand_labels(conf['labels'])
+        new = expand_labels(new_lbls)
+        for lbl in new - old:
+            r.zadd('lb:services:' + lbl, 0, sid)
+            r.zadd('lb:labels', 0, lbl)
+            reindex = True
+        for lbl in old - new:
+            r.zrem('lb:services:' + lbl, sid)
+            index_status(lbl, None)
+            publish(lbl, json.dumps({'id': sid, 'deleted': True}))
+        if list(conf['labels']) != list(new_lbls):
+            conf_changed = True
+        conf['labels'] = new_lbls
+    lbls = expand_labels(conf['labels'])
+
+    if whb is not None or ehb is not None:
+        hb = conf['heartbeat']
+        if hb['warning'] != whb or hb['error'] != ehb:
+            hb['warning'], hb['error'] = whb, ehb
+            conf_changed = True
+
+    if threshold is not None:
+        if threshold.get('warning') is None and threshold.get('error') is None:
+            threshold = None
+        if not same_threshold(conf.get('threshold'), threshold):
+            if threshold is None:
+                conf.pop('threshold', None)
+            else:
+                conf['threshold'] = threshold
+            state.pop('value_status', None)
+            conf_changed = True
+            if threshold and threshold['aggregate'] != 'last':
+                entry = [threshold['aggregate'], threshold['window']]
+                for level in (threshold['warning'], threshold['error']):
+                    entry.append('' if level is None else level)
+                r.hset('lb:thresholds', sid,
+                       '/'.join(lua_str(x) for x in entry))
+            else:
+                r.hdel('lb:thresholds', sid)
+            r.hdel('lb:value_status', sid)
+            r.incr('lb:thresholds:version')
+
+    if state.get('maint') and state['maint']['type'] == 'soft':
+        del state['maint']
+    state['last']['ts'] = now
+    state['last']['val'] = value if value is not None else 1
+    th = conf.get('threshold')
+    if value is not None and th and th['aggregate'] == 'last':
+        if th['error'] is not None and value >= th['error']:
+            state['value_status'] = 'error'
+        elif th['warning'] is not None and value >= th['warning']:
+            state['value_status'] = 'warning'
+        else:
+            state['value_status'] = 'ok'
+    if state.get('maint') and state['maint']['expiry'] >= now:
+        state['status'] = 'maint'
+    else:
+        state['status'] = state.get('value_status') or 'ok'
+
+    if reindex or state['status'] != old_status:
+        index_status('all', state['status'])
+        for lbl in lbls:
+            index_status(lbl, state['status'])
+
+    event = json.dumps({'id': sid, 'status': state['status'], 'last': now})
+    publish('all', event)
+    for lbl in lbls:
+        publish(lbl, event)
+
+    deadline = None
+    alert_status = 'ok' if state['status'] == 'maint' else state['status']
+    if state['alert']['status'] != alert_status and \
+            state['alert']['state'] == 'confirmed':
+        deadline = now
+    elif state['status'] == 'maint':
+        deadline = state['maint']['expiry'] + 1
+    else:
+        for hb in (conf['heartbeat']['warning'], conf['heartbeat']['error']):
+            if isinstance(hb, (int, long, float)) and hb > 0 and \
+                    (deadline is None or now + hb < deadline):
+                deadline = now + hb
+    if deadline is not None:
+        r.zadd('lb:deadlines', deadline, sid)
+    else:
+        r.zrem('lb:deadlines', sid)
+
+    r.hset(keys[0], 'state', pack(state, fmt))
+    r.hset('lb:last', sid, now)
+    r.lpush(keys[1], '%s:%s' % (now, lua_str(value if value is not None
+                                             else 1)))
+    r.ltrim(keys[1], 0, max_saved - 1)
+    if value is not None:
+        for resolution, span, retention in json.loads(args[9]):
+            bucket = now // span
+            key = 'lb:s:%s:ts:%s:%s' % (sid, resolution, bucket)
+            expireat = (bucket + 1) * span + retention
+            if resolution == 0:
+                r.append(key, struct.pack('<Id', now, value))
+                r.expire(key, expireat - now)
+            else:
+                rollup(key, now - now % resolution, expireat)
+    if conf_changed:
+        r.hset(keys[0], 'conf', pack(conf, fmt))
+    return 1
+
+
+def claim(r, keys, args):
+    """ See lua/claim.lua. """
+    agent, alert_id, status, now, timeout, fmt = args
+    raw = r.hget(keys[0], 'state')
+    if not raw:
+        return 'already_claimed'
+    state = unpack(raw)
+    alert = state['alert']
+    if alert['id'] != lua_number(alert_id) or alert['status'] != status:
+        return 'already_claimed'
+    if alert['state'] == 'claimed':
+        if alert['claim']['agent'] == agent:
+            return 'ok'
+        ts = alert['claim'].get('ts')
+        if ts is None or ts + int(timeout) > int(now):
+            return 'already_claimed'
+    elif alert['state'] != 'new':
+        return 'already_claimed'
+    alert['state'] = 'claimed'
+    alert['claim'] = {'agent': agent, 'ts': int(now)}
+    r.hset(keys[0], 'state', pack(state, fmt))
+    return 'ok'
+
+
+def confirm(r, keys, args):
+    """ See lua/confirm.lua. """
+    sid, agent, alert_id, status, now, fmt = args
+    raw = r.hget(keys[0], 'state')
+    if not raw:
+        return 'already_confirmed'
+    state = unpack(raw)
+    alert = state['alert']
+    if alert['id'] != lua_number(alert_id) or alert['status'] != status:
+        return 'already_confirmed'
+    elif alert['state'] == 'confirmed':
+        return 'ok'
+    alert['state'] = 'confirmed'
+    alert['confirmed'] = {'agent': agent}
+    r.hset(keys[0], 'state', pack(state, fmt))
+    entry = r.hget(keys[2], sid)
+    if entry:
+        r.xack(keys[1], 'agents', entry)
+        r.hdel(keys[2], sid)
+    r.zadd(keys[3], now, sid)
+    return 'ok'
+
+
+PORTS = {'trigger.lua': trigger, 'claim.lua': claim, 'confirm.lua': confirm}
+ports = {}
+
+
+def ported_scripts():
+    """ Map the SHA1 of the scripts in lua/ to their names in PORTS. """
+    if not ports:
+        for name in PORTS:
+            with open(os.path.join(LUA_DIR, name)) as f:
+                ports[hashlib.sha1(f.read()).hexdigest()] = name
+    return ports
@@ -0,0 +1,49 @@
+-- Claims an alert of a service for an agent, see claim.
+--
+-- KEYS[1]  lb:s:<sid>
+-- ARGV[1]  agent
+-- ARGV[2]  alert id
+-- ARGV[3]  alert status
+-- ARGV[4]  now
+-- ARGV[5]  seconds after which a claim that hasn't been confirmed expires
+-- ARGV[6]  format to store the state in, 'json' or 'msgpack'
+local agent = ARGV[1]
+local alert_id = tonumber(ARGV[2])
+local now = tonumber(ARGV[4])
+local timeout = tonumber(ARGV[5])
+
+local raw = redis.call('HGET', KEYS[1], 'state')
+if not raw then
+  return 'already_claimed'
+end
+local state
+if string.sub(raw, 1, 1) == '{' then
+  state = cjson.decode(raw)
+else
+  state = cmsgpack.unpack(raw)
+end
+local alert = state.alert
+
+-- claiming an old alert - a race condition.
+if alert.id ~= alert_id or alert.status ~= ARGV[3] then
+  return 'already_claimed'
+end
+if alert.state == 'claimed' then
+  if alert.claim.agent == agent then
+    return 'ok'
+  end
+  -- the agent that claimed it may have died; see read_alert_feed
+  if not alert.claim.ts or alert.claim.ts + timeout > now then
+    return 'already_claimed'
+  end
+elseif alert.state ~= 'new' then
+  return 'already_claimed'
+end
+alert.state = 'claimed'
+alert.claim = {agent = agent, ts = now}
+if ARGV[6] == 'msgpack' then
+  redis.call('HSET', KEYS[1], 'state', cmsgpack.pack(state))
+else
+  redis.call('HSET', KEYS[1], 'state', cjson.encode(state))
+end
+return 'ok'
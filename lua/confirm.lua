@@ -0,0 +1,51 @@
+-- Confirms that an alert of a service has been sent, see confirm.
+--
+-- KEYS[1]  lb:s:<sid>
+-- KEYS[2]  lb:alerts
+-- KEYS[3]  lb:alerts:entries
+-- KEYS[4]  lb:deadlines
+-- ARGV[1]  sid
+-- ARGV[2]  agent
+-- ARGV[3]  alert id
+-- ARGV[4]  alert status
+-- ARGV[5]  now
+-- ARGV[6]  format to store the state in, 'json' or 'msgpack'
+local sid = ARGV[1]
+local alert_id = tonumber(ARGV[3])
+
+local raw = redis.call('HGET', KEYS[1], 'state')
+if not raw then
+  return 'already_confirmed'
+end
+local state
+if string.sub(raw, 1, 1) == '{' then
+  state = cjson.decode(raw)
+else
+  state = cmsgpack.unpack(raw)
+end
+local alert = state.alert
+
+if alert.id ~= alert_id or alert.status ~= ARGV[4] then
+  -- confirming an old alert - a race condition.
+  return 'already_confirmed'
+elseif alert.state == 'confirmed' then
+  -- confirming an already confirmed alert - client retrying?
+  return 'ok'
+end
+alert.state = 'confirmed'
+alert.confirmed = {agent = ARGV[2]}
+if ARGV[6] == 'msgpack' then
+  redis.call('HSET', KEYS[1], 'state', cmsgpack.pack(state))
+else
+  redis.call('HSET', KEYS[1], 'state', cjson.encode(state))
+end
+-- the alert has been delivered, so its feed entry must not be handed out
+-- again; see alert_feed
+local entry = redis.call('HGET', KEYS[3], sid)
+if entry then
+  redis.call('XACK', KEYS[2], 'agents', entry)
+  redis.call('HDEL', KEYS[3], sid)
+end
+-- the status may have changed while the alert was being handled
+redis.call('ZADD', KEYS[4], ARGV[5], sid)
+return 'ok'
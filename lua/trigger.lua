@@ -0,0 +1,284 @@
+-- Registers a heartbeat for a service. This is the atomic equivalent of
+-- loading, modifying and storing the service within a WATCH/MULTI block.
+--
+-- KEYS[1]  lb:s:<sid>
+-- KEYS[2]  lb:s:<sid>:h
+-- ARGV[1]  sid
+-- ARGV[2]  now
+-- ARGV[3]  number of history entries to keep
+-- ARGV[4]  new labels, as a sorted JSON array (empty to keep the old ones)
+-- ARGV[5]  warning heartbeat, or empty
+-- ARGV[6]  error heartbeat, or empty
+-- ARGV[7]  default config, as JSON
+-- ARGV[8]  format to store the config and state in, 'json' or 'msgpack'
+-- ARGV[9]  value of the heartbeat, or empty
+-- ARGV[10] time series tiers, as a JSON array, see SERIES_TIERS
+-- ARGV[11] value thresholds, as JSON, or empty; see parse_threshold
+local sid = ARGV[1]
+local now = tonumber(ARGV[2])
+local max_saved = tonumber(ARGV[3])
+local new_lbls = cjson.decode(ARGV[4])
+local whb = tonumber(ARGV[5])
+local ehb = tonumber(ARGV[6])
+local value = tonumber(ARGV[9])
+local threshold = ARGV[11] ~= '' and cjson.decode(ARGV[11])
+local statuses = {'ok', 'warning', 'error', 'maint'}
+
+-- Adds the value to the last record of a rollup series if it's for the same
+-- slot, or appends a new record. See read_series for the format.
+local function rollup(key, slot, expireat)
+  local len = redis.call('STRLEN', key)
+  if len >= 32 then
+    local last = redis.call('GETRANGE', key, len - 32, len - 1)
+    local ts, count, sum, min, max = struct.unpack('<IIddd', last)
+    if ts == slot then
+      redis.call('SETRANGE', key, len - 32,
+                 struct.pack('<IIddd', ts, count + 1, sum + value,
+                             math.min(min, value), math.max(max, value)))
+      return
+    end
+  end
+  redis.call('APPEND', key, struct.pack('<IIddd', slot, 1, value, value, value))
+  redis.call('EXPIRE', key, expireat - now)
+end
+
+-- see pack and unpack
+local function unpack(data)
+  if string.sub(data, 1, 1) == '{' then
+    return cjson.decode(data)
+  end
+  return cmsgpack.unpack(data)
+end
+
+local function pack(obj)
+  if ARGV[8] == 'msgpack' then
+    return cmsgpack.pack(obj)
+  end
+  -- cjson can't tell an empty array from an empty object.
+  return (string.gsub(cjson.encode(obj), '"labels":{}', '"labels":[]'))
+end
+
+local function same_threshold(a, b)
+  if not a or not b then
+    return a == b
+  end
+  for _, k in ipairs({'warning', 'error', 'aggregate', 'window'}) do
+    if a[k] ~= b[k] then
+      return false
+    end
+  end
+  return true
+end
+
+-- see publish; every event also changes the label, see bump_versions
+local function publish(lbl, event)
+  redis.call('PUBLISH', 'lb:events:' .. lbl, event)
+  redis.call('HINCRBY', 'lb:versions', lbl, 1)
+end
+
+-- Returns the labels and their ancestors as a set, see expand_labels.
+local function expand(lbls)
+  local expanded = {}
+  for _, lbl in ipairs(lbls) do
+    local pos = string.find(lbl, '/', 1, true)
+    while pos do
+      expanded[string.sub(lbl, 1, pos - 1)] = true
+      pos = string.find(lbl, '/', pos + 1, true)
+    end
+    expanded[lbl] = true
+  end
+  return expanded
+end
+
+local function same_labels(a, b)
+  if #a ~= #b then
+    return false
+  end
+  for i = 1, #a do
+    if a[i] ~= b[i] then
+      return false
+    end
+  end
+  return true
+end
+
+-- see index_status
+local function index_status(lbl, status)
+  for _, s in ipairs(statuses) do
+    local key = 'lb:status:' .. lbl .. ':' .. s
+    if s == status then
+      redis.call('ZADD', key, 0, sid)
+    else
+      redis.call('ZREM', key, sid)
+    end
+  end
+end
+
+local raw = redis.call('HMGET', KEYS[1], 'conf', 'state')
+-- write the config if it's new or stored in another format
+local conf_changed = not raw[1] or
+  (string.sub(raw[1], 1, 1) == '{') == (ARGV[8] == 'msgpack')
+local conf = raw[1] and unpack(raw[1]) or cjson.decode(ARGV[7])
+-- msgpack can't store null values in maps
+conf.heartbeat.warning = conf.heartbeat.warning or cjson.null
+conf.heartbeat.error = conf.heartbeat.error or cjson.null
+conf.labels = conf.labels or {}
+if conf.threshold then
+  conf.threshold.warning = conf.threshold.warning or cjson.null
+  conf.threshold.error = conf.threshold.error or cjson.null
+end
+local state
+if raw[2] then
+  state = unpack(raw[2])
+else
+  state = {last = {}, status = 'ok',
+           alert = {status = 'ok', id = 0, state = 'confirmed'}}
+end
+local old_status = state.status
+-- delayed triggers (see Coalescer) must not move the last heartbeat back
+if state.last.ts and state.last.ts > now then
+  now = state.last.ts
+end
+-- the status indexes of all labels must be updated for new services
+local reindex = not raw[1]
+
+-- Labels are persistent, so they are only modified when new ones are set.
+redis.call('ZADD', 'lb:services:all', 0, sid)
+if #new_lbls > 0 then
+  -- the services are indexed in the ancestors of their labels as well
+  local old, new = expand(conf.labels), expand(new_lbls)
+  for lbl in pairs(new) do
+    if not old[lbl] then
+      redis.call('ZADD', 'lb:services:' .. lbl, 0, sid)
+      redis.call('ZADD', 'lb:labels', 0, lbl)
+      reindex = true
+    end
+  end
+  for lbl in pairs(old) do
+    if not new[lbl] then
+      redis.call('ZREM', 'lb:services:' .. lbl, sid)
+      index_status(lbl, nil)
+      publish(lbl, cjson.encode({id = sid, deleted = true}))
+    end
+  end
+  if not same_labels(conf.labels, new_lbls) then
+    conf_changed = true
+  end
+  conf.labels = new_lbls
+end
+local lbls = expand(conf.labels)
+
+if whb or ehb then
+  local hb = conf.heartbeat
+  if hb.warning ~= (whb or cjson.null) or hb.error ~= (ehb or cjson.null) then
+    hb.warning = whb or cjson.null
+    hb.error = ehb or cjson.null
+    conf_changed = true
+  end
+end
+
+if threshold then
+  if threshold.warning == cjson.null and threshold.error == cjson.null then
+    threshold = nil
+  end
+  if not same_threshold(conf.threshold, threshold) then
+    conf.threshold = threshold
+    state.value_status = nil
+    conf_changed = true
+    -- windows are evaluated by evaluate_thresholds, see load_thresholds
+    if threshold and threshold.aggregate ~= 'last' then
+      local entry = {threshold.aggregate, threshold.window}
+      for _, level in ipairs({threshold.warning, threshold.error}) do
+        entry[#entry + 1] = level == cjson.null and '' or level
+      end
+      redis.call('HSET', 'lb:thresholds', sid, table.concat(entry, '/'))
+    else
+      redis.call('HDEL', 'lb:thresholds', sid)
+    end
+    redis.call('HDEL', 'lb:value_status', sid)
+    redis.call('INCR', 'lb:thresholds:version')
+  end
+end
+
+if state.maint and state.maint.type == 'soft' then
+  state.maint = nil
+end
+state.last.ts = now
+state.last.val = value or 1
+if value and conf.threshold and conf.threshold.aggregate == 'last' then
+  -- see threshold_status
+  local th = conf.threshold
+  if th.error ~= cjson.null and value >= th.error then
+    state.value_status = 'error'
+  elseif th.warning ~= cjson.null and value >= th.warning then
+    state.value_status = 'warning'
+  else
+    state.value_status = 'ok'
+  end
+end
+-- nothing but maintenance or its values can keep a service that just beat
+-- from being ok
+if state.maint and state.maint.expiry >= now then
+  state.status = 'maint'
+else
+  state.status = state.value_status or 'ok'
+end
+
+if reindex or state.status ~= old_status then
+  index_status('all', state.status)
+  for lbl in pairs(lbls) do
+    index_status(lbl, state.status)
+  end
+end
+
+-- every heartbeat is sent to the open dashboards, see state_event
+local event = cjson.encode({id = sid, status = state.status, last = now})
+publish('all', event)
+for lbl in pairs(lbls) do
+  publish(lbl, event)
+end
+
+-- schedule the next evaluation, see next_deadline
+local deadline
+local alert_status = state.status == 'maint' and 'ok' or state.status
+if state.alert.status ~= alert_status and state.alert.state == 'confirmed' then
+  deadline = now
+elseif state.status == 'maint' then
+  deadline = state.maint.expiry + 1
+else
+  for _, hb in pairs({conf.heartbeat.warning, conf.heartbeat.error}) do
+    if type(hb) == 'number' and hb > 0 and
+        (not deadline or now + hb < deadline) then
+      deadline = now + hb
+    end
+  end
+end
+if deadline then
+  redis.call('ZADD', 'lb:deadlines', deadline, sid)
+else
+  redis.call('ZREM', 'lb:deadlines', sid)
+end
+
+redis.call('HSET', KEYS[1], 'state', pack(state))
+-- see metrics
+redis.call('HSET', 'lb:last', sid, now)
+redis.call('LPUSH', KEYS[2], now .. ':' .. (value or 1))
+redis.call('LTRIM', KEYS[2], 0, max_saved - 1)
+if value then
+  for _, tier in ipairs(cjson.decode(ARGV[10])) do
+    local resolution, span, retention = tier[1], tier[2], tier[3]
+    local bucket = math.floor(now / span)
+    local key = 'lb:s:' .. sid .. ':ts:' .. resolution .. ':' .. bucket
+    local expireat = (bucket + 1) * span + retention
+    if resolution == 0 then
+      redis.call('APPEND', key, struct.pack('<Id', now, value))
+      redis.call('EXPIRE', key, expireat - now)
+    else
+      rollup(key, now - now % resolution, expireat)
+    end
+  end
+end
+if conf_changed then
+  redis.call('HSET', KEYS[1], 'conf', pack(conf))
+end
+return 1
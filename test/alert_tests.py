@@ -1,4 +1,5 @@
 import json
+import re
 import unittest
 from base import LovebeatBase
 from werkzeug.datastructures import MultiDict
@@ -267,5 +268,53 @@ ENDFILE
         alerts = self.app.get('/agent/bond/alerts.txt').data
         self.assertEquals("1\nENDFILE\n", alerts)
 
+    def test_changed_rcpts(self):
+        self.set_ts(20)
+        alerts = self.app.get('/agent/bond/alerts.txt').data
+        self.assertTrue("TO\ngtalk:foo@example.com\n" in alerts)
+
+        md = MultiDict([('alert', 'warning:email:bar@example.com')])
+        self.app.post('/l/all', data=md)
+        self.app.post('/l/foo', data=dict())
+        alerts = self.app.get('/agent/bond/alerts.txt').data
+        self.assertTrue("TO\nemail:bar@example.com\n" in alerts)
+
+    def test_inherited_rcpt(self):
+        md = MultiDict([('alert', 'error:email:prod@example.com')])
+        self.app.post('/l/prod', data=md)
+        md = MultiDict([('alert', 'error:email:db@example.com')])
+        self.app.post('/l/prod/eu/db', data=md)
+        self.assertEquals(['email:db@example.com'], json.loads(
+            self.app.get('/l/prod/eu/db').data)['alerts']['error'])
+        self.app.post('/s/test.db', data=dict(labels='prod/eu/db',
+                                              heartbeat='error:5'))
+        self.app.post('/s/test.web', data=dict(labels='prod/eu/web',
+                                               heartbeat='error:5'))
+        self.set_ts(6)
+        data = self.app.get('/agent/bond/alerts.txt').data
+        alerts = dict(re.findall(r'^SERVICE\n(.*)\n(?:.*\n)*?TO\n(.*)\n',
+                                 data, re.M))
+        self.assertEquals(sorted(['email:prod@example.com',
+                                  'email:db@example.com']),
+                          sorted(alerts['test.db'].split()))
+        self.assertEquals('email:prod@example.com', alerts['test.web'])
+
+    def test_label_names(self):
+        md = MultiDict([('alert', 'error:email:db@example.com')])
+        self.app.post('/l/Prod/DB/', data=md)
+        self.assertEquals(['email:db@example.com'], json.loads(
+            self.app.get('/l/prod/db').data)['alerts']['error'])
+        self.assertEquals(['email:db@example.com'], json.loads(
+            self.app.get('/l/prod/db/').data)['alerts']['error'])
+        self.assertEquals(400, self.app.post('/l/prod//db',
+                                             data=md).status_code)
+        self.assertEquals(400, self.app.get('/l/prod//db').status_code)
+        self.app.post('/s/test.db', data=dict(labels='prod/db',
+                                              heartbeat='error:5'))
+        self.set_ts(6)
+        data = self.app.get('/agent/bond/alerts.txt').data
+        self.assertTrue('TO\nemail:db@example.com\n' in data)
+
+
 if __name__ == '__main__':
     unittest.main()
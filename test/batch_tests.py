@@ -0,0 +1,72 @@
+import json
+import unittest
+from base import LovebeatBase
+
+
+class BatchTests(LovebeatBase):
+    def batch(self, data, content_type):
+        rv = self.app.post('/batch', data=data, content_type=content_type)
+        return json.loads(rv.data)['results']
+
+    def test_batch_json(self):
+        entries = [{'id': 'test.one', 'heartbeat': {'error': 30}},
+                   {'id': 'test.two', 'labels': ['foo', 'Bar']},
+                   'test.three']
+        results = self.batch(json.dumps(entries), 'application/json')
+        self.assertEquals(['ok', 'ok', 'ok'], [r['status'] for r in results])
+        self.expect('test.one', 'OK', 0)
+        self.expect('test.one', 'ERROR', 30)
+        self.assertEquals(['bar', 'foo'], self.get_config('test.two')['labels'])
+        obj = json.loads(self.app.get('/dashboard/foo/json').data)
+        self.assertEquals(['test.two'], [s['id'] for s in obj['services']])
+
+    def test_batch_lines(self):
+        body = 'test.one\n\n{"id": "test.two", "labels": "x,y"}\ntest.one\n'
+        results = self.batch(body, 'text/plain')
+        self.assertEquals(['test.one', 'test.two', 'test.one'],
+                          [r['id'] for r in results])
+        self.assertEquals(['x', 'y'], self.get_config('test.two')['labels'])
+
+    def test_batch_invalid_entries(self):
+        entries = [{'id': 'test.one'}, {'labels': ['foo']},
+                   {'id': 'test.two', 'heartbeat': {'error': 'soon'}}]
+        results = self.batch(json.dumps(entries), 'application/json')
+        self.assertEquals(['ok', 'error', 'error'],
+                          [r['status'] for r in results])
+        self.expect('test.one', 'OK')
+        obj = json.loads(self.app.get('/dashboard/all/json').data)
+        self.assertEquals(1, len(obj['services']))
+
+    def test_batch_invalid_lines(self):
+        body = 'test.one\n{"id": "test.two", "labels": \n'
+        results = self.batch(body, 'text/plain')
+        self.assertEquals([{'id': 'test.one', 'status': 'ok'},
+                           {'id': None, 'status': 'error',
+                            'error': 'invalid entry'}], results)
+        obj = json.loads(self.app.get('/dashboard/all/json').data)
+        self.assertEquals(['test.one'], [s['id'] for s in obj['services']])
+
+    def test_batch_invalid_labels(self):
+        body = json.dumps([{'id': 'test.one', 'labels': ['foo']},
+                           {'id': 'test.two', 'labels': [1]},
+                           {'id': 'test.three', 'labels': {'foo': 1}}])
+        results = self.batch(body, 'application/json')
+        self.assertEquals(['ok', 'error', 'error'],
+                          [r['status'] for r in results])
+        obj = json.loads(self.app.get('/dashboard/all/json').data)
+        self.assertEquals(['test.one'], [s['id'] for s in obj['services']])
+
+    def test_batch_same_as_trigger(self):
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        self.app.post('/s/test.one/maint')
+        self.set_ts(10)
+        self.batch(json.dumps([{'id': 'test.one', 'labels': ['bar']}]),
+                   'application/json')
+        self.expect('test.one', 'OK')
+        s = self.get_json('test.one')
+        self.assertEquals(['bar'], s['config']['labels'])
+        self.assertEquals(self.EPOCH + 10, s['state']['last']['ts'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import json
+import unittest
+import lovebeat
+from base import LovebeatBase
+from werkzeug.datastructures import MultiDict
+
+
+class CacheTests(LovebeatBase):
+    def setUp(self):
+        super(CacheTests, self).setUp()
+        lovebeat.response_cache.clear()
+        self.sample = lovebeat.app.config['STATS_SAMPLE']
+        self.app.post('/s/test.one', data=dict(labels='foo/bar'))
+        self.app.post('/s/test.two', data=dict(labels='baz',
+                                               heartbeat='warning:5'))
+
+    def tearDown(self):
+        lovebeat.app.config['RESPONSE_CACHE'] = 0
+        lovebeat.app.config['STATS_SAMPLE'] = self.sample
+
+    def get(self, path, etag=None):
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.app.get(path, headers=headers)
+
+    def expect_unchanged(self, path, etag):
+        rv = self.get(path, etag)
+        self.assertEquals(304, rv.status_code)
+        self.assertEquals('', rv.data)
+        self.assertEquals(etag, rv.headers['ETag'])
+
+    def expect_changed(self, path, etag):
+        rv = self.get(path, etag)
+        self.assertEquals(200, rv.status_code)
+        self.assertNotEquals(etag, rv.headers['ETag'])
+        return rv.headers['ETag']
+
+    def test_etag(self):
+        rv = self.get('/dashboard/foo/raw')
+        etag = rv.headers['ETag']
+        self.assertTrue('[OK] test.one' in rv.data)
+        self.expect_unchanged('/dashboard/foo/raw', etag)
+        self.assertEquals(304, self.get('/dashboard/foo/raw',
+                                        'W/' + etag).status_code)
+        # other labels don't matter
+        self.app.post('/s/test.two')
+        self.expect_unchanged('/dashboard/foo/raw', etag)
+        self.app.post('/s/test.one')
+        etag = self.expect_changed('/dashboard/foo/raw', etag)
+        self.expect_unchanged('/dashboard/foo/raw', etag)
+
+    def test_weak(self):
+        etag = self.get('/dashboard/foo/json').headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.expect_unchanged('/dashboard/foo/json', etag)
+        rv = self.app.get('/dashboard/foo/json?stream=1')
+        self.assertFalse('ETag' in rv.headers)
+
+    def test_page(self):
+        # the page counts on from the time it was rendered at
+        rv = self.get('/dashboard/foo/')
+        self.assertFalse('ETag' in rv.headers)
+        self.set_ts(5)
+        rv = self.get('/dashboard/foo/', '*')
+        self.assertEquals(200, rv.status_code)
+        self.assertTrue('var skew = %d ' % (self.EPOCH + 5) in rv.data)
+
+    def test_changes(self):
+        etag = self.get('/dashboard/all/raw').headers['ETag']
+        # a status transition
+        self.set_ts(6)
+        etag = self.expect_changed('/dashboard/all/raw', etag)
+        self.expect_unchanged('/dashboard/all/raw', etag)
+        for path in ('/s/test.two/maint', '/s/test.two/unmaint',
+                     '/s/test.two/delete'):
+            self.app.post(path)
+            etag = self.expect_changed('/dashboard/all/raw', etag)
+
+    def test_alert(self):
+        md = MultiDict([('alert', 'warning:email:baz@example.com')])
+        self.app.post('/l/baz', data=md)
+        self.set_ts(6)
+        etag = self.get('/dashboard/baz/json').headers['ETag']
+        self.app.post('/agent/bond/claim/test.two/1/warning')
+        etag = self.expect_changed('/dashboard/baz/json', etag)
+        self.app.post('/agent/bond/confirm/test.two/1/warning')
+        self.expect_changed('/dashboard/baz/json', etag)
+
+    def test_parent(self):
+        etag = self.get('/dashboard/foo/raw').headers['ETag']
+        self.app.post('/s/test.three', data=dict(labels='foo/qux'))
+        self.expect_changed('/dashboard/foo/raw', etag)
+
+    def test_label(self):
+        self.app.post('/l/foo', data=MultiDict([('alert', 'error:sms:1')]))
+        etag = self.get('/l/foo').headers['ETag']
+        self.expect_unchanged('/l/foo', etag)
+        self.app.post('/l/foo', data=MultiDict([('alert', 'error:sms:2')]))
+        self.expect_changed('/l/foo', etag)
+
+    def renders(self):
+        stats = json.loads(self.app.get('/stats').data)
+        return stats['timers']['get_services']['calls']
+
+    def test_cache(self):
+        lovebeat.app.config['RESPONSE_CACHE'] = 10
+        lovebeat.app.config['STATS_SAMPLE'] = 1
+        before = self.get('/dashboard/foo/json').data
+        renders = self.renders()
+        self.set_ts(5)
+        self.assertEquals(before, self.get('/dashboard/foo/json').data)
+        self.assertEquals(renders, self.renders())
+        # but not once the label has changed
+        self.app.post('/s/test.one')
+        self.assertNotEquals(before, self.get('/dashboard/foo/json').data)
+        self.assertEquals(renders + 1, self.renders())
+        # or the response has expired
+        self.set_ts(20)
+        obj = json.loads(self.get('/dashboard/foo/json').data)
+        self.assertEquals(15, obj['services'][0]['state']['last']['delta'])
+
+
+if __name__ == '__main__':
+    unittest.main()
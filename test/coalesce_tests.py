@@ -0,0 +1,104 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import unittest
+import lovebeat
+from base import LovebeatBase
+
+# triggers a service twice within the window, and waits to be terminated
+SERVER = """
+import sys
+import time
+import lovebeat
+lovebeat.app.config.update(TESTING=True, TESTING_TS=%d, COALESCE_WINDOW=60)
+lovebeat.use_test_db(%d)
+client = lovebeat.app.test_client()
+client.post('/s/test.one')
+lovebeat.app.config['TESTING_TS'] += 5
+client.post('/s/test.one')
+# lovebeat writes sys.stdout to stderr
+sys.__stdout__.write('ready\\n')
+time.sleep(60)
+"""
+
+
+class CoalesceTests(LovebeatBase):
+    def setUp(self):
+        super(CoalesceTests, self).setUp()
+        lovebeat.coalescer = lovebeat.Coalescer(5)
+
+    def tearDown(self):
+        lovebeat.coalescer = None
+
+    def last_ts(self, sid='test.one'):
+        return self.get_json(sid)['state']['last']['ts'] - self.EPOCH
+
+    def test_coalescing(self):
+        self.app.post('/s/test.one')
+        self.assertEquals(0, self.last_ts())
+
+        self.set_ts(1)
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        self.set_ts(2)
+        self.app.post('/s/test.one', data=dict(heartbeat='error:60'))
+        self.assertEquals(0, self.last_ts())
+
+        lovebeat.coalescer.flush()
+        self.assertEquals(2, self.last_ts())
+        config = self.get_config('test.one')
+        self.assertEquals(['foo'], config['labels'])
+        self.assertEquals(60, config['heartbeat']['error'])
+
+        stats = json.loads(self.app.get('/stats').data)['coalescer']
+        self.assertEquals({'triggers': 3, 'coalesced': 1, 'writes': 2,
+                           'pending': 0}, stats)
+
+    def test_written_after_window(self):
+        self.app.post('/s/test.one')
+        self.set_ts(4)
+        self.app.post('/s/test.one')
+        self.assertEquals(0, self.last_ts())
+        self.set_ts(5)
+        self.app.post('/s/test.two')
+        self.assertEquals(5, self.last_ts('test.two'))
+        lovebeat.coalescer.flush()
+        self.assertEquals(4, self.last_ts())
+
+        # flushed services are held back for another window
+        self.set_ts(9)
+        self.app.post('/s/test.one')
+        self.assertEquals(4, self.last_ts())
+        self.set_ts(10)
+        lovebeat.coalescer.flush()
+        self.set_ts(15)
+        self.app.post('/s/test.one')
+        self.assertEquals(15, self.last_ts())
+
+    def test_late_flush_keeps_newest_heartbeat(self):
+        self.app.post('/s/test.one')
+        self.set_ts(1)
+        self.app.post('/s/test.one')
+        # another process writes a newer heartbeat before the flush
+        self.set_ts(3)
+        self.app.post('/batch', data='test.one', content_type='text/plain')
+        lovebeat.coalescer.flush()
+        self.assertEquals(3, self.last_ts())
+
+    def test_flushed_on_sigterm(self):
+        if lovebeat.app.config['STORAGE'] == 'memory':
+            self.skipTest("needs redis")
+        port = lovebeat.pool.connection_kwargs['port']
+        server = subprocess.Popen(
+            [sys.executable, '-u', '-c', SERVER % (self.EPOCH, port)],
+            stdout=subprocess.PIPE,
+            cwd=os.path.join(os.path.dirname(__file__), '..'))
+        self.assertEquals('ready\n', server.stdout.readline())
+        server.send_signal(signal.SIGTERM)
+        self.assertEquals(128 + signal.SIGTERM, server.wait())
+        self.assertEquals(5, self.last_ts())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+import lovebeat
+from base import LovebeatBase
+from werkzeug.datastructures import MultiDict
+
+
+class EvaluatorTests(LovebeatBase):
+    def setUp(self):
+        super(EvaluatorTests, self).setUp()
+        lovebeat.app.config['INLINE_EVAL'] = False
+        md = MultiDict([('heartbeat', 'warning:20'),
+                        ('heartbeat', 'error:30')])
+        self.app.post('/s/test.one', data=md)
+
+    def tearDown(self):
+        lovebeat.app.config['INLINE_EVAL'] = True
+
+    def stored_state(self):
+        return lovebeat.conn().hget('lb:s:test.one', 'state')
+
+    def test_reads_are_pure(self):
+        before = self.stored_state()
+        self.set_ts(30)
+        self.expect('test.one', 'OK')
+        self.app.get('/dashboard/all/status')
+        self.app.get('/dashboard/all/json')
+        self.app.get('/agent/bond/alerts.txt')
+        self.assertEquals(before, self.stored_state())
+        self.assertEquals(30, self.get_json('test.one')['state']['last']['delta'])
+
+    def test_evaluator_advances_state(self):
+        self.set_ts(20)
+        lovebeat.evaluator_tick()
+        self.expect('test.one', 'WARN')
+        state = self.get_json('test.one')['state']
+        self.assertEquals('warning', state['alert']['status'])
+        self.assertEquals('new', state['alert']['state'])
+
+        self.set_ts(30)
+        lovebeat.evaluator_tick()
+        self.expect('test.one', 'ERROR')
+        self.assertEquals('down+error',
+                          self.app.get('/dashboard/all/status').data)
+
+    def test_trigger_sets_status(self):
+        self.set_ts(30)
+        lovebeat.evaluator_tick()
+        self.expect('test.one', 'ERROR')
+        self.app.post('/s/test.one')
+        self.expect('test.one', 'OK')
+
+    def deadline(self, sid='test.one'):
+        score = lovebeat.conn().zscore('lb:deadlines', sid)
+        return None if score is None else score - self.EPOCH
+
+    def test_deadlines(self):
+        self.assertEquals(20, self.deadline())
+        self.set_ts(25)
+        lovebeat.evaluator_tick()
+        self.assertEquals(30, self.deadline())
+        self.set_ts(30)
+        lovebeat.evaluator_tick()
+        self.assertEquals(None, self.deadline())
+
+        self.app.post('/s/test.one/maint', data=dict(expiry=100))
+        self.assertEquals(131, self.deadline())
+        self.app.post('/s/test.one/unmaint')
+        self.assertEquals(30, self.deadline())
+        lovebeat.evaluator_tick()
+        self.expect('test.one', 'ERROR')
+        self.assertEquals(None, self.deadline())
+
+        self.app.post('/s/test.one/delete')
+        self.assertEquals(0, lovebeat.conn().zcard('lb:deadlines'))
+
+    def test_confirm_reschedules(self):
+        self.set_ts(20)
+        lovebeat.evaluator_tick()
+        self.app.post('/agent/bond/confirm/test.one/1/warning')
+        self.app.post('/s/test.one')
+        self.assertEquals(20, self.deadline())
+        lovebeat.evaluator_tick()
+        state = self.get_json('test.one')['state']
+        self.assertEquals('ok', state['alert']['status'])
+        self.assertEquals('new', state['alert']['state'])
+        self.assertEquals(40, self.deadline())
+
+    def test_only_due_services_are_evaluated(self):
+        self.app.post('/s/test.two', data=dict(heartbeat='error:100'))
+        r = lovebeat.conn()
+        # corrupt the record - it must not be touched until it's due.
+        r.hset('lb:s:test.two', 'state', 'garbage')
+        self.set_ts(30)
+        lovebeat.evaluator_tick()
+        self.assertEquals('garbage', r.hget('lb:s:test.two', 'state'))
+
+    def test_reindex_all(self):
+        lovebeat.conn().delete('lb:deadlines')
+        self.set_ts(5)
+        lovebeat.evaluator_tick(lovebeat.reindex_all)
+        self.assertEquals(20, self.deadline())
+
+
+    def test_survives_errors(self):
+        calls = []
+
+        class Stop(BaseException):
+            pass
+
+        def tick():
+            calls.append(1)
+            if len(calls) == 1:
+                raise TypeError("broken service")
+            if len(calls) == 2:
+                raise lovebeat.redis.ResponseError("script failed")
+            raise Stop()
+        saved = lovebeat.evaluator_tick
+        lovebeat.evaluator_tick = tick
+        try:
+            self.assertRaises(Stop, lovebeat.run_evaluator, 0)
+        finally:
+            lovebeat.evaluator_tick = saved
+        self.assertEquals(3, len(calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
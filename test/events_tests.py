@@ -0,0 +1,85 @@
+import json
+import Queue
+import time
+import unittest
+import lovebeat
+from base import LovebeatBase
+
+
+class EventsTests(LovebeatBase):
+    def subscribe(self, *channels):
+        pubsub = lovebeat.conn().pubsub()
+        pubsub.subscribe(['lb:events:%s' % c for c in channels])
+        messages = pubsub.listen()
+        for c in channels:
+            messages.next()
+        return messages
+
+    def next_event(self, messages):
+        message = messages.next()
+        return message['channel'][len('lb:events:'):], \
+            json.loads(message['data'])
+
+    def test_publish(self):
+        messages = self.subscribe('all', 'foo')
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        event = {'id': 'test.one', 'status': 'ok', 'last': self.EPOCH}
+        self.assertEquals(('all', event), self.next_event(messages))
+        self.assertEquals(('foo', event), self.next_event(messages))
+
+        # status transitions are published by the evaluation
+        self.expect('test.one', 'WARN', 10)
+        event['status'] = 'warning'
+        self.assertEquals(('all', event), self.next_event(messages))
+        self.assertEquals(('foo', event), self.next_event(messages))
+
+        self.app.post('/s/test.one/delete')
+        event = {'id': 'test.one', 'deleted': True}
+        self.assertEquals([('all', event), ('foo', event)],
+                          sorted([self.next_event(messages),
+                                  self.next_event(messages)]))
+
+    def test_stream(self):
+        rv = self.app.get('/dashboard/foo/events')
+        self.assertEquals('text/event-stream', rv.mimetype)
+        stream = iter(rv.response)
+        self.assertEquals('retry: 3000\n\n', stream.next())
+        self.app.post('/s/test.two')
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        data = stream.next()
+        self.assertTrue(data.startswith('data: '))
+        self.assertEquals({'id': 'test.one', 'status': 'ok',
+                           'last': self.EPOCH}, json.loads(data[6:]))
+        rv.close()
+        self.assertEquals({}, lovebeat.events.streams)
+
+    def test_errors(self):
+        events = lovebeat.Events()
+        dispatch = events.dispatch
+        failed = []
+
+        def fail_once(message, subscribed):
+            if message['type'] == 'pmessage' and not failed:
+                failed.append(message)
+                raise ValueError("bad message")
+            dispatch(message, subscribed)
+        events.dispatch = fail_once
+        queue = events.listen('foo')
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        # the streams are ended, as events were lost
+        self.assertEquals(None, queue.get(timeout=5))
+        # and events are passed on again once subscribed anew
+        deadline = time.time() + 5
+        while 1:
+            self.app.post('/s/test.one')
+            try:
+                event = json.loads(queue.get(timeout=0.2))
+                break
+            except Queue.Empty:
+                self.assertTrue(time.time() < deadline)
+        self.assertEquals('test.one', event['id'])
+        events.unlisten('foo', queue)
+
+
+if __name__ == '__main__':
+    unittest.main()
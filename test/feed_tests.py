@@ -0,0 +1,105 @@
+import unittest
+import lovebeat
+from base import LovebeatBase
+from werkzeug.datastructures import MultiDict
+
+
+class FeedTests(LovebeatBase):
+    def setUp(self):
+        super(FeedTests, self).setUp()
+        md1 = MultiDict([('heartbeat', 'warning:20'),
+                         ('heartbeat', 'error:30'),
+                         ('labels', 'foo')])
+        md2 = MultiDict([('heartbeat', 'warning:25'),
+                         ('heartbeat', 'error:35'),
+                         ('labels', 'foo')])
+        self.app.post('/s/test.one', data=md1)
+        self.app.post('/s/test.two', data=md2)
+        self.app.post('/s/test.three', data=dict(heartbeat='warning:20'))
+        md = MultiDict([('alert', 'warning:email:foo@example.com'),
+                        ('alert', 'error:sms:0015551234')])
+        self.app.post('/l/foo', data=md)
+
+    def feed(self, agent, count=10):
+        rv = self.app.get('/agent/%s/feed.txt?wait=0&count=%d' %
+                          (agent, count))
+        self.assertEquals(200, rv.status_code)
+        lines = rv.data.split('\n')
+        self.assertEquals(['1'], lines[:1])
+        self.assertEquals(['ENDFILE', ''], lines[-2:])
+        return [lines[i + 1] for i, line in enumerate(lines)
+                if line == 'SERVICE']
+
+    def test_feed(self):
+        self.assertEquals([], self.feed('bond'))
+        self.set_ts(20)
+        rv = self.app.get('/agent/bond/feed.txt?wait=0')
+        self.assertTrue('SERVICE\ntest.one\nALERTID\n1\nTYPE\nwarning\n'
+                        'TO\nemail:foo@example.com\n' in rv.data)
+        # test.three has no recipients
+        self.assertFalse('test.three' in rv.data)
+        # an alert is only read once
+        self.assertEquals([], self.feed('bond'))
+
+    def test_shared(self):
+        # keep test.three from taking up an entry
+        self.set_ts(10)
+        self.app.post('/s/test.three')
+        self.set_ts(25)
+        one = self.feed('bond', 1)
+        two = self.feed('smiley', 1)
+        self.assertEquals(['test.one', 'test.two'], sorted(one + two))
+        self.assertEquals([], self.feed('bond'))
+        self.assertEquals([], self.feed('smiley'))
+
+    def test_handled(self):
+        self.expect('test.one', 'WARN', 20)
+        self.app.post('/agent/bond/confirm/test.one/1/warning')
+        self.app.post('/s/test.one')
+        self.assertEquals([], self.feed('bond'))
+        # a new alert can be raised when the recovery has been confirmed
+        self.app.post('/agent/bond/confirm/test.one/1/ok')
+        self.set_ts(50)
+        self.assertEquals(['test.one', 'test.two'], sorted(self.feed('bond')))
+
+    def pending(self):
+        return lovebeat.conn().execute_command('XPENDING', 'lb:alerts',
+                                               'agents')[0]
+
+    def test_confirm(self):
+        self.set_ts(20)
+        self.assertEquals(['test.one'], self.feed('bond'))
+        # test.three's alert has no recipients, so nobody will confirm it
+        self.assertEquals(1, self.pending())
+        rv = self.app.post('/agent/bond/confirm/test.one/1/warning')
+        self.assertEquals('ok', rv.data)
+        self.assertEquals(0, self.pending())
+        self.assertEquals({}, lovebeat.conn().hgetall('lb:alerts:entries'))
+
+    def test_redelivery(self):
+        lovebeat.app.config['CLAIM_TIMEOUT'] = 0
+        try:
+            self.set_ts(20)
+            self.assertEquals(['test.one'], self.feed('bond'))
+            rv = self.app.post('/agent/bond/claim/test.one/1/warning')
+            self.assertEquals('ok', rv.data)
+            # bond never confirms it
+            self.set_ts(21)
+            self.assertEquals(['test.one'], self.feed('smiley'))
+            rv = self.app.post('/agent/smiley/claim/test.one/1/warning')
+            self.assertEquals('ok', rv.data)
+            self.app.post('/agent/smiley/confirm/test.one/1/warning')
+            self.assertEquals([], self.feed('bond'))
+            self.assertEquals(0, self.pending())
+        finally:
+            lovebeat.app.config['CLAIM_TIMEOUT'] = 300
+
+    def test_bad_args(self):
+        rv = self.app.get('/agent/bond/feed.txt?wait=soon')
+        self.assertEquals(400, rv.status_code)
+        rv = self.app.get('/agent/bond/feed.txt?count=0')
+        self.assertEquals(400, rv.status_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 import json
+import re
 import unittest
+import lovebeat
 from base import LovebeatBase
 
 
@@ -44,6 +46,99 @@ class LabelsTests(LovebeatBase):
         self.assertEquals(['one', 'two'],
                           obj['services'][0]['config']['labels'])
 
+    def test_sorted(self):
+        for sid in ('test.b', 'test.c', 'test.a'):
+            self.app.post('/s/%s' % sid, data=dict(labels='one'))
+        obj = json.loads(self.app.get('/dashboard/one/json').data)
+        self.assertEquals(['test.a', 'test.b', 'test.c'],
+                          [s['id'] for s in obj['services']])
+        data = self.app.get('/dashboard/one/raw').data
+        self.assertTrue(data.index('test.a') < data.index('test.b') <
+                        data.index('test.c'))
+
+    def overview(self):
+        data = self.app.get('/dashboard/').data
+        return re.findall(r'data-label="([^"]*)" data-status="([^"]*)" '
+                          r'data-size="(\d+)"', data)
+
+    def test_overview(self):
+        self.app.post('/s/test.one', data=dict(labels='foo,bar'))
+        self.app.post('/s/test.two', data=dict(labels='foo',
+                                               heartbeat='warning:5'))
+        self.app.post('/l/empty')
+        self.assertEquals([('all', 'ok', '2'), ('bar', 'ok', '1'),
+                           ('empty', '', '0'), ('foo', 'ok', '2')],
+                          self.overview())
+        self.set_ts(6)
+        self.assertEquals([('all', 'warning', '2'), ('bar', 'ok', '1'),
+                           ('empty', '', '0'), ('foo', 'warning', '2')],
+                          self.overview())
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        self.app.post('/s/test.two/delete')
+        self.assertEquals([('all', 'ok', '1'), ('bar', '', '0'),
+                           ('empty', '', '0'), ('foo', 'ok', '1')],
+                          self.overview())
+
+    def test_upgrade(self):
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        # as stored by previous versions
+        db = lovebeat.conn()
+        for key in ('lb:labels', 'lb:services:all', 'lb:services:foo'):
+            members = db.zrange(key, 0, -1)
+            db.delete(key)
+            db.sadd(key, *members)
+        lovebeat.upgrade_label_index(db)
+        for key in ('lb:labels', 'lb:services:all', 'lb:services:foo'):
+            self.assertEquals('zset', db.type(key))
+        obj = json.loads(self.app.get('/dashboard/foo/json').data)
+        self.assertEquals(['test.one'], [s['id'] for s in obj['services']])
+
+    def services(self, lbl):
+        obj = json.loads(self.app.get('/dashboard/%s/json' % lbl).data)
+        return [s['id'] for s in obj['services']]
+
+    def test_hierarchy(self):
+        self.app.post('/s/test.db', data=dict(labels='prod/eu/db'))
+        self.app.post('/s/test.web', data=dict(labels='/Prod/eu/web/'))
+        self.app.post('/s/test.us', data=dict(labels='prod/us,web',
+                                              heartbeat='warning:5'))
+        obj = json.loads(self.app.get('/dashboard/all/json').data)
+        self.assertEquals(['prod/eu/web'], obj['services'][2]['config']
+                          ['labels'])
+        self.assertEquals(['test.db', 'test.us', 'test.web'],
+                          self.services('prod'))
+        self.assertEquals(['test.db', 'test.web'], self.services('prod/eu'))
+        self.assertEquals(['test.db'], self.services('prod/eu/db'))
+        self.assertEquals(['test.us'], self.services('web'))
+        self.assertEquals([], self.services('eu'))
+        self.set_ts(6)
+        status = self.app.get('/dashboard/prod/status').data
+        self.assertEquals('down+warning', status)
+        status = self.app.get('/dashboard/prod/eu/status').data
+        self.assertEquals('up+flawless', status)
+        self.assertEquals(['all', 'prod', 'prod/eu', 'prod/eu/db',
+                           'prod/eu/web', 'prod/us', 'web'],
+                          [l[0] for l in self.overview()])
+
+        # moving a service within the tree
+        self.app.post('/s/test.db', data=dict(labels='prod/us/db'))
+        self.assertEquals(['test.db', 'test.us', 'test.web'],
+                          self.services('prod'))
+        self.assertEquals(['test.web'], self.services('prod/eu'))
+        self.assertEquals(['test.db', 'test.us'], self.services('prod/us'))
+        self.assertEquals([], self.services('prod/eu/db'))
+        self.app.post('/s/test.db/delete')
+        self.assertEquals(['test.us', 'test.web'], self.services('prod'))
+
+    def test_reindex(self):
+        self.app.post('/s/test.db', data=dict(labels='prod/eu/db'))
+        # as indexed by previous versions
+        db = lovebeat.conn()
+        db.delete('lb:services:prod', 'lb:services:prod/eu')
+        lovebeat.evaluator_tick(lovebeat.reindex_all)
+        self.assertEquals(['test.db'], self.services('prod'))
+        self.assertEquals(['test.db'], self.services('prod/eu'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,63 @@
+import json
+import unittest
+from base import LovebeatBase
+
+
+class ListTests(LovebeatBase):
+    def setUp(self):
+        super(ListTests, self).setUp()
+        for i in range(7):
+            self.app.post('/s/prod.node%d' % i, data=dict(labels='prod'))
+        self.app.post('/s/test.node0', data=dict(heartbeat='error:100'))
+
+    def page(self, url):
+        obj = json.loads(self.app.get(url).data)
+        return [s['id'] for s in obj['services']], obj['cursor']
+
+    def test_paging(self):
+        sids, cursor = self.page('/dashboard/all/list?limit=3')
+        self.assertEquals(['prod.node0', 'prod.node1', 'prod.node2'], sids)
+        seen = sids
+        while cursor:
+            sids, cursor = self.page('/dashboard/all/list?limit=3&cursor=%s'
+                                     % cursor)
+            seen += sids
+        self.assertEquals(['prod.node%d' % i for i in range(7)] +
+                          ['test.node0'], seen)
+
+    def test_exact_last_page(self):
+        sids, cursor = self.page('/dashboard/prod/list?limit=7')
+        self.assertEquals(7, len(sids))
+        self.assertEquals(None, cursor)
+
+    def test_status_filter(self):
+        self.set_ts(30)
+        self.app.post('/s/prod.node3')
+        sids, cursor = self.page('/dashboard/all/list?status=ok')
+        self.assertEquals(['prod.node3', 'test.node0'], sids)
+        sids, cursor = self.page('/dashboard/prod/list?status=error,warning'
+                                 '&limit=2')
+        self.assertEquals(['prod.node0', 'prod.node1'], sids)
+        sids, cursor = self.page('/dashboard/prod/list?status=error,warning'
+                                 '&limit=2&cursor=%s' % cursor)
+        self.assertEquals(['prod.node2', 'prod.node4'], sids)
+
+    def test_prefix_filter(self):
+        sids, cursor = self.page('/dashboard/all/list?prefix=test.')
+        self.assertEquals(['test.node0'], sids)
+        sids, cursor = self.page('/dashboard/all/list?prefix=prod.node&limit=4')
+        self.assertEquals(4, len(sids))
+        sids, cursor = self.page('/dashboard/all/list?prefix=prod.node'
+                                 '&cursor=%s' % cursor)
+        self.assertEquals(['prod.node4', 'prod.node5', 'prod.node6'], sids)
+        self.assertEquals(None, cursor)
+
+    def test_bad_requests(self):
+        rv = self.app.get('/dashboard/all/list?status=bad')
+        self.assertEquals(400, rv.status_code)
+        rv = self.app.get('/dashboard/all/list?limit=0')
+        self.assertEquals(400, rv.status_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import lovebeat
 from base import LovebeatBase
 from werkzeug.datastructures import MultiDict
 
@@ -88,6 +89,21 @@ class SimpleTests(LovebeatBase):
         self.expect('test.one', 'OK', 10 + 20 + 1)
         self.expect('test.one', 'ERROR', 20 + 15)
 
+    def test_unknown_service(self):
+        self.app.post('/s/test.one')
+        db = lovebeat.conn()
+        for path in ('/s/test.unknown/maint', '/s/test.unknown/unmaint'):
+            self.assertEquals(200, self.app.post(path).status_code)
+            self.assertEquals(None, db.zscore('lb:deadlines', 'test.unknown'))
+        # as scheduled by previous versions
+        db.zadd('lb:deadlines', lovebeat.get_ts(), 'test.unknown')
+        with lovebeat.app.test_request_context():
+            lovebeat.evaluate(lovebeat.get_ts())
+        self.assertEquals(None, db.zscore('lb:deadlines', 'test.unknown'))
+        self.expect('test.one', 'OK')
+        rv = self.app.get('/dashboard/all/status')
+        self.assertEquals('up+flawless', rv.data)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,129 @@
+import cPickle as pickle
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import lovebeat
+import lovebeat_memory
+from base import LovebeatBase
+from werkzeug.datastructures import MultiDict
+
+
+class MemoryTests(LovebeatBase):
+    def setUp(self):
+        super(MemoryTests, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.saved = (lovebeat.app.config['STORAGE'], lovebeat.memory_store,
+                      lovebeat_memory.MIN_COMPACT_SIZE)
+        lovebeat.app.config['STORAGE'] = 'memory'
+        lovebeat.app.config['MEMORY_LOG'] = os.path.join(self.dir, 'log')
+        self.restart()
+
+    def tearDown(self):
+        lovebeat.memory_store.log.close()
+        (lovebeat.app.config['STORAGE'], lovebeat.memory_store,
+         lovebeat_memory.MIN_COMPACT_SIZE) = self.saved
+        lovebeat.app.config['MEMORY_LOG'] = None
+        lovebeat.thresholds.clear()
+        lovebeat.routing = None
+        shutil.rmtree(self.dir)
+
+    def restart(self):
+        if lovebeat.memory_store is not self.saved[1]:
+            lovebeat.memory_store.log.close()
+        lovebeat.memory_store = None
+        lovebeat.thresholds.clear()
+        lovebeat.routing = None
+
+    def populate(self):
+        md = MultiDict([('alert', 'error:email:foo@example.com')])
+        self.app.post('/l/foo', data=md)
+        self.app.post('/s/test.one', data=dict(labels='foo', value=2.5))
+        self.app.post('/s/test.two', data=dict(heartbeat='warning:5'))
+        self.app.post('/s/test.three', data=dict(threshold='error:10',
+                                                 aggregate='avg', window=60))
+        self.set_ts(30)
+        self.app.post('/s/test.three', data=dict(value=12))
+        self.app.get('/agent/bond/feed.txt?wait=0')
+
+    def dump(self):
+        return (json.loads(self.app.get('/dashboard/all/json').data),
+                self.app.get('/dashboard/foo/list').data,
+                self.app.get('/s/test.one/series?from=0&res=0').data,
+                self.app.get('/agent/bond/alerts.txt').data,
+                lovebeat.conn().execute_command('XPENDING', 'lb:alerts',
+                                                'agents'))
+
+    def test_restart(self):
+        self.populate()
+        before = self.dump()
+        self.assertEquals(1, before[-1][0])
+        self.restart()
+        self.assertEquals(before, self.dump())
+        # the feed entry is handed out again after CLAIM_TIMEOUT
+        lovebeat.app.config['CLAIM_TIMEOUT'] = 0
+        try:
+            data = self.app.get('/agent/james/feed.txt?wait=0').data
+        finally:
+            lovebeat.app.config['CLAIM_TIMEOUT'] = 300
+        self.assertTrue('test.one' in data)
+
+    def test_compact(self):
+        lovebeat_memory.MIN_COMPACT_SIZE = 0
+        self.populate()
+        before = self.dump()
+        log = lovebeat.app.config['MEMORY_LOG']
+        self.assertTrue(os.path.getsize(log) <
+                        2 * lovebeat.memory_store.snapshot_size)
+        self.restart()
+        self.assertEquals(before, self.dump())
+
+    def test_script_log(self):
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        records = []
+        with open(lovebeat.app.config['MEMORY_LOG'], 'rb') as f:
+            while 1:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+        # a single record for all that the trigger wrote
+        self.assertEquals(['SNAPSHOT', 'EVAL'], [r[0] for r in records])
+        self.assertEquals('trigger.lua', records[1][1])
+
+    def test_watch(self):
+        db = lovebeat.conn()
+        db.set('foo', 1)
+
+        def trans(pipe):
+            value = int(pipe.get('foo'))
+            if value == 1:
+                db.set('foo', 10)
+            pipe.multi()
+            pipe.set('foo', value + 1)
+        db.transaction(trans, 'foo')
+        self.assertEquals('11', db.get('foo'))
+
+
+class SortedSetTests(unittest.TestCase):
+    def test_order(self):
+        z = lovebeat_memory.SortedSet()
+        z.RUN = 2
+        for i in range(20):
+            z.add('m%02d' % i, i % 5)
+        z.remove('m03')
+        z.add('m04', 1)
+        items = sorted((i % 5, 'm%02d' % i) for i in range(20) if i != 3)
+        items.remove((4, 'm04'))
+        items = sorted(items + [(1, 'm04')])
+        self.assertEquals(items, list(z))
+        self.assertEquals(items[2:-3], z.range(slice(2, -3)))
+        self.assertEquals([item for item in items if 1 < item[0] <= 3],
+                          z.range_by_score('(1', '3'))
+        z = pickle.loads(pickle.dumps(z, pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(items, list(z))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import lovebeat
+from base import LovebeatBase
+
+
+class MetricsTests(LovebeatBase):
+    def tearDown(self):
+        lovebeat.app.config['METRICS_CACHE'] = 0
+        lovebeat.metrics_cache = None
+
+    def metrics(self, **headers):
+        rv = self.app.get('/metrics', headers=headers)
+        self.assertEquals(200, rv.status_code)
+        return rv
+
+    def samples(self, name):
+        lines = self.metrics().data.splitlines()
+        return sorted(line for line in lines if line.startswith(name + '{'))
+
+    def test_metrics(self):
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        self.app.post('/s/test.two', data=dict(heartbeat='warning:5'))
+        self.app.post('/s/test."three"')
+        self.set_ts(7)
+        self.app.post('/s/test.one')
+        self.assertEquals([
+            'lovebeat_services{label="all",status="error"} 0',
+            'lovebeat_services{label="all",status="maint"} 0',
+            'lovebeat_services{label="all",status="ok"} 2',
+            'lovebeat_services{label="all",status="warning"} 1',
+            'lovebeat_services{label="foo",status="error"} 0',
+            'lovebeat_services{label="foo",status="maint"} 0',
+            'lovebeat_services{label="foo",status="ok"} 1',
+            'lovebeat_services{label="foo",status="warning"} 0'],
+            self.samples('lovebeat_services'))
+        self.assertEquals([
+            'lovebeat_service_heartbeat_age_seconds'
+            '{service="test.\\"three\\""} 7',
+            'lovebeat_service_heartbeat_age_seconds{service="test.one"} 0',
+            'lovebeat_service_heartbeat_age_seconds{service="test.two"} 7'],
+            self.samples('lovebeat_service_heartbeat_age_seconds'))
+        self.assertEquals([
+            'lovebeat_service_status'
+            '{service="test.\\"three\\"",status="ok"} 1',
+            'lovebeat_service_status{service="test.one",status="ok"} 1',
+            'lovebeat_service_status{service="test.two",status="warning"} 1'],
+            self.samples('lovebeat_service_status'))
+
+        # deleted services are gone
+        self.app.post('/s/test.two/delete')
+        samples = self.samples('lovebeat_service_status')
+        self.assertEquals(2, len(samples))
+        self.assertFalse([line for line in samples if 'test.two' in line])
+
+    def test_format(self):
+        self.app.post('/s/test.one')
+        rv = self.metrics()
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        self.assertTrue('# TYPE lovebeat_services gauge' in rv.data)
+        rv = self.metrics(Accept='application/openmetrics-text')
+        self.assertTrue(rv.content_type.startswith(
+            'application/openmetrics-text'))
+        self.assertTrue(rv.data.endswith('# EOF\n'))
+
+    def test_cache(self):
+        lovebeat.app.config['METRICS_CACHE'] = 15
+        self.app.post('/s/test.one')
+        before = self.metrics().data
+        self.set_ts(10)
+        self.app.post('/s/test.two')
+        self.assertEquals(before, self.metrics().data)
+        self.set_ts(15)
+        self.assertEquals(2, len(self.samples('lovebeat_service_status')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import json
+import threading
+import unittest
+import lovebeat
+import redis
+from base import LovebeatBase
+from werkzeug.datastructures import MultiDict
+
+REPLICA = 'redis://localhost:16380/0'
+
+
+class PoolTests(LovebeatBase):
+    def setUp(self):
+        super(PoolTests, self).setUp()
+        if lovebeat.app.config['STORAGE'] != 'redis':
+            self.skipTest("needs redis")
+        self.saved = dict((k, v) for k, v in lovebeat.app.config.items()
+                          if k.startswith('REDIS_'))
+        kwargs = lovebeat.pool.connection_kwargs
+        self.url = 'redis://%s:%d/%d' % (kwargs['host'], kwargs['port'],
+                                         kwargs['db'])
+
+    def tearDown(self):
+        lovebeat.app.config.update(self.saved)
+        lovebeat.app.config['INLINE_EVAL'] = True
+
+    def test_replicas(self):
+        replica = lovebeat.make_pool(REPLICA)
+        try:
+            redis.StrictRedis(connection_pool=replica).flushdb()
+        except redis.ConnectionError:
+            self.skipTest("needs redis on the port 16380")
+        lovebeat.app.config['REDIS_REPLICAS'] = [REPLICA]
+        lovebeat.app.config['INLINE_EVAL'] = False
+        md = MultiDict([('alert', 'error:email:foo@example.com')])
+        self.app.post('/l/foo', data=md)
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        # written to the primary, but read from the (empty) replica
+        self.assertTrue(lovebeat.conn().exists('lb:s:test.one'))
+        obj = json.loads(self.app.get('/dashboard/all/json').data)
+        self.assertEquals([], obj['services'])
+        self.assertEquals({}, json.loads(self.app.get('/l/foo').data))
+
+        lovebeat.app.config['REDIS_REPLICAS'] = []
+        obj = json.loads(self.app.get('/dashboard/all/json').data)
+        self.assertEquals(['test.one'], [s['id'] for s in obj['services']])
+        config = json.loads(self.app.get('/l/foo').data)
+        self.assertEquals(['email:foo@example.com'], config['alerts']['error'])
+
+    def test_blocking_pool(self):
+        lovebeat.app.config.update(REDIS_MAX_CONNECTIONS=1,
+                                   REDIS_POOL_BLOCK=True,
+                                   REDIS_POOL_TIMEOUT=0.1)
+        pool = lovebeat.make_pool(self.url)
+        connection = pool.get_connection('GET')
+        self.assertRaises(redis.ConnectionError, pool.get_connection, 'GET')
+        threading.Timer(0.05, pool.release, [connection]).start()
+        self.assertTrue(pool.get_connection('GET') is connection)
+
+    def test_timeouts(self):
+        lovebeat.app.config.update(REDIS_SOCKET_TIMEOUT=0.1,
+                                   REDIS_CONNECT_TIMEOUT=1)
+        db = redis.StrictRedis(connection_pool=lovebeat.make_pool(self.url))
+        self.assertRaises(redis.ConnectionError, db.blpop, 'test.list', 1)
+        # but not when waiting on purpose
+        self.assertEquals(None, lovebeat.untimed(db).blpop('test.list', 1))
+
+    def test_url(self):
+        kwargs = lovebeat.make_pool(
+            'unix://:secret@/tmp/redis.sock?db=3').connection_kwargs
+        self.assertEquals(('/tmp/redis.sock', 3, 'secret'),
+                          (kwargs['path'], kwargs['db'], kwargs['password']))
+        kwargs = lovebeat.make_pool('redis://example.com').connection_kwargs
+        self.assertEquals(('example.com', 6379, 0),
+                          (kwargs['host'], kwargs['port'], kwargs['db']))
+
+
+if __name__ == '__main__':
+    unittest.main()
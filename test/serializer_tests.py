@@ -0,0 +1,51 @@
+import unittest
+import lovebeat
+from base import LovebeatBase
+from werkzeug.datastructures import MultiDict
+
+
+@unittest.skipIf(lovebeat.msgpack is None, "msgpack is not installed")
+class SerializerTests(LovebeatBase):
+    def tearDown(self):
+        lovebeat.app.config['SERIALIZER'] = 'json'
+
+    def raw(self, sid, field):
+        return lovebeat.conn().hget('lb:s:%s' % sid, field)
+
+    def test_msgpack(self):
+        lovebeat.app.config['SERIALIZER'] = 'msgpack'
+        md = MultiDict([('heartbeat', 'warning:20'), ('labels', 'foo')])
+        self.app.post('/s/test.one', data=md)
+        self.assertNotEquals('{', self.raw('test.one', 'conf')[0])
+        self.assertNotEquals('{', self.raw('test.one', 'state')[0])
+        config = self.get_config('test.one')
+        self.assertEquals(20, config['heartbeat']['warning'])
+        self.assertEquals(None, config['heartbeat']['error'])
+        self.assertEquals(['foo'], config['labels'])
+        self.expect('test.one', 'WARN', 20)
+
+    def test_online_migration(self):
+        self.app.post('/s/test.one', data=dict(labels='foo'))
+        self.app.post('/s/test.two')
+        self.assertEquals('{', self.raw('test.one', 'conf')[0])
+
+        lovebeat.app.config['SERIALIZER'] = 'msgpack'
+        self.app.post('/s/test.one')
+        self.assertNotEquals('{', self.raw('test.one', 'conf')[0])
+        self.assertEquals(['foo'], self.get_config('test.one')['labels'])
+        # not triggered yet
+        self.assertEquals('{', self.raw('test.two', 'state')[0])
+
+        lovebeat.evaluator_tick(lovebeat.migrate_all)
+        self.assertNotEquals('{', self.raw('test.two', 'conf')[0])
+        self.assertNotEquals('{', self.raw('test.two', 'state')[0])
+        self.expect('test.two', 'ERROR', 20)
+
+        lovebeat.app.config['SERIALIZER'] = 'json'
+        lovebeat.evaluator_tick(lovebeat.migrate_all)
+        self.assertEquals('{', self.raw('test.two', 'state')[0])
+        self.assertEquals([], self.get_config('test.two')['labels'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import json
+import unittest
+import lovebeat
+from base import LovebeatBase
+
+
+class SeriesTests(LovebeatBase):
+    def post(self, ts, value):
+        self.set_ts(ts)
+        rv = self.app.post('/s/test.one', data=dict(value=value))
+        self.assertEquals(200, rv.status_code)
+
+    def series(self, query):
+        rv = self.app.get('/s/test.one/series?' + query)
+        self.assertEquals(200, rv.status_code)
+        return json.loads(rv.data)
+
+    def test_value(self):
+        self.post(0, '2.5')
+        self.assertEquals(2.5, self.get_json('test.one')['state']['last']['val'])
+        self.app.post('/s/test.one')
+        self.assertEquals(1, self.get_json('test.one')['state']['last']['val'])
+        history = lovebeat.conn().lrange('lb:s:test.one:h', 0, -1)
+        self.assertEquals(['%d:1' % self.EPOCH, '%d:2.5' % self.EPOCH],
+                          history)
+
+    def test_raw(self):
+        for ts, value in ((0, 1), (10, 2), (20, 4.5)):
+            self.post(ts, value)
+        obj = self.series('from=%d' % (self.EPOCH + 5))
+        self.assertEquals(0, obj['resolution'])
+        self.assertEquals([[self.EPOCH + 10, 2], [self.EPOCH + 20, 4.5]],
+                          obj['points'])
+
+    def test_rollups(self):
+        for ts, value in ((0, 1), (30, 3), (60, 10), (3600, 5)):
+            self.post(ts, value)
+        e = self.EPOCH
+        obj = self.series('from=%d&res=60' % e)
+        self.assertEquals([[e, 2, 2, 1, 3], [e + 60, 1, 10, 10, 10],
+                           [e + 3600, 1, 5, 5, 5]], obj['points'])
+        obj = self.series('from=%d&res=3600' % e)
+        self.assertEquals([[e, 3, 14 / 3.0, 1, 10], [e + 3600, 1, 5, 5, 5]],
+                          obj['points'])
+        obj = self.series('from=%d&res=120' % e)
+        self.assertEquals([[e, 3, 14 / 3.0, 1, 10], [e + 3600, 1, 5, 5, 5]],
+                          obj['points'])
+
+    def test_retention(self):
+        self.post(0, 1)
+        self.post(10 * 86400, 2)
+        e = self.EPOCH
+        # raw values and minute rollups of the first day are gone by now
+        obj = self.series('from=%d' % e)
+        self.assertEquals(3600, obj['resolution'])
+        self.assertEquals([[e, 1, 1, 1, 1], [e + 10 * 86400, 1, 2, 2, 2]],
+                          obj['points'])
+        obj = self.series('from=%d' % (e + 9 * 86400))
+        self.assertEquals(60, obj['resolution'])
+        ttl = lovebeat.conn().ttl('lb:s:test.one:ts:0:%d' % ((e + 10 * 86400) / 3600))
+        self.assertEquals(7 * 3600, ttl)
+
+    def test_bad_values(self):
+        rv = self.app.post('/s/test.one', data=dict(value='nan'))
+        self.assertEquals(400, rv.status_code)
+        rv = self.app.post('/s/test.one', data=dict(value='many'))
+        self.assertEquals(400, rv.status_code)
+        rv = self.app.get('/s/test.one/series?res=-1')
+        self.assertEquals(400, rv.status_code)
+
+    def test_delete(self):
+        self.post(0, 1)
+        self.app.post('/s/test.one/delete')
+        self.assertEquals([], lovebeat.conn().keys('lb:s:test.one*'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import json
+import unittest
+import lovebeat
+import redis
+from base import LovebeatBase
+from werkzeug.datastructures import MultiDict
+
+SHARDS = ['redis://localhost:16380/0', 'redis://localhost:16381/0']
+NEW_SHARD = 'redis://localhost:16382/0'
+
+
+class ShardTests(LovebeatBase):
+    def setUp(self):
+        super(ShardTests, self).setUp()
+        for url in SHARDS + [NEW_SHARD]:
+            try:
+                lovebeat.shard_conn(url).flushdb()
+            except redis.ConnectionError:
+                self.skipTest("needs redis on the ports 16380 to 16382")
+        lovebeat.app.config['SHARDS'] = SHARDS
+        items = [{'id': 'test.%d' % i, 'labels': ['foo'] if i % 2 else [],
+                  'heartbeat': {'warning': 20, 'error': 30}}
+                 for i in range(30)]
+        self.app.post('/batch', data=json.dumps(items),
+                      content_type='application/json')
+
+    def tearDown(self):
+        lovebeat.app.config['SHARDS'] = []
+        lovebeat.app.config['PREVIOUS_SHARDS'] = []
+
+    def stored(self, url):
+        return set(lovebeat.shard_conn(url).zrange('lb:services:all', 0, -1))
+
+    def expect_placement(self):
+        ring = lovebeat.get_ring(lovebeat.app.config['SHARDS'])
+        for url in SHARDS + [NEW_SHARD]:
+            for sid in self.stored(url):
+                self.assertEquals(ring.owner(sid), url)
+                db = lovebeat.shard_conn(url)
+                self.assertTrue(db.exists('lb:s:%s' % sid))
+
+    def services(self, lbl):
+        data = self.app.get('/dashboard/%s/json' % lbl).data
+        return dict((s['id'], s) for s in json.loads(data)['services'])
+
+    def test_spread(self):
+        self.assertEquals([], lovebeat.conn().keys('lb:s:*'))
+        self.assertTrue(self.stored(SHARDS[0]))
+        self.assertTrue(self.stored(SHARDS[1]))
+        self.expect_placement()
+        self.assertEquals(30, len(self.services('all')))
+        self.assertEquals(15, len(self.services('foo')))
+
+        self.set_ts(20)
+        self.app.post('/s/test.1')
+        statuses = [s['state']['status']
+                    for s in self.services('all').values()]
+        self.assertEquals(29, statuses.count('warning'))
+        self.assertEquals('down+warning',
+                          self.app.get('/dashboard/foo/status').data)
+        page = json.loads(self.app.get(
+            '/dashboard/foo/list?status=warning&limit=5').data)
+        self.assertEquals(['test.11', 'test.13', 'test.15', 'test.17',
+                           'test.19'], [s['id'] for s in page['services']])
+
+    def test_metrics(self):
+        # the labels of services are only stored on the shards
+        self.assertEquals([], lovebeat.conn().zrange('lb:labels', 0, -1))
+        rv = self.app.get('/metrics')
+        self.assertTrue('lovebeat_services{label="foo",status="ok"} 15'
+                        in rv.data)
+
+    def test_alerts(self):
+        md = MultiDict([('alert', 'warning:email:foo@example.com')])
+        self.app.post('/l/foo', data=md)
+        self.set_ts(20)
+        rv = self.app.get('/agent/bond/feed.txt?wait=0')
+        lines = rv.data.split('\n')
+        sids = [lines[i + 1] for i, line in enumerate(lines)
+                if line == 'SERVICE']
+        self.assertEquals(15, len(sids))
+        for sid in sids:
+            rv = self.app.post('/agent/bond/confirm/%s/1/warning' % sid)
+            self.assertEquals('ok', rv.data)
+        for url in SHARDS:
+            pending = lovebeat.shard_conn(url).execute_command(
+                'XPENDING', 'lb:alerts', 'agents')
+            self.assertEquals(0, pending[0])
+
+    def test_rebalance(self):
+        lovebeat.app.config['PREVIOUS_SHARDS'] = SHARDS
+        lovebeat.app.config['SHARDS'] = SHARDS + [NEW_SHARD]
+        ring = lovebeat.get_ring(SHARDS + [NEW_SHARD])
+        moving = [sid for sid in self.services('all')
+                  if ring.owner(sid) == NEW_SHARD]
+        self.assertTrue(moving)
+        # services are moved when they are used
+        self.set_ts(10)
+        self.app.post('/s/%s' % moving[0])
+        self.assertEquals(set([moving[0]]), self.stored(NEW_SHARD))
+
+        lovebeat.evaluator_tick(lovebeat.rebalance)
+        self.assertEquals(set(moving), self.stored(NEW_SHARD))
+        self.expect_placement()
+        lovebeat.app.config['PREVIOUS_SHARDS'] = []
+        self.assertEquals(30, len(self.services('all')))
+        self.assertEquals(15, len(self.services('foo')))
+        self.set_ts(25)
+        services = self.services('all')
+        self.assertEquals('ok', services[moving[0]]['state']['status'])
+        statuses = [s['state']['status'] for s in services.values()]
+        self.assertEquals(29, statuses.count('warning'))
+
+    def test_rebalance_leftover(self):
+        lovebeat.app.config['PREVIOUS_SHARDS'] = SHARDS
+        lovebeat.app.config['SHARDS'] = SHARDS + [NEW_SHARD]
+        ring = lovebeat.get_ring(SHARDS + [NEW_SHARD])
+        sid = [sid for sid in self.services('all')
+               if ring.owner(sid) == NEW_SHARD][0]
+        # as if a move had failed after copying the keys
+        lovebeat.shard_conn(NEW_SHARD).hset('lb:s:%s' % sid, 'conf', 'x')
+        self.set_ts(10)
+        self.app.post('/s/%s' % sid)
+        self.assertEquals(set([sid]), self.stored(NEW_SHARD))
+        self.set_ts(25)
+        lovebeat.app.config['PREVIOUS_SHARDS'] = []
+        services = self.services('all')
+        self.assertEquals('ok', services[sid]['state']['status'])
+        self.assertEquals(30, len(services))
+
+    def test_unix_socket(self):
+        self.assertRaises(ValueError, lovebeat.get_ring,
+                          SHARDS + ['unix:///tmp/redis.sock?db=0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import threading
+import unittest
+import lovebeat
+from base import LovebeatBase
+
+
+class StatsTests(LovebeatBase):
+    def setUp(self):
+        super(StatsTests, self).setUp()
+        self.sample = lovebeat.app.config['STATS_SAMPLE']
+        lovebeat.app.config['STATS_SAMPLE'] = 1
+
+    def tearDown(self):
+        lovebeat.app.config['STATS_SAMPLE'] = self.sample
+
+    def stats(self):
+        return json.loads(self.app.get('/stats').data)
+
+    def route(self, stats, name):
+        return stats['routes'].get(name, {'requests': 0, 'sampled': 0,
+                                          'round_trips': 0,
+                                          'histogram': {'+Inf': 0}})
+
+    def test_routes(self):
+        before = self.stats()
+        self.app.post('/s/test.one')
+        self.app.post('/s/test.two')
+        self.app.get('/dashboard/all/json')
+        after = self.stats()
+        old = self.route(before, 'POST /s/<sid>')
+        new = self.route(after, 'POST /s/<sid>')
+        self.assertEquals(2, new['requests'] - old['requests'])
+        self.assertEquals(2, new['sampled'] - old['sampled'])
+        self.assertEquals(2, new['histogram']['+Inf'] -
+                          old['histogram']['+Inf'])
+        if lovebeat.app.config['STORAGE'] == 'redis':
+            self.assertTrue(new['round_trips'] > old['round_trips'])
+        for timer in ('evaluate', 'get_services', 'render'):
+            self.assertTrue(after['timers'][timer]['calls'] >
+                            before['timers'].get(timer, {'calls': 0})['calls'])
+
+    def test_sample(self):
+        lovebeat.app.config['STATS_SAMPLE'] = 2
+        before = self.route(self.stats(), 'GET /dashboard/<path:lbl>/status')
+        for i in range(4):
+            self.app.get('/dashboard/all/status')
+        after = self.route(self.stats(), 'GET /dashboard/<path:lbl>/status')
+        self.assertEquals(4, after['requests'] - before['requests'])
+        self.assertEquals(2, after['sampled'] - before['sampled'])
+
+    def test_threads(self):
+        before = lovebeat.instruments.read().get('test.key', 0)
+        threads = [threading.Thread(target=lovebeat.instruments.add,
+                                    args=('test.key',)) for i in range(100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(100, lovebeat.instruments.read()['test.key'] - before)
+        self.assertEquals(lovebeat.Instruments.SLOTS,
+                          len(lovebeat.instruments.slots))
+
+    def test_retries(self):
+        db = lovebeat.conn()
+        db.set('test.key', 0)
+        calls = []
+
+        def trans(pipe):
+            if not calls:
+                # modified by someone else
+                lovebeat.conn().set('test.key', 1)
+            calls.append(pipe.get('test.key'))
+            pipe.multi()
+            pipe.incr('test.key')
+        before = self.stats()['retries'].get('transaction', 0)
+        lovebeat.transaction(db, trans, 'test.key')
+        self.assertEquals(['1', '1'], calls)
+        self.assertEquals('2', db.get('test.key'))
+        self.assertEquals(1, self.stats()['retries']['transaction'] - before)
+
+
+if __name__ == '__main__':
+    unittest.main()
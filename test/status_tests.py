@@ -1,4 +1,5 @@
 import unittest
+import lovebeat
 from base import LovebeatBase
 from werkzeug.datastructures import MultiDict
 
@@ -41,6 +42,39 @@ class StatusTests(LovebeatBase):
         rv = self.app.get('/dashboard/all/status')
         self.assertEquals(rv.data, text)
 
+    def summary(self, lbl):
+        r = lovebeat.conn()
+        return dict((s, r.zcard('lb:status:%s:%s' % (lbl, s)))
+                    for s in lovebeat.STATUSES)
+
+    def test_label_summaries(self):
+        self.app.post('/s/test.one', data=dict(labels='foo', heartbeat=30))
+        self.app.post('/s/test.two', data=dict(labels='foo,bar'))
+        self.assertEquals({'ok': 2, 'warning': 0, 'error': 0, 'maint': 0},
+                          self.summary('foo'))
+
+        self.set_ts(10)
+        self.assertEquals('down+warning',
+                          self.app.get('/dashboard/bar/status').data)
+        self.assertEquals({'ok': 1, 'warning': 1, 'error': 0, 'maint': 0},
+                          self.summary('foo'))
+
+        # moving out of a label removes it from that label's summary
+        self.app.post('/s/test.two', data=dict(labels='baz'))
+        self.assertEquals('up+flawless',
+                          self.app.get('/dashboard/bar/status').data)
+        self.assertEquals({'ok': 1, 'warning': 0, 'error': 0, 'maint': 0},
+                          self.summary('baz'))
+
+        self.app.post('/s/test.one/maint')
+        self.assertEquals('up+maint',
+                          self.app.get('/dashboard/foo/status').data)
+
+        self.app.post('/s/test.one/delete')
+        self.app.post('/s/test.two/delete')
+        self.assertEquals({'ok': 0, 'warning': 0, 'error': 0, 'maint': 0},
+                          self.summary('all'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,51 @@
+import json
+import unittest
+import lovebeat
+from base import LovebeatBase
+
+
+class StreamTests(LovebeatBase):
+    def setUp(self):
+        super(StreamTests, self).setUp()
+        self.app.post('/s/test.one', data=dict(heartbeat='error:30'))
+        self.app.post('/s/test.two', data=dict(labels='foo'))
+
+    def test_stream_json(self):
+        self.set_ts(20)
+        streamed = json.loads(
+            self.app.get('/dashboard/all/json?stream=1').data)['services']
+        plain = json.loads(self.app.get('/dashboard/all/json').data)['services']
+        streamed.sort(key=lambda s: s['id'])
+        plain.sort(key=lambda s: s['id'])
+        self.assertEquals(plain, streamed)
+        self.assertEquals('error', streamed[1]['state']['status'])
+
+    def test_stream_json_empty(self):
+        obj = json.loads(self.app.get('/dashboard/none/json?stream=1').data)
+        self.assertEquals([], obj['services'])
+
+    def test_ndjson(self):
+        lines = self.app.get('/dashboard/foo/ndjson').data.splitlines()
+        self.assertEquals(1, len(lines))
+        self.assertEquals('test.two', json.loads(lines[0])['id'])
+
+    def test_stream_raw(self):
+        self.set_ts(20)
+        data = self.app.get('/dashboard/all/raw?stream=1').data
+        assert '[OK] test.one\n' in data
+        assert '[ERROR] test.two\n' in data
+        assert 'errors: True\n' in data
+        assert 'all good: False' in data
+
+    def test_iter_services_batches(self):
+        for i in range(25):
+            self.app.post('/s/test.many.%d' % i)
+        with lovebeat.app.test_request_context():
+            lovebeat.app.preprocess_request()
+            sids = [s['id'] for s in lovebeat.iter_services('all', count=4)]
+        self.assertEquals(27, len(sids))
+        self.assertEquals(27, len(set(sids)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import json
+import math
+import unittest
+import lovebeat
+from base import LovebeatBase
+from werkzeug.datastructures import MultiDict
+
+
+class ThresholdTests(LovebeatBase):
+    def setUp(self):
+        super(ThresholdTests, self).setUp()
+        self.numpy = lovebeat.numpy
+
+    def tearDown(self):
+        lovebeat.numpy = self.numpy
+
+    def configure(self, aggregate='last', window=300):
+        md = MultiDict([('heartbeat', 'error:1000'),
+                        ('threshold', 'warning:10'),
+                        ('threshold', 'error:20'),
+                        ('aggregate', aggregate),
+                        ('window', str(window))])
+        rv = self.app.post('/s/test.one', data=md)
+        self.assertEquals(200, rv.status_code)
+
+    def post(self, ts, value):
+        self.set_ts(ts)
+        self.app.post('/s/test.one', data=dict(value=value))
+
+    def test_last(self):
+        self.configure()
+        self.post(0, 5)
+        self.expect('test.one', 'OK')
+        self.post(1, 15)
+        self.expect('test.one', 'WARN')
+        self.post(2, 25)
+        self.expect('test.one', 'ERROR')
+        # heartbeats without values don't change the last value
+        self.app.post('/s/test.one')
+        self.expect('test.one', 'ERROR')
+        self.post(3, 1)
+        self.expect('test.one', 'OK')
+        self.assertEquals([], lovebeat.conn().hkeys('lb:thresholds'))
+
+    def test_config(self):
+        self.configure('p95', 600)
+        threshold = self.get_config('test.one')['threshold']
+        self.assertEquals({'warning': 10, 'error': 20, 'aggregate': 'p95',
+                           'window': 600}, threshold)
+        self.assertEquals('p95/600/10/20',
+                          lovebeat.conn().hget('lb:thresholds', 'test.one'))
+        self.app.post('/s/test.one', data=dict(threshold='off'))
+        self.assertFalse('threshold' in self.get_config('test.one'))
+        self.assertEquals([], lovebeat.conn().hkeys('lb:thresholds'))
+
+    def test_json(self):
+        threshold = {'error': 20, 'aggregate': 'max', 'window': 60}
+        self.app.post('/s/test.one', data=json.dumps({'threshold': threshold}),
+                      content_type='application/json')
+        self.assertEquals('max',
+                          self.get_config('test.one')['threshold']['aggregate'])
+        self.app.post('/batch', data=json.dumps([{'id': 'test.one',
+                                                  'threshold': {}}]),
+                      content_type='application/json')
+        self.assertFalse('threshold' in self.get_config('test.one'))
+
+    def test_bad_thresholds(self):
+        for data in (dict(threshold='error:lots'),
+                     dict(threshold='error:10', aggregate='median'),
+                     dict(threshold='error:10', window='0'),
+                     dict(threshold='error:10', window=str(7 * 3600)),
+                     dict(threshold='error:1:2'),
+                     dict(threshold='foo:5')):
+            rv = self.app.post('/s/test.one', data=data)
+            self.assertEquals(400, rv.status_code)
+
+    def check_avg(self):
+        self.configure('avg', 120)
+        self.post(0, 10)
+        self.expect('test.one', 'WARN')
+        self.post(30, 30)
+        self.expect('test.one', 'ERROR')
+        # the first value is still within the window, rounded to minutes
+        self.post(150, 0)
+        self.expect('test.one', 'WARN')
+        self.expect('test.one', 'OK', 180)
+
+    def check_max(self):
+        self.configure('max', 60)
+        self.post(0, 12)
+        self.post(10, 3)
+        self.expect('test.one', 'WARN', 20)
+        self.expect('test.one', 'OK', 120)
+
+    def check_percentile(self):
+        self.configure('p90', 60)
+        for i in range(10):
+            self.post(i, 1)
+        self.post(10, 100)
+        self.expect('test.one', 'OK', 20)
+        self.post(21, 100)
+        self.expect('test.one', 'ERROR')
+        self.expect('test.one', 'OK', 100)
+
+    def check_alert(self):
+        self.configure('max', 60)
+        self.post(0, 30)
+        self.expect('test.one', 'ERROR', 1)
+        alert = self.get_json('test.one')['state']['alert']
+        self.assertEquals({'id': 1, 'status': 'error', 'state': 'new'},
+                          dict((k, alert[k]) for k in ('id', 'status', 'state')))
+
+    def test_windows(self):
+        for check in (self.check_avg, self.check_max, self.check_percentile,
+                      self.check_alert):
+            for np in (self.numpy, None):
+                if np is None and self.numpy is None:
+                    continue
+                lovebeat.numpy = np
+                LovebeatBase.setUp(self)
+                check()
+
+    def test_interval(self):
+        self.configure('max', 60)
+        self.post(0, 30)
+        self.expect('test.one', 'ERROR', 1)
+        loads = []
+        load_thresholds = lovebeat.load_thresholds
+        lovebeat.load_thresholds = lambda db: (loads.append(db) or
+                                               load_thresholds(db))
+        try:
+            # dashboards read within EVAL_INTERVAL show the stored status
+            self.expect('test.one', 'ERROR')
+            self.expect('test.one', 'ERROR')
+            self.assertEquals(0, len(loads))
+            self.expect('test.one', 'OK', 120)
+            self.assertEquals(1, len(loads))
+        finally:
+            lovebeat.load_thresholds = load_thresholds
+
+    def test_delete(self):
+        self.configure('max', 60)
+        self.post(0, 30)
+        self.expect('test.one', 'ERROR', 1)
+        self.app.post('/s/test.one/delete')
+        r = lovebeat.conn()
+        self.assertEquals([], r.hkeys('lb:thresholds'))
+        self.assertEquals([], r.hkeys('lb:value_status'))
+
+    def test_aggregates(self):
+        data = lovebeat.struct.pack('<IdIdIdId', 1, 3, 2, 1, 3, 2, 1, 5)
+        for np in (self.numpy, None):
+            lovebeat.numpy = np
+            values = lovebeat.aggregate_raw(data, [0, 3, 0, 1], [0, 2, 0, 0],
+                                            ['p50', 'p99', 'p50', 'p50'])
+            self.assertTrue(math.isnan(values[0]) and math.isnan(values[2]))
+            self.assertEquals([2.0, 5.0], values[1::2])
+
+
+if __name__ == '__main__':
+    unittest.main()